@@ -4,7 +4,12 @@
 
 from __future__ import division
 from builtins import object
+from builtins import range
+import array
+import bisect
 import logging
+import sys
+import threading
 
 _logger = logging.getLogger('arvados.ranges')
 
@@ -60,6 +65,438 @@ def first_block(data_locators, range_start):
 
     return i
 
+# Array type code for segment fields: a signed 64-bit integer.
+_INT64 = 'q' if sys.version_info >= (3,) else 'l'
+
+class BlockTable(object):
+    """Interned block locators shared by the files of one collection.
+
+    A SegmentIndex refers to blocks by their position in a BlockTable, so a
+    locator used by many segments or files is stored once.  Entries are
+    never removed; to drop unused locators, rebind the indexes that use a
+    table to a new one.
+    """
+
+    def __init__(self):
+        self._index = {}
+        self._locators = []
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._locators)
+
+    def intern(self, locator):
+        """Return the table position of `locator`, adding it if needed."""
+        i = self._index.get(locator)
+        if i is None:
+            with self._lock:
+                i = self._index.get(locator)
+                if i is None:
+                    i = len(self._locators)
+                    self._locators.append(locator)
+                    self._index[locator] = i
+        return i
+
+    def locator(self, i):
+        return self._locators[i]
+
+    def remap(self, func):
+        """Replace each locator `loc` with `func(loc)`, unless that is None.
+
+        Every SegmentIndex using the table sees the new locators at once.
+        Returns the number of locators replaced.
+        """
+        replaced = 0
+        with self._lock:
+            for i, loc in enumerate(self._locators):
+                new_loc = func(loc)
+                if new_loc is None or new_loc == loc:
+                    continue
+                self._locators[i] = new_loc
+                if self._index.get(loc) == i:
+                    del self._index[loc]
+                self._index.setdefault(new_loc, i)
+                replaced += 1
+        return replaced
+
+
+class BlockStream(object):
+    """The blocks of a manifest stream, interned in a BlockTable.
+
+    Used with SegmentIndex.append_stream_range() to turn the file segments
+    of a stream into file segments quickly.
+    """
+
+    __slots__ = ('blocks', 'starts', 'sizes', 'ids', 'size')
+
+    def __init__(self, blocks):
+        self.blocks = blocks
+        self.starts = []
+        self.sizes = []
+        self.ids = []
+        self.size = 0
+
+    def append(self, locator, size):
+        self.starts.append(self.size)
+        self.sizes.append(size)
+        self.ids.append(self.blocks.intern(locator))
+        self.size += size
+
+
+class SegmentIndex(object):
+    """An ordered list of contiguous file segments, indexed by offset.
+
+    Segments are stored as rows of four integers (range_start, range_size,
+    block, segment_offset) in arrays ("chunks") of LOAD/2 to 2*LOAD rows,
+    with `block` a position in a BlockTable shared with the other files of
+    the collection.  Each chunk's range_starts are also kept in an array of
+    their own, with each chunk's first range_start and the number of rows
+    before it in lists, so finding the segment at an offset or index is two
+    binary searches.
+    Replacing a range only touches the chunks it overlaps, so random writes
+    to a file with many segments don't cost O(number of segments) each.
+
+    The index reads and writes Range objects, but they are built on demand:
+    changing a Range returned by the index does not change the index.  Use
+    replace_range(), truncate() and remap_locators() instead.
+    locators_and_ranges() and replace_range() accept a SegmentIndex in
+    place of a list.
+    """
+
+    __slots__ = ('_blocks', '_chunks', '_starts', '_firsts', '_rows', '_rows_valid', '_len')
+
+    # Appending fills chunks with this many segments.  Chunks that grow
+    # past twice this many are split, and ones that shrink below half are
+    # merged with their neighbours.
+    LOAD = 256
+
+    def __init__(self, segments=(), blocks=None):
+        """
+        :segments:
+          Range objects to start with.
+
+        :blocks:
+          BlockTable to intern locators in.  If not specified, use a new one.
+        """
+        self._blocks = blocks if blocks is not None else BlockTable()
+        self._chunks = []
+        # range_start of each row of the corresponding chunk.
+        self._starts = []
+        # range_start of each chunk's first row.
+        self._firsts = []
+        # Number of rows before each chunk.  Only the first _rows_valid
+        # entries are current; __getitem__ updates the rest when needed,
+        # so writes don't pay to renumber every chunk after theirs.
+        self._rows = []
+        self._rows_valid = 0
+        self._len = 0
+        self.extend(segments)
+
+    def __len__(self):
+        return self._len
+
+    def __iter__(self):
+        return self._iter_from(0, 0)
+
+    def __getitem__(self, i):
+        if i < 0:
+            i += self._len
+        if i < 0 or i >= self._len:
+            raise IndexError("segment index out of range")
+        rows = self._rows
+        if self._rows_valid < len(rows):
+            k = self._rows_valid
+            n = rows[k-1] + len(self._starts[k-1]) if k else 0
+            for k in range(k, len(rows)):
+                rows[k] = n
+                n += len(self._starts[k])
+            self._rows_valid = len(rows)
+        k = bisect.bisect_right(rows, i) - 1
+        return self._range(self._chunks[k], (i - rows[k]) * 4)
+
+    def __repr__(self):
+        return "SegmentIndex(%r)" % (list(self),)
+
+    def _range(self, chunk, i):
+        return Range(self._blocks._locators[chunk[i+2]], chunk[i], chunk[i+1], chunk[i+3])
+
+    def _iter_from(self, k, i):
+        locators = self._blocks._locators
+        chunks = self._chunks
+        while k < len(chunks):
+            chunk = chunks[k]
+            for i in range(i, len(chunk), 4):
+                yield Range(locators[chunk[i+2]], chunk[i], chunk[i+1], chunk[i+3])
+            k += 1
+            i = 0
+
+    def size(self):
+        """Return the offset just past the last segment."""
+        if not self._chunks:
+            return 0
+        last = self._chunks[-1]
+        return last[-4] + last[-3]
+
+    def _new_chunk(self, start):
+        if self._rows_valid == len(self._rows):
+            self._rows_valid += 1
+        self._chunks.append(array.array(_INT64))
+        self._starts.append(array.array(_INT64))
+        self._firsts.append(start)
+        self._rows.append(self._len)
+
+    def _append(self, start, size, block, offset):
+        if not self._chunks or len(self._starts[-1]) >= self.LOAD:
+            self._new_chunk(start)
+        self._chunks[-1].extend((start, size, block, offset))
+        self._starts[-1].append(start)
+        self._len += 1
+
+    def append(self, r):
+        self._append(r.range_start, r.range_size, self._blocks.intern(r.locator), r.segment_offset)
+
+    def extend(self, segments):
+        intern = self._blocks.intern
+        for r in segments:
+            if not self._chunks or len(self._starts[-1]) >= self.LOAD:
+                self._new_chunk(r.range_start)
+            self._chunks[-1].extend((r.range_start, r.range_size, intern(r.locator), r.segment_offset))
+            self._starts[-1].append(r.range_start)
+            self._len += 1
+
+    def append_stream_range(self, stream, pos, size):
+        """Append `size` bytes at offset `pos` of a BlockStream.
+
+        The result is the same as appending the ranges returned by
+        locators_and_ranges() for the stream's blocks.  `stream` must use
+        this index's BlockTable.
+        """
+        if stream.blocks is not self._blocks:
+            raise ValueError("BlockStream uses a different BlockTable")
+        starts = stream.starts
+        i = bisect.bisect_right(starts, pos) - 1
+        if i < 0:
+            return
+        end = pos + size
+        file_end = self.size()
+        while i < len(starts) and starts[i] < end:
+            block_start = starts[i]
+            lo = max(pos, block_start)
+            hi = min(end, block_start + stream.sizes[i])
+            if hi > lo:
+                self._append(file_end, hi - lo, stream.ids[i], lo - block_start)
+                file_end += hi - lo
+            i += 1
+
+    def locators(self):
+        """Return the distinct locators of the segments, in order of first use."""
+        seen = set()
+        result = []
+        locators = self._blocks._locators
+        for chunk in self._chunks:
+            for b in chunk[2::4]:
+                if b not in seen:
+                    seen.add(b)
+                    result.append(locators[b])
+        return result
+
+    def remap_locators(self, func):
+        """Replace each segment's locator `loc` with `func(loc)`.
+
+        `func` is called once per distinct locator.  Segments for which it
+        returns None are left alone.  Return True if any segment was given
+        a new locator.
+        """
+        locators = self._blocks._locators
+        mapping = {}
+        remapped = False
+        for chunk in self._chunks:
+            for i in range(2, len(chunk), 4):
+                b = chunk[i]
+                if b not in mapping:
+                    loc = func(locators[b])
+                    mapping[b] = None if loc is None else self._blocks.intern(loc)
+                if mapping[b] is not None:
+                    chunk[i] = mapping[b]
+                    remapped = True
+        return remapped
+
+    def pack_block(self, locator):
+        """Renumber the segments in `locator` to be consecutive in file order.
+
+        The first segment in the block gets segment_offset 0, the next one
+        starts where it ends, and so on.  Return the (segment_offset,
+        range_size) each of those segments had before, in file order.
+        """
+        block = self._blocks._index.get(locator)
+        old = []
+        if block is None:
+            return old
+        new_offset = 0
+        for chunk in self._chunks:
+            for i in range(2, len(chunk), 4):
+                if chunk[i] == block:
+                    old.append((chunk[i+1], chunk[i-1]))
+                    chunk[i+1] = new_offset
+                    new_offset += chunk[i-1]
+        return old
+
+    def rebind(self, blocks):
+        """Move this index's locators to the BlockTable `blocks`."""
+        if blocks is self._blocks:
+            return
+        locators = self._blocks._locators
+        mapping = {}
+        for chunk in self._chunks:
+            for i in range(2, len(chunk), 4):
+                b = chunk[i]
+                if b not in mapping:
+                    mapping[b] = blocks.intern(locators[b])
+                chunk[i] = mapping[b]
+        self._blocks = blocks
+
+    def _find(self, offset):
+        """Return (chunk, row) of the segment containing offset, or None.
+
+        `row` is the position of the segment's first field in the chunk.
+        """
+        k = bisect.bisect_right(self._firsts, offset) - 1
+        if k < 0:
+            return None
+        i = (bisect.bisect_right(self._starts[k], offset) - 1) * 4
+        chunk = self._chunks[k]
+        if offset >= chunk[i] + chunk[i+1]:
+            return None
+        return k, i
+
+    def iter_from(self, offset):
+        """Iterate over segments, starting with the one containing offset."""
+        pos = self._find(offset)
+        if pos is None:
+            return iter(())
+        return self._iter_from(*pos)
+
+    def _splice(self, k1, i1, k2, i2, pieces):
+        """Replace segments (k1, i1) through (k2, i2) inclusive with pieces.
+
+        `pieces` is a flat list of segment fields.
+        """
+        chunks = self._chunks
+        starts = self._starts
+        pieces = array.array(_INT64, pieces)
+        piece_starts = pieces[0::4]
+        if k1 == k2:
+            removed = (i2 + 4 - i1) // 4
+            chunks[k1][i1:i2+4] = pieces
+            starts[k1][i1//4:i2//4+1] = piece_starts
+        else:
+            removed = (len(chunks[k1]) - i1 + i2 + 4) // 4
+            for k in range(k1+1, k2):
+                removed += len(chunks[k]) // 4
+            chunks[k1][i1:] = pieces
+            starts[k1][i1//4:] = piece_starts
+            del chunks[k2][:i2+4]
+            del starts[k2][:i2//4+1]
+            if starts[k2]:
+                self._firsts[k2] = starts[k2][0]
+            del chunks[k1+1:k2]
+            del starts[k1+1:k2]
+            del self._firsts[k1+1:k2]
+            del self._rows[k1+1:k2]
+        if starts[k1]:
+            self._firsts[k1] = starts[k1][0]
+        self._len += len(pieces) // 4 - removed
+        self._rebalance(k1)
+
+    def _rebalance(self, k):
+        """Merge and split chunk k and its neighbours to keep chunk sizes in
+        bounds."""
+        chunks = self._chunks
+        starts = self._starts
+        lo = max(k - 1, 0)
+        hi = min(k + 2, len(chunks))
+        low = self.LOAD // 2 if len(chunks) > 1 else 1
+        high = 2 * self.LOAD
+        for s in starts[k:hi]:
+            if not low <= len(s) <= high:
+                break
+        else:
+            self._rows_valid = min(self._rows_valid, k + 1)
+            return
+        fields = array.array(_INT64)
+        for chunk in chunks[lo:hi]:
+            fields.extend(chunk)
+        nrows = len(fields) // 4
+        n = -(-nrows // self.LOAD)
+        new_chunks = [fields[(nrows * j // n) * 4:(nrows * (j + 1) // n) * 4]
+                      for j in range(n)]
+        chunks[lo:hi] = new_chunks
+        starts[lo:hi] = [chunk[0::4] for chunk in new_chunks]
+        self._firsts[lo:hi] = [chunk[0] for chunk in new_chunks]
+        self._rows[lo:hi] = [0] * n
+        self._rows_valid = min(self._rows_valid, lo)
+
+    def replace_range(self, new_range_start, new_range_size, new_locator, new_segment_offset):
+        """See replace_range()."""
+        if new_range_size == 0:
+            return
+
+        new_range_end = new_range_start + new_range_size
+        block = self._blocks.intern(new_locator)
+
+        if self._len == 0:
+            self._append(new_range_start, new_range_size, block, new_segment_offset)
+            return
+
+        last = self._chunks[-1]
+        if (last[-4] + last[-3]) == new_range_start:
+            if last[-2] == block and (last[-1] + last[-3]) == new_segment_offset:
+                # extend last segment
+                last[-3] += new_range_size
+            else:
+                self._append(new_range_start, new_range_size, block, new_segment_offset)
+            return
+
+        first = self._find(new_range_start)
+        if first is None:
+            return
+        k1, i1 = first
+        chunk = self._chunks[k1]
+
+        pieces = []
+        if new_range_start > chunk[i1]:
+            pieces.extend((chunk[i1], new_range_start - chunk[i1], chunk[i1+2], chunk[i1+3]))
+        pieces.extend((new_range_start, new_range_size, block, new_segment_offset))
+
+        end = self._find(new_range_end - 1)
+        if end is None:
+            # The new range runs past the end of the file.
+            k2 = len(self._chunks) - 1
+            i2 = len(self._chunks[k2]) - 4
+        else:
+            k2, i2 = end
+            chunk = self._chunks[k2]
+            old_segment_end = chunk[i2] + chunk[i2+1]
+            if new_range_end < old_segment_end:
+                pieces.extend((new_range_end, old_segment_end - new_range_end, chunk[i2+2],
+                               chunk[i2+3] + (new_range_end - chunk[i2])))
+        self._splice(k1, i1, k2, i2, pieces)
+
+    def truncate(self, size):
+        """Drop everything after offset `size`."""
+        pos = self._find(size)
+        if pos is None:
+            return
+        k, i = pos
+        chunk = self._chunks[k]
+        if chunk[i] < size:
+            pieces = [chunk[i], size - chunk[i], chunk[i+2], chunk[i+3]]
+        else:
+            pieces = []
+        last = len(self._chunks) - 1
+        self._splice(k, i, last, len(self._chunks[last]) - 4, pieces)
+
+
 class LocatorAndRange(object):
     __slots__ = ("locator", "block_size", "segment_offset", "segment_size")
 
@@ -84,7 +521,8 @@ def locators_and_ranges(data_locators, range_start, range_size, limit=None):
     Returns a list of LocatorAndRange objects.
 
     :data_locators:
-      list of Range objects, assumes that blocks are in order and contiguous
+      list or SegmentIndex of Range objects, assumes that blocks are in
+      order and contiguous
 
     :range_start:
       start of range
@@ -103,14 +541,19 @@ def locators_and_ranges(data_locators, range_start, range_size, limit=None):
     resp = []
     range_end = range_start + range_size
 
-    i = first_block(data_locators, range_start)
-    if i is None:
-        return []
-
-    # We should always start at the first segment due to the binary
-    # search.
-    while i < len(data_locators) and len(resp) != limit:
-        dl = data_locators[i]
+    if isinstance(data_locators, SegmentIndex):
+        segments = data_locators.iter_from(range_start)
+    else:
+        i = first_block(data_locators, range_start)
+        if i is None:
+            return []
+        # We should always start at the first segment due to the binary
+        # search.
+        segments = (data_locators[j] for j in range(i, len(data_locators)))
+
+    for dl in segments:
+        if len(resp) == limit:
+            break
         block_start = dl.range_start
         block_size = dl.range_size
         block_end = block_start + block_size
@@ -133,8 +576,6 @@ def locators_and_ranges(data_locators, range_start, range_size, limit=None):
         elif range_start < block_start and range_end <= block_end:
             # range starts in a previous block and ends in this block
             resp.append(LocatorAndRange(dl.locator, block_size, dl.segment_offset, range_end - block_start))
-        block_start = block_end
-        i += 1
     return resp
 
 def replace_range(data_locators, new_range_start, new_range_size, new_locator, new_segment_offset):
@@ -145,7 +586,8 @@ def replace_range(data_locators, new_range_start, new_range_size, new_locator, n
     data_locators will be updated in place
 
     :data_locators:
-      list of Range objects, assumes that segments are in order and contiguous
+      list or SegmentIndex of Range objects, assumes that segments are in
+      order and contiguous
 
     :new_range_start:
       start of range to replace in data_locators
@@ -160,6 +602,10 @@ def replace_range(data_locators, new_range_start, new_range_size, new_locator, n
       segment offset within the locator
 
     """
+    if isinstance(data_locators, SegmentIndex):
+        data_locators.replace_range(new_range_start, new_range_size, new_locator, new_segment_offset)
+        return
+
     if new_range_size == 0:
         return
 
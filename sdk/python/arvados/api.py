@@ -15,6 +15,7 @@ import os
 import re
 import socket
 import sys
+import threading
 import time
 import types
 
@@ -32,6 +33,8 @@ MAX_IDLE_CONNECTION_DURATION = 30
 RETRY_DELAY_INITIAL = 2
 RETRY_DELAY_BACKOFF = 2
 RETRY_COUNT = 2
+DISCOVERY_MAX_AGE = 60*60*24*2
+DISCOVERY_REFRESH_AGE = 60*5
 
 if sys.version_info >= (3,):
     httplib2.SSLHandshakeError = None
@@ -154,7 +157,110 @@ def http_cache(data_type):
         util.mkdir_dash_p(path)
     except OSError:
         return None
-    return cache.SafeHTTPCache(path, max_age=60*60*24*2)
+    return cache.SafeHTTPCache(path, max_age=DISCOVERY_MAX_AGE)
+
+# Discovery documents, shared by all the API clients in this process.
+# Maps each discovery URL to a (fetched_at, JSON text) tuple.  apiclient
+# modifies the document while it builds a client, so each client parses
+# its own copy.
+_discovery_docs = {}
+# Maps each discovery URL being refreshed to its refresh thread.
+_discovery_refreshing = {}
+_discovery_lock = threading.Lock()
+
+def _discovery_cache_key(url):
+    return 'arvados-discovery-document:' + url
+
+def _fetch_discovery_document(http, url):
+    """Return the discovery document at `url` as JSON text."""
+    resp, content = http.request(url)
+    if resp.status >= 400:
+        raise apiclient_errors.HttpError(resp, content, uri=url)
+    return content.decode('utf-8')
+
+def _fetch_discovery_entry(http, url):
+    content = _fetch_discovery_document(http, url)
+    # Fail now rather than in every client if it isn't JSON.
+    json.loads(content)
+    return (time.time(), content)
+
+def _load_discovery_document(url):
+    disk_cache = http_cache('discovery')
+    if disk_cache is None:
+        return None
+    content = disk_cache.get(_discovery_cache_key(url))
+    if content is None:
+        return None
+    try:
+        cached = json.loads(content.decode('utf-8'))
+        return (float(cached['fetched_at']), cached['document'])
+    except Exception:
+        _logger.debug("Ignoring unreadable cached discovery document for %s",
+                      url, exc_info=True)
+        return None
+
+def _store_discovery_document(url, entry):
+    with _discovery_lock:
+        _discovery_docs[url] = entry
+    disk_cache = http_cache('discovery')
+    if disk_cache is not None:
+        disk_cache.set(_discovery_cache_key(url), json.dumps({
+            'fetched_at': entry[0],
+            'document': entry[1],
+        }).encode('utf-8'))
+
+def _refresh_discovery_document(url, new_http):
+    """Fetch the discovery document again in a background thread.
+
+    Clients built before the refresh finishes use the cached document.
+    At most one refresh per URL runs at a time.  The thread is a daemon:
+    a process doesn't wait for it at exit, and if it hasn't finished, the
+    next process to use the document refreshes it.
+    """
+    def refresh():
+        try:
+            _store_discovery_document(
+                url, _fetch_discovery_entry(new_http(), url))
+        except Exception:
+            _logger.debug("Failed to refresh discovery document %s",
+                          url, exc_info=True)
+        finally:
+            with _discovery_lock:
+                _discovery_refreshing.pop(url, None)
+
+    with _discovery_lock:
+        if url in _discovery_refreshing:
+            return
+        thread = threading.Thread(target=refresh, name="discovery refresh")
+        thread.daemon = True
+        _discovery_refreshing[url] = thread
+        thread.start()
+
+def _discovery_document(url, http, new_http):
+    """Return the parsed discovery document at `url`.
+
+    A document fetched in the last DISCOVERY_REFRESH_AGE seconds is used
+    as is, without revalidating it with the server.  An older one is
+    still used if it is newer than DISCOVERY_MAX_AGE, but gets refreshed
+    in the background with a client from `new_http`.  If `new_http` is
+    None, or there is no usable cached document, fetch it now with
+    `http`.
+    """
+    with _discovery_lock:
+        entry = _discovery_docs.get(url)
+    if entry is None:
+        entry = _load_discovery_document(url)
+    age = time.time() - entry[0] if entry else None
+    if (entry is None or age > DISCOVERY_MAX_AGE or
+        (age > DISCOVERY_REFRESH_AGE and new_http is None)):
+        entry = _fetch_discovery_entry(http, url)
+        _store_discovery_document(url, entry)
+    else:
+        with _discovery_lock:
+            _discovery_docs.setdefault(url, entry)
+        if age > DISCOVERY_REFRESH_AGE:
+            _refresh_discovery_document(url, new_http)
+    return json.loads(entry[1])
 
 def api(version=None, cache=True, host=None, token=None, insecure=False,
         request_id=None, timeout=10, **kwargs):
@@ -166,7 +272,14 @@ def api(version=None, cache=True, host=None, token=None, insecure=False,
 
     :cache:
       Use a cache (~/.cache/arvados/discovery) for the discovery
-      document.
+      document.  A cached document is reused without contacting the
+      server, and refreshed in the background once it is more than
+      DISCOVERY_REFRESH_AGE seconds old.  After the API server is
+      upgraded, clients can therefore keep using the old document, and
+      see errors for methods it no longer has, for DISCOVERY_REFRESH_AGE
+      seconds, or up to DISCOVERY_MAX_AGE seconds while the server can't
+      be reached for a refresh.  Pass cache=False to always fetch the
+      current document.
 
     :host:
       The Arvados API server host (and optional :port) to connect to.
@@ -224,6 +337,7 @@ def api(version=None, cache=True, host=None, token=None, insecure=False,
         kwargs['discoveryServiceUrl'] = (
             'https://%s/discovery/v1/apis/{api}/{apiVersion}/rest' % (host,))
 
+    new_http = None
     if 'http' not in kwargs:
         http_kwargs = {'ca_certs': util.ca_certs_path()}
         if cache:
@@ -231,13 +345,23 @@ def api(version=None, cache=True, host=None, token=None, insecure=False,
         if insecure:
             http_kwargs['disable_ssl_certificate_validation'] = True
         kwargs['http'] = httplib2.Http(**http_kwargs)
+        new_http = lambda: _patch_http_request(
+            httplib2.Http(timeout=timeout, **http_kwargs), token)
 
     if kwargs['http'].timeout is None:
         kwargs['http'].timeout = timeout
 
     kwargs['http'] = _patch_http_request(kwargs['http'], token)
 
-    svc = apiclient_discovery.build('arvados', version, cache_discovery=False, **kwargs)
+    discovery_url = kwargs.pop('discoveryServiceUrl').format(
+        api='arvados', apiVersion=version)
+    if cache:
+        discovery_doc = _discovery_document(
+            discovery_url, kwargs['http'], new_http)
+    else:
+        discovery_doc = json.loads(
+            _fetch_discovery_document(kwargs['http'], discovery_url))
+    svc = apiclient_discovery.build_from_document(discovery_doc, **kwargs)
     svc.api_token = token
     svc.insecure = insecure
     svc.request_id = request_id
@@ -11,10 +11,11 @@ from builtins import range
 from builtins import object
 import bz2
 import collections
-import copy
 import errno
 import functools
 import hashlib
+import heapq
+import itertools
 import logging
 import os
 import queue
@@ -28,7 +29,7 @@ from . import config
 from .errors import KeepWriteError, AssertionError, ArgumentError
 from .keep import KeepLocator
 from ._normalize_stream import normalize_stream
-from ._ranges import locators_and_ranges, replace_range, Range, LocatorAndRange
+from ._ranges import locators_and_ranges, replace_range, Range, LocatorAndRange, SegmentIndex
 from .retry import retry_method
 
 MOD = "mod"
@@ -277,6 +278,116 @@ class StateChangeError(Exception):
         self.state = state
         self.nextstate = nextstate
 
+class _BufferPool(object):
+    """Recycled write buffers for _BufferBlocks, under a memory budget.
+
+    Buffers come in power-of-two sizes from MIN_BUFFER up, so a block
+    growing to full size reuses buffers that earlier blocks gave back
+    instead of asking the allocator for fresh ones.  Idle buffers are kept
+    for reuse up to `retain` bytes.
+
+    Buffers in use and idle buffers together stay within `budget` bytes.
+    acquire() is called with a block's lock held, and usually its
+    collection's too, so it never waits: it goes over budget if it has
+    to.  Writers call wait_for_room() before taking those locks instead,
+    which waits for an upload to finish and give its buffer back.  If no
+    uploads are in progress, waiting would never end, so it doesn't.
+    """
+
+    MIN_BUFFER = 2**14
+    DEFAULT_RETAIN = 2 * config.KEEP_BLOCK_SIZE
+
+    def __init__(self, budget, retain=None):
+        self.budget = budget
+        self.retain = self.DEFAULT_RETAIN if retain is None else retain
+        self._cond = threading.Condition()
+        # buffer size => list of idle buffers
+        self._free = collections.defaultdict(list)
+        self._free_bytes = 0
+        self._in_use = 0
+        self._uploading = 0
+        self.allocated = 0
+        self.reused = 0
+        self.waits = 0
+
+    @classmethod
+    def buffer_size(cls, nbytes):
+        size = cls.MIN_BUFFER
+        while size < nbytes:
+            size *= 2
+        return size
+
+    def _drop_free(self):
+        size = max(sz for sz, bufs in self._free.items() if bufs)
+        self._free[size].pop()
+        self._free_bytes -= size
+
+    def acquire(self, nbytes):
+        """Return a buffer of at least nbytes, without waiting."""
+        size = self.buffer_size(nbytes)
+        with self._cond:
+            if self._free[size]:
+                self._free_bytes -= size
+                self._in_use += size
+                self.reused += 1
+                return self._free[size].pop()
+            while self._free_bytes and self._in_use + self._free_bytes + size > self.budget:
+                self._drop_free()
+            self._in_use += size
+            self.allocated += 1
+        return bytearray(size)
+
+    def wait_for_room(self, nbytes):
+        """Wait until nbytes more of buffers fit in the budget.
+
+        Returns at once if no uploads are in progress.  Don't call this
+        while holding a lock that uploads or other writers need.
+        """
+        with self._cond:
+            waited = False
+            while self._uploading and self._in_use + nbytes > self.budget:
+                if not waited:
+                    self.waits += 1
+                    waited = True
+                self._cond.wait()
+
+    def release(self, buf, reuse=True):
+        """Give back a buffer from acquire().
+
+        Pass reuse=False if something else may still be reading it.
+        """
+        size = len(buf)
+        with self._cond:
+            self._in_use -= size
+            if (reuse and
+                self._free_bytes + size <= self.retain and
+                self._in_use + self._free_bytes + size <= self.budget):
+                self._free[size].append(buf)
+                self._free_bytes += size
+            self._cond.notify_all()
+
+    def upload_started(self):
+        with self._cond:
+            self._uploading += 1
+
+    def upload_finished(self):
+        with self._cond:
+            self._uploading -= 1
+            self._cond.notify_all()
+
+    def stats(self):
+        with self._cond:
+            return {
+                'budget': self.budget,
+                'in_use': self._in_use,
+                'free': self._free_bytes,
+                'uploading': self._uploading,
+                'allocated': self.allocated,
+                'reused': self.reused,
+                'waits': self.waits,
+            }
+
+
 class _BufferBlock(object):
     """A stand-in for a Keep block that is in the process of being written.
 
@@ -303,7 +414,7 @@ class _BufferBlock(object):
     ERROR = 3
     DELETED = 4
 
-    def __init__(self, blockid, starting_capacity, owner):
+    def __init__(self, blockid, starting_capacity, owner, pool=None):
         """
         :blockid:
           the identifier for this block
@@ -314,11 +425,26 @@ class _BufferBlock(object):
         :owner:
           ArvadosFile that owns this block
 
+        :pool:
+          _BufferPool to take buffers from, or None to allocate them directly
+
         """
         self.blockid = blockid
-        self.buffer_block = bytearray(starting_capacity)
-        self.buffer_view = memoryview(self.buffer_block)
+        self._pool = pool
+        # Buffers from the pool that this block has to give back.
+        self._buffers = []
+        # The block's content is normally buffer_view[0:write_pointer].
+        # A block assembled from pieces of other buffers (see append_block
+        # and repack_writes) instead has no buffer_view, and its content
+        # is this list of views, in order.
+        self._chunks = None
+        self._set_buffer(self._new_buffer(starting_capacity))
         self.write_pointer = 0
+        # Running hash of the first _md5_size bytes of content.  Blocks
+        # only grow at the end, so locator() just has to hash the bytes
+        # appended since it last ran.
+        self._md5 = hashlib.md5()
+        self._md5_size = 0
         self._state = _BufferBlock.WRITABLE
         self._locator = None
         self.owner = owner
@@ -326,6 +452,69 @@ class _BufferBlock(object):
         self.wait_for_commit = threading.Event()
         self.error = None
 
+    def _new_buffer(self, capacity):
+        if self._pool is None:
+            return bytearray(capacity)
+        return self._pool.acquire(capacity)
+
+    def _set_buffer(self, buf):
+        self.buffer_block = buf
+        self.buffer_view = memoryview(buf)
+        self._chunks = None
+        if self._pool is not None:
+            self._buffers.append(buf)
+
+    def _release_buffer(self, reuse=True):
+        buffers = self._buffers
+        self._buffers = []
+        self.buffer_block = None
+        self.buffer_view = None
+        self._chunks = None
+        if self._pool is not None:
+            for buf in buffers:
+                self._pool.release(buf, reuse)
+
+    def _views(self, offset, size):
+        """Return memoryviews of `size` bytes of content starting at `offset`."""
+        if self._chunks is None:
+            return [self.buffer_view[offset:offset+size]]
+        views = []
+        for chunk in self._chunks:
+            if size <= 0:
+                break
+            if offset >= len(chunk):
+                offset -= len(chunk)
+                continue
+            view = chunk[offset:offset+size]
+            views.append(view)
+            size -= len(view)
+            offset = 0
+        return views
+
+    def _contents(self):
+        views = self._views(0, self.write_pointer)
+        if len(views) == 1:
+            return views[0].tobytes()
+        return b''.join(v.tobytes() for v in views)
+
+    def _append(self, data):
+        needed = self.write_pointer + len(data)
+        if self._chunks is not None or needed > len(self.buffer_block):
+            if self._chunks is not None:
+                capacity = needed
+            else:
+                capacity = max(len(self.buffer_block) * 2, needed)
+            new_buffer_block = self._new_buffer(capacity)
+            pos = 0
+            for view in self._views(0, self.write_pointer):
+                new_buffer_block[pos:pos+len(view)] = view
+                pos += len(view)
+            self._release_buffer()
+            self._set_buffer(new_buffer_block)
+        self.buffer_view[self.write_pointer:needed] = data
+        self.write_pointer = needed
+        self._locator = None
+
     @synchronized
     def append(self, data):
         """Append some data to the buffer.
@@ -337,17 +526,42 @@ class _BufferBlock(object):
         if self._state == _BufferBlock.WRITABLE:
             if not isinstance(data, bytes) and not isinstance(data, memoryview):
                 data = data.encode()
-            while (self.write_pointer+len(data)) > len(self.buffer_block):
-                new_buffer_block = bytearray(len(self.buffer_block) * 2)
-                new_buffer_block[0:self.write_pointer] = self.buffer_block[0:self.write_pointer]
-                self.buffer_block = new_buffer_block
-                self.buffer_view = memoryview(self.buffer_block)
-            self.buffer_view[self.write_pointer:self.write_pointer+len(data)] = data
-            self.write_pointer += len(data)
-            self._locator = None
+            self._append(data)
         else:
             raise AssertionError("Buffer block is not writable")
 
+    @synchronized
+    def append_block(self, other):
+        """Append the content of another buffer block without copying it.
+
+        This block takes over giving other's buffers back to the pool, so
+        other must be deleted, not committed, afterwards.  Until then its
+        content is still readable.
+
+        """
+        if self._state != _BufferBlock.WRITABLE:
+            raise AssertionError("Buffer block is not writable")
+        with other.lock:
+            views = other._views(0, other.write_pointer)
+            if other._buffers and other._pool is not self._pool:
+                # We can't take the buffers over, so copy them.
+                for view in views:
+                    self._append(view)
+                return
+            if self._chunks is None:
+                if self.write_pointer == 0:
+                    self._release_buffer()
+                    self._chunks = []
+                else:
+                    self._chunks = self._views(0, self.write_pointer)
+                    self.buffer_block = None
+                    self.buffer_view = None
+            self._chunks.extend(views)
+            self._buffers.extend(other._buffers)
+            other._buffers = []
+            self.write_pointer += other.write_pointer
+            self._locator = None
+
     STATE_TRANSITIONS = frozenset([
             (WRITABLE, PENDING),
             (PENDING, COMMITTED),
@@ -362,17 +576,22 @@ class _BufferBlock(object):
 
         if self._state == _BufferBlock.PENDING:
             self.wait_for_commit.clear()
+            if self._pool is not None:
+                self._pool.upload_started()
 
         if self._state == _BufferBlock.COMMITTED:
             self._locator = val
-            self.buffer_view = None
-            self.buffer_block = None
+            self._md5 = None
+            self._release_buffer()
             self.wait_for_commit.set()
 
         if self._state == _BufferBlock.ERROR:
             self.error = val
             self.wait_for_commit.set()
 
+        if self._pool is not None and self._state in (_BufferBlock.COMMITTED, _BufferBlock.ERROR):
+            self._pool.upload_finished()
+
     @synchronized
     def state(self):
         return self._state
@@ -381,27 +600,49 @@ class _BufferBlock(object):
         """The amount of data written to the buffer."""
         return self.write_pointer
 
+    def _md5sum(self):
+        if self._md5 is None:
+            self._md5 = hashlib.md5()
+            self._md5_size = 0
+        if self._md5_size < self.write_pointer:
+            for view in self._views(self._md5_size, self.write_pointer - self._md5_size):
+                self._md5.update(view)
+            self._md5_size = self.write_pointer
+        return self._md5.hexdigest()
+
+    @synchronized
+    def md5sum(self):
+        """The MD5 hex digest of this buffer's contents."""
+        return self._md5sum()
+
     @synchronized
     def locator(self):
         """The Keep locator for this buffer's contents."""
         if self._locator is None:
-            self._locator = "%s+%i" % (hashlib.md5(self.buffer_view[0:self.write_pointer]).hexdigest(), self.size())
+            self._locator = "%s+%i" % (self._md5sum(), self.size())
         return self._locator
 
     @synchronized
     def clone(self, new_blockid, owner):
         if self._state == _BufferBlock.COMMITTED:
             raise AssertionError("Cannot duplicate committed buffer block")
-        bufferblock = _BufferBlock(new_blockid, self.size(), owner)
-        bufferblock.append(self.buffer_view[0:self.size()])
+        bufferblock = _BufferBlock(new_blockid, self.size(), owner, pool=self._pool)
+        for view in self._views(0, self.write_pointer):
+            bufferblock.append(view)
         return bufferblock
 
     @synchronized
     def clear(self):
+        if self._state == _BufferBlock.PENDING:
+            # An upload may still be reading the buffer, so it can't be
+            # handed to another block.
+            self._release_buffer(reuse=False)
+            if self._pool is not None:
+                self._pool.upload_finished()
+        else:
+            self._release_buffer()
         self._state = _BufferBlock.DELETED
         self.owner = None
-        self.buffer_block = None
-        self.buffer_view = None
 
     @synchronized
     def repack_writes(self):
@@ -416,32 +657,31 @@ class _BufferBlock(object):
         if self._state != _BufferBlock.WRITABLE:
             raise AssertionError("Cannot repack non-writable block")
 
-        segs = self.owner.segments()
-
-        # Collect the segments that reference the buffer block.
-        bufferblock_segs = [s for s in segs if s.locator == self.blockid]
+        # Point the file's segments in this block at where they will be
+        # after repacking, and collect where their data is now.
+        bufferblock_segs = self.owner.pack_block_segments(self.blockid)
 
         # Collect total data referenced by segments (could be smaller than
         # bufferblock size if a portion of the file was written and
         # then overwritten).
-        write_total = sum([s.range_size for s in bufferblock_segs])
+        write_total = sum([size for offset, size in bufferblock_segs])
 
         if write_total < self.size() or len(bufferblock_segs) > 1:
             # If there's more than one segment referencing this block, it is
             # due to out-of-order writes and will produce a fragmented
-            # manifest, so try to optimize by re-packing into a new buffer.
-            contents = self.buffer_view[0:self.write_pointer].tobytes()
-            new_bb = _BufferBlock(None, write_total, None)
-            for t in bufferblock_segs:
-                new_bb.append(contents[t.segment_offset:t.segment_offset+t.range_size])
-                t.segment_offset = new_bb.size() - t.range_size
-
-            self.buffer_block = new_bb.buffer_block
-            self.buffer_view = new_bb.buffer_view
-            self.write_pointer = new_bb.write_pointer
+            # manifest, so try to optimize by re-packing.  The segments
+            # are put in order as views of the existing buffer, so nothing
+            # is copied.
+            chunks = []
+            for offset, size in bufferblock_segs:
+                chunks.extend(self._views(offset, size))
+
+            self._chunks = chunks
+            self.buffer_block = None
+            self.buffer_view = None
+            self.write_pointer = write_total
             self._locator = None
-            new_bb.clear()
-            self.owner.set_segments(segs)
+            self._md5 = None
 
     def __repr__(self):
         return "<BufferBlock %s>" % (self.blockid)
@@ -470,6 +710,183 @@ def must_be_writable(orig_func):
     return must_be_writable_wrapper
 
 
+class _ReadAhead(object):
+    """Size the read-ahead window for one reader from its access pattern.
+
+    Each read that starts where the previous one ended (or skips forward
+    by less than the current window) doubles the window, from MIN_WINDOW up
+    to max_window.  A read that starts up to REORDER_SLACK bytes before the
+    furthest point read so far leaves the window as it is: concurrent reads
+    of one stream, like the kernel's async reads through FUSE, don't always
+    arrive in order.  Any other read is treated as random access and turns
+    read-ahead off until the reader is sequential again.
+
+    Also counts how many prefetched blocks were later read (hits) and how
+    many were abandoned unread (wasted).
+    """
+
+    # Start small, so a reader that only wants the start of a file doesn't
+    # pull in a whole block after it; doubling reaches a full block after
+    # a handful of sequential reads.
+    MIN_WINDOW = 1 << 20
+    REORDER_SLACK = 1 << 20
+    MAX_WINDOW = 8 * config.KEEP_BLOCK_SIZE
+    # Number of outstanding prefetched blocks to remember.
+    MAX_TRACKED = 256
+
+    def __init__(self, max_window=None):
+        self.lock = threading.Lock()
+        self.max_window = max(max_window or self.MAX_WINDOW, self.MIN_WINDOW)
+        self.window = 0
+        self.next_offset = 0
+        self.prefetched = 0
+        self.hits = 0
+        self.wasted = 0
+        self._outstanding = collections.OrderedDict()
+
+    def access(self, offset, size, locators):
+        """Record a read of `size` bytes at `offset` that used `locators`.
+
+        Returns the number of bytes after the read to prefetch.
+        """
+        with self.lock:
+            for loc in locators:
+                if self._outstanding.pop(loc, None) is not None:
+                    self.hits += 1
+            if self.next_offset <= offset <= self.next_offset + self.window:
+                self.window = min(max(self.window * 2, self.MIN_WINDOW), self.max_window)
+                self.next_offset = offset + size
+            elif self.next_offset - self.REORDER_SLACK <= offset < self.next_offset:
+                self.next_offset = max(self.next_offset, offset + size)
+            else:
+                self.window = 0
+                # The pattern that justified earlier prefetches is gone.
+                self.wasted += len(self._outstanding)
+                self._outstanding.clear()
+                self.next_offset = offset + size
+            return self.window
+
+    def should_prefetch(self, locator):
+        """Return True if locator isn't already outstanding."""
+        with self.lock:
+            return locator not in self._outstanding
+
+    def add_prefetch(self, locator):
+        """Count a prefetch of locator that was queued."""
+        with self.lock:
+            if locator in self._outstanding:
+                return
+            self._outstanding[locator] = True
+            self.prefetched += 1
+            if len(self._outstanding) > self.MAX_TRACKED:
+                self._outstanding.popitem(last=False)
+                self.wasted += 1
+
+    def stats(self):
+        """Return read-ahead counters and hit/waste ratios."""
+        with self.lock:
+            return {
+                'window': self.window,
+                'prefetched': self.prefetched,
+                'hits': self.hits,
+                'wasted': self.wasted,
+                'outstanding': len(self._outstanding),
+                'hit_ratio': (self.hits / self.prefetched) if self.prefetched else 0.0,
+                'waste_ratio': (self.wasted / self.prefetched) if self.prefetched else 0.0,
+            }
+
+
+class _PrefetchQueue(object):
+    """Block prefetch requests waiting for a download thread.
+
+    Requests come out lowest priority value first; readers use the
+    distance of the block from their current read position.  A locator is
+    queued at most once: asking for it again can only move it up.  Each
+    request is made on behalf of an owner (normally a reader's _ReadAhead),
+    and cancel(owner) withdraws that owner's requests, dropping blocks no
+    other owner still wants.
+    """
+
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self._cond = threading.Condition()
+        self._heap = []
+        # locator => [priority, sequence number, set of owners]
+        self._pending = {}
+        # owner => set of locators
+        self._by_owner = {}
+        self._seq = itertools.count()
+        self._closed = False
+
+    def __len__(self):
+        with self._cond:
+            return len(self._pending)
+
+    def put(self, locator, priority=0, owner=None):
+        """Queue a locator.  Returns False if the queue is full."""
+        with self._cond:
+            entry = self._pending.get(locator)
+            if entry is None:
+                if len(self._pending) >= self.maxsize:
+                    return False
+                entry = self._pending[locator] = [priority, next(self._seq), set()]
+                heapq.heappush(self._heap, (priority, entry[1], locator))
+                self._cond.notify()
+            elif priority < entry[0]:
+                # Requeue it nearer the front; the old heap entry becomes
+                # stale and is skipped by get().
+                entry[0] = priority
+                entry[1] = next(self._seq)
+                heapq.heappush(self._heap, (priority, entry[1], locator))
+            entry[2].add(owner)
+            self._by_owner.setdefault(owner, set()).add(locator)
+            return True
+
+    def cancel(self, owner):
+        """Withdraw all of owner's requests that haven't started."""
+        with self._cond:
+            for locator in self._by_owner.pop(owner, ()):
+                entry = self._pending.get(locator)
+                if entry is not None:
+                    entry[2].discard(owner)
+                    if not entry[2]:
+                        del self._pending[locator]
+            if len(self._heap) > 2 * len(self._pending) + 64:
+                # Drop stale heap entries.
+                self._heap = [(entry[0], entry[1], locator)
+                              for locator, entry in self._pending.items()]
+                heapq.heapify(self._heap)
+
+    def get(self):
+        """Return the next locator to fetch, waiting if necessary.
+
+        Returns None once the queue is closed.
+        """
+        with self._cond:
+            while not self._closed:
+                while self._heap:
+                    priority, seq, locator = heapq.heappop(self._heap)
+                    entry = self._pending.get(locator)
+                    if entry is None or entry[1] != seq:
+                        continue
+                    del self._pending[locator]
+                    for owner in entry[2]:
+                        locs = self._by_owner.get(owner)
+                        if locs is not None:
+                            locs.discard(locator)
+                            if not locs:
+                                del self._by_owner[owner]
+                    return locator
+                self._cond.wait()
+            return None
+
+    def close(self):
+        """Make get() return None in every waiting and future call."""
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+
+
 class _BlockManager(object):
     """BlockManager handles buffer blocks.
 
@@ -480,9 +897,17 @@ class _BlockManager(object):
 
     DEFAULT_PUT_THREADS = 2
     DEFAULT_GET_THREADS = 2
+    # Maximum number of blocks waiting to be prefetched.
+    MAX_PREFETCH_PENDING = 1024
 
-    def __init__(self, keep, copies=None, put_threads=None, num_retries=None, storage_classes_func=None):
-        """keep: KeepClient object to use"""
+    def __init__(self, keep, copies=None, put_threads=None, num_retries=None, storage_classes_func=None,
+                 get_threads=None, buffer_budget=None):
+        """keep: KeepClient object to use
+
+        buffer_budget: bytes of write buffers to allow before writers wait
+        for uploads.  The default allows a full block for each upload
+        thread, one queued for upload and one being written.
+        """
         self._keep = keep
         self._bufferblocks = collections.OrderedDict()
         self._put_queue = None
@@ -492,7 +917,9 @@ class _BlockManager(object):
         self.lock = threading.Lock()
         self.prefetch_enabled = True
         self.num_put_threads = put_threads or _BlockManager.DEFAULT_PUT_THREADS
-        self.num_get_threads = _BlockManager.DEFAULT_GET_THREADS
+        self.num_get_threads = get_threads or _BlockManager.DEFAULT_GET_THREADS
+        self.buffer_pool = _BufferPool(
+            buffer_budget or (self.num_put_threads + 2) * config.KEEP_BLOCK_SIZE)
         self.copies = copies
         self.storage_classes = storage_classes_func or (lambda: [])
         self._pending_write_size = 0
@@ -516,10 +943,11 @@ class _BlockManager(object):
         """
         return self._alloc_bufferblock(blockid, starting_capacity, owner)
 
-    def _alloc_bufferblock(self, blockid=None, starting_capacity=2**14, owner=None):
+    def _alloc_bufferblock(self, blockid=None, starting_capacity=2**14, owner=None, pooled=True):
         if blockid is None:
             blockid = str(uuid.uuid4())
-        bufferblock = _BufferBlock(blockid, starting_capacity=starting_capacity, owner=owner)
+        bufferblock = _BufferBlock(blockid, starting_capacity=starting_capacity, owner=owner,
+                                   pool=self.buffer_pool if pooled else None)
         self._bufferblocks[bufferblock.blockid] = bufferblock
         return bufferblock
 
@@ -543,6 +971,17 @@ class _BlockManager(object):
     def is_bufferblock(self, locator):
         return locator in self._bufferblocks
 
+    def _put_block(self, bufferblock):
+        # A block assembled from several buffers is uploaded as a list of
+        # them, so it never has to be joined into one.
+        data_hash = bufferblock.md5sum()
+        views = bufferblock._views(0, bufferblock.write_pointer)
+        data = views[0] if len(views) == 1 else views
+        if self.copies is None:
+            return self._keep.put(data, num_retries=self.num_retries, classes=self.storage_classes(), data_hash=data_hash)
+        else:
+            return self._keep.put(data, num_retries=self.num_retries, copies=self.copies, classes=self.storage_classes(), data_hash=data_hash)
+
     def _commit_bufferblock_worker(self):
         """Background uploader thread."""
 
@@ -552,10 +991,7 @@ class _BlockManager(object):
                 if bufferblock is None:
                     return
 
-                if self.copies is None:
-                    loc = self._keep.put(bufferblock.buffer_view[0:bufferblock.write_pointer].tobytes(), num_retries=self.num_retries, classes=self.storage_classes())
-                else:
-                    loc = self._keep.put(bufferblock.buffer_view[0:bufferblock.write_pointer].tobytes(), num_retries=self.num_retries, copies=self.copies, classes=self.storage_classes())
+                loc = self._put_block(bufferblock)
                 bufferblock.set_state(_BufferBlock.COMMITTED, loc)
             except Exception as e:
                 bufferblock.set_state(_BufferBlock.ERROR, e)
@@ -588,11 +1024,15 @@ class _BlockManager(object):
 
     def _block_prefetch_worker(self):
         """The background downloader thread."""
+        prefetch_queue = self._prefetch_queue
         while True:
             try:
-                b = self._prefetch_queue.get()
+                b = prefetch_queue.get()
                 if b is None:
                     return
+                if self._block_cached_or_loading(b):
+                    # A reader got to it first.
+                    continue
                 self._keep.get(b)
             except Exception:
                 _logger.exception("Exception doing block prefetch")
@@ -600,7 +1040,7 @@ class _BlockManager(object):
     @synchronized
     def start_get_threads(self):
         if self._prefetch_threads is None:
-            self._prefetch_queue = queue.Queue()
+            self._prefetch_queue = _PrefetchQueue(self.MAX_PREFETCH_PENDING)
             self._prefetch_threads = []
             for i in range(0, self.num_get_threads):
                 thread = threading.Thread(target=self._block_prefetch_worker)
@@ -622,8 +1062,7 @@ class _BlockManager(object):
         self._put_queue = None
 
         if self._prefetch_threads is not None:
-            for t in self._prefetch_threads:
-                self._prefetch_queue.put(None)
+            self._prefetch_queue.close()
             for t in self._prefetch_threads:
                 t.join()
         self._prefetch_threads = None
@@ -678,7 +1117,7 @@ class _BlockManager(object):
             bb = small_blocks.pop(0)
             new_bb.owner.append(bb.owner)
             self._pending_write_size -= bb.size()
-            new_bb.append(bb.buffer_view[0:bb.write_pointer].tobytes())
+            new_bb.append_block(bb)
             files.append((bb, new_bb.write_pointer - bb.size()))
 
         self.commit_bufferblock(new_bb, sync=sync)
@@ -723,10 +1162,7 @@ class _BlockManager(object):
 
         if sync:
             try:
-                if self.copies is None:
-                    loc = self._keep.put(block.buffer_view[0:block.write_pointer].tobytes(), num_retries=self.num_retries, classes=self.storage_classes())
-                else:
-                    loc = self._keep.put(block.buffer_view[0:block.write_pointer].tobytes(), num_retries=self.num_retries, copies=self.copies, classes=self.storage_classes())
+                loc = self._put_block(block)
                 block.set_state(_BufferBlock.COMMITTED, loc)
             except Exception as e:
                 block.set_state(_BufferBlock.ERROR, e)
@@ -750,7 +1186,9 @@ class _BlockManager(object):
         """
 
         if self.padding_block is None:
-            self.padding_block = self._alloc_bufferblock(starting_capacity=config.KEEP_BLOCK_SIZE)
+            # Recycled buffers aren't zeroed, so this one comes straight
+            # from the allocator.
+            self.padding_block = self._alloc_bufferblock(starting_capacity=config.KEEP_BLOCK_SIZE, pooled=False)
             self.padding_block.write_pointer = config.KEEP_BLOCK_SIZE
             self.commit_bufferblock(self.padding_block, False)
         return self.padding_block
@@ -768,20 +1206,23 @@ class _BlockManager(object):
         """Fetch a block.
 
         First checks to see if the locator is a BufferBlock and return that, if
-        not, passes the request through to KeepClient.get().
+        not, passes the request through to KeepClient.read_block().
 
         """
         with self.lock:
             if locator in self._bufferblocks:
                 bufferblock = self._bufferblocks[locator]
-                if bufferblock.state() != _BufferBlock.COMMITTED:
-                    return bufferblock.buffer_view[0:bufferblock.write_pointer].tobytes()
-                else:
-                    locator = bufferblock._locator
-        if cache_only:
-            return self._keep.get_from_cache(locator)
-        else:
-            return self._keep.get(locator, num_retries=num_retries)
+                # Hold the block's lock so its buffer can't be recycled
+                # while we copy it.
+                with bufferblock.lock:
+                    if bufferblock._state != _BufferBlock.COMMITTED:
+                        return bufferblock._contents()
+                    else:
+                        locator = bufferblock._locator
+        # readfrom() only copies out the part of the block it needs, so
+        # skip the copy get() makes when blocks are cached on disk.
+        return self._keep.read_block(locator, num_retries=num_retries,
+                                     cache_only=cache_only)
 
     def commit_all(self):
         """Commit all outstanding buffer blocks.
@@ -827,7 +1268,27 @@ class _BlockManager(object):
                         owner.flush(sync=True)
                     self.delete_bufferblock(k)
 
-    def block_prefetch(self, locator):
+    def max_readahead(self):
+        """Return the most a single reader should prefetch, in bytes.
+
+        Half the Keep block cache, so prefetched blocks don't evict the
+        ones being read.
+        """
+        cache_max = getattr(getattr(self._keep, 'block_cache', None), 'cache_max', None)
+        if not cache_max:
+            return None
+        return min(cache_max // 2, _ReadAhead.MAX_WINDOW)
+
+    def _block_cached_or_loading(self, locator):
+        block_cache = getattr(self._keep, 'block_cache', None)
+        if block_cache is not None:
+            # A slot exists once a download has started, so this also
+            # catches blocks that are still on their way.  peek() leaves
+            # the LRU order alone: asking isn't using the block.
+            return block_cache.peek(locator[0:32]) is not None
+        return self._keep.get_from_cache(locator) is not None
+
+    def block_prefetch(self, locator, priority=0, owner=None):
         """Initiate a background download of a block.
 
         This assumes that the underlying KeepClient implements a block cache,
@@ -835,20 +1296,35 @@ class _BlockManager(object):
         downloads (unless the block is evicted from the cache.)  This method
         does not block.
 
+        :priority:
+          Blocks with lower values are downloaded first.  Readers pass the
+          distance from their read position to the block.
+
+        :owner:
+          The reader making the request, for cancel_prefetch().
+
+        Returns True if the block was queued for download.
+
         """
 
         if not self.prefetch_enabled:
-            return
+            return False
 
-        if self._keep.get_from_cache(locator) is not None:
-            return
+        if self._block_cached_or_loading(locator):
+            return False
 
         with self.lock:
             if locator in self._bufferblocks:
-                return
+                return False
 
         self.start_get_threads()
-        self._prefetch_queue.put(locator)
+        return self._prefetch_queue.put(locator, priority, owner)
+
+    def cancel_prefetch(self, owner):
+        """Withdraw owner's prefetch requests that haven't started yet."""
+        prefetch_queue = self._prefetch_queue
+        if prefetch_queue is not None:
+            prefetch_queue.cancel(owner)
 
 
 class ArvadosFile(object):
@@ -863,7 +1339,8 @@ class ArvadosFile(object):
     """
 
     __slots__ = ('parent', 'name', '_writers', '_committed',
-                 '_segments', 'lock', '_current_bblock', 'fuse_entry')
+                 '_segments', 'lock', '_current_bblock', 'fuse_entry',
+                 '_readahead')
 
     def __init__(self, parent, name, stream=[], segments=[]):
         """
@@ -877,13 +1354,15 @@ class ArvadosFile(object):
         """
         self.parent = parent
         self.name = name
-        self._writers = set()
+        self._writers = None
         self._committed = False
-        self._segments = []
-        self.lock = parent.root_collection().lock
+        root = parent.root_collection()
+        self._segments = SegmentIndex(blocks=root._my_block_table())
+        self.lock = root.lock
         for s in segments:
             self._add_segment(stream, s.locator, s.range_size)
         self._current_bblock = None
+        self._readahead = None
 
     def writable(self):
         return self.parent.writable()
@@ -891,8 +1370,8 @@ class ArvadosFile(object):
     @synchronized
     def permission_expired(self, as_of_dt=None):
         """Returns True if any of the segment's locators is expired"""
-        for r in self._segments:
-            if KeepLocator(r.locator).permission_expired(as_of_dt):
+        for loc in self._segments.locators():
+            if KeepLocator(loc).permission_expired(as_of_dt):
                 return True
         return False
 
@@ -900,11 +1379,16 @@ class ArvadosFile(object):
     def has_remote_blocks(self):
         """Returns True if any of the segment's locators has a +R signature"""
 
-        for s in self._segments:
-            if '+R' in s.locator:
+        for loc in self._segments.locators():
+            if '+R' in loc:
                 return True
         return False
 
+    @synchronized
+    def _remote_locators(self):
+        """Get the set of remote (+R) block locators in this file."""
+        return set(loc for loc in self._segments.locators() if '+R' in loc)
+
     @synchronized
     def _copy_remote_blocks(self, remote_blocks={}):
         """Ask Keep to copy remote blocks and point to their local copies.
@@ -917,20 +1401,21 @@ class ArvadosFile(object):
             different subdirectories.
         """
 
-        for s in self._segments:
-            if '+R' in s.locator:
+        def local_locator(loc):
+            if '+R' in loc:
                 try:
-                    loc = remote_blocks[s.locator]
+                    return remote_blocks[loc]
                 except KeyError:
-                    loc = self.parent._my_keep().refresh_signature(s.locator)
-                    remote_blocks[s.locator] = loc
-                s.locator = loc
-                self.parent.set_committed(False)
+                    local = self.parent._my_keep().refresh_signature(loc)
+                    remote_blocks[loc] = local
+                    return local
+        if self._segments.remap_locators(local_locator):
+            self.parent.set_committed(False)
         return remote_blocks
 
     @synchronized
     def segments(self):
-        return copy.copy(self._segments)
+        return list(self._segments)
 
     @synchronized
     def clone(self, new_parent, new_name):
@@ -945,7 +1430,7 @@ class ArvadosFile(object):
         """Replace segments of this file with segments from another `ArvadosFile` object."""
 
         map_loc = {}
-        self._segments = []
+        self._segments = SegmentIndex(blocks=self.parent.root_collection()._my_block_table())
         for other_segment in other.segments():
             new_loc = other_segment.locator
             if other.parent._my_block_manager().is_bufferblock(other_segment.locator):
@@ -971,9 +1456,7 @@ class ArvadosFile(object):
         with self.lock:
             if len(self._segments) != len(othersegs):
                 return False
-            for i in range(0, len(othersegs)):
-                seg1 = self._segments[i]
-                seg2 = othersegs[i]
+            for seg1, seg2 in zip(self._segments, othersegs):
                 loc1 = seg1.locator
                 loc2 = seg2.locator
 
@@ -996,7 +1479,21 @@ class ArvadosFile(object):
 
     @synchronized
     def set_segments(self, segs):
-        self._segments = segs
+        self._segments = SegmentIndex(segs, blocks=self.parent.root_collection()._my_block_table())
+        self.parent._invalidate_manifest_cache()
+
+    @synchronized
+    def pack_block_segments(self, blockid):
+        """Renumber segments in `blockid` to be consecutive in file order.
+
+        Returns the (segment_offset, range_size) of those segments before
+        renumbering.  See _BufferBlock.repack_writes().
+        """
+        return self._segments.pack_block(blockid)
+
+    @synchronized
+    def _rebind_block_table(self, blocks):
+        self._segments.rebind(blocks)
 
     @synchronized
     def set_committed(self, value=True):
@@ -1006,6 +1503,11 @@ class ArvadosFile(object):
 
         If value is False, set committed to be False for this and all parents.
         """
+        if not value and self.parent is not None:
+            # Called whenever the segments change, so the parent's
+            # cached manifest text must go even if we were already
+            # uncommitted.
+            self.parent._invalidate_manifest_cache()
         if value == self._committed:
             return
         self._committed = value
@@ -1021,6 +1523,8 @@ class ArvadosFile(object):
     def add_writer(self, writer):
         """Add an ArvadosFileWriter reference to the list of writers"""
         if isinstance(writer, ArvadosFileWriter):
+            if self._writers is None:
+                self._writers = set()
             self._writers.add(writer)
 
     @synchronized
@@ -1043,7 +1547,7 @@ class ArvadosFile(object):
         Get whether this is closed or not. When the writers list is empty, the file
         is supposed to be closed.
         """
-        return len(self._writers) == 0
+        return not self._writers
 
     @must_be_writable
     @synchronized
@@ -1056,21 +1560,7 @@ class ArvadosFile(object):
 
         """
         if size < self.size():
-            new_segs = []
-            for r in self._segments:
-                range_end = r.range_start+r.range_size
-                if r.range_start >= size:
-                    # segment is past the trucate size, all done
-                    break
-                elif size < range_end:
-                    nr = Range(r.locator, r.range_start, size - r.range_start, 0)
-                    nr.segment_offset = r.segment_offset
-                    new_segs.append(nr)
-                    break
-                else:
-                    new_segs.append(r)
-
-            self._segments = new_segs
+            self._segments.truncate(size)
             self.set_committed(False)
         elif size > self.size():
             padding = self.parent._my_block_manager().get_padding_block()
@@ -1085,20 +1575,26 @@ class ArvadosFile(object):
             # size == self.size()
             pass
 
-    def readfrom(self, offset, size, num_retries, exact=False):
+    def readfrom(self, offset, size, num_retries, exact=False, readahead=None):
         """Read up to `size` bytes from the file starting at `offset`.
 
         :exact:
          If False (default), return less data than requested if the read
          crosses a block boundary and the next block isn't cached.  If True,
          only return less data than requested when hitting EOF.
+
+        :readahead:
+         The _ReadAhead tracking the caller's access pattern, which decides
+         how much to prefetch.  Defaults to one shared by all readers of
+         this file that don't supply their own.
         """
 
         with self.lock:
             if size == 0 or offset >= self.size():
                 return b''
             readsegs = locators_and_ranges(self._segments, offset, size)
-            prefetch = locators_and_ranges(self._segments, offset + size, config.KEEP_BLOCK_SIZE, limit=32)
+            if readahead is None:
+                readahead = self.readahead()
 
         locs = set()
         data = []
@@ -1111,15 +1607,36 @@ class ArvadosFile(object):
             else:
                 break
 
-        for lr in prefetch:
-            if lr.locator not in locs:
-                self.parent._my_block_manager().block_prefetch(lr.locator)
-                locs.add(lr.locator)
+        window = readahead.access(offset, size, locs)
+        if window:
+            with self.lock:
+                prefetch = locators_and_ranges(self._segments, offset + size, window, limit=32)
+            distance = 0
+            for lr in prefetch:
+                if lr.locator not in locs:
+                    locs.add(lr.locator)
+                    if (readahead.should_prefetch(lr.locator) and
+                        self.parent._my_block_manager().block_prefetch(
+                            lr.locator, priority=distance, owner=readahead)):
+                        readahead.add_prefetch(lr.locator)
+                distance += lr.segment_size
+        else:
+            # This reader has moved away from whatever it asked for before.
+            self.parent._my_block_manager().cancel_prefetch(readahead)
 
         return b''.join(data)
 
+    def readahead(self):
+        """Return the default _ReadAhead for this file, creating it if needed."""
+        if self._readahead is None:
+            self._readahead = self.new_readahead()
+        return self._readahead
+
+    def new_readahead(self):
+        """Return a new _ReadAhead sized for this file's block cache."""
+        return _ReadAhead(self.parent._my_block_manager().max_readahead())
+
     @must_be_writable
-    @synchronized
     def writeto(self, offset, data, num_retries):
         """Write `data` to the file starting at `offset`.
 
@@ -1127,6 +1644,14 @@ class ArvadosFile(object):
         necessary.
 
         """
+        # Wait for write buffer space before taking the collection lock,
+        # so other operations on the collection carry on meanwhile.
+        pool = self.parent._my_block_manager().buffer_pool
+        pool.wait_for_room(min(len(data), config.KEEP_BLOCK_SIZE))
+        return self._writeto(offset, data, num_retries)
+
+    @synchronized
+    def _writeto(self, offset, data, num_retries):
         if not isinstance(data, bytes) and not isinstance(data, memoryview):
             data = data.encode()
         if len(data) == 0:
@@ -1140,7 +1665,7 @@ class ArvadosFile(object):
             n = 0
             dataview = memoryview(data)
             while n < len(data):
-                self.writeto(offset+n, dataview[n:n + config.KEEP_BLOCK_SIZE].tobytes(), num_retries)
+                self._writeto(offset+n, dataview[n:n + config.KEEP_BLOCK_SIZE].tobytes(), num_retries)
                 n += config.KEEP_BLOCK_SIZE
             return
 
@@ -1183,13 +1708,15 @@ class ArvadosFile(object):
 
         if sync:
             to_delete = set()
-            for s in self._segments:
-                bb = self.parent._my_block_manager().get_bufferblock(s.locator)
+            def committed_locator(loc):
+                bb = self.parent._my_block_manager().get_bufferblock(loc)
                 if bb:
                     if bb.state() != _BufferBlock.COMMITTED:
                         self.parent._my_block_manager().commit_bufferblock(bb, sync=True)
-                    to_delete.add(s.locator)
-                    s.locator = bb.locator()
+                    to_delete.add(loc)
+                    return bb.locator()
+            if self._segments.remap_locators(committed_locator):
+                self.parent._invalidate_manifest_cache()
             for s in to_delete:
                 # Don't delete the bufferblock if it's owned by many files. It'll be
                 # deleted after all of its owners are flush()ed.
@@ -1213,18 +1740,19 @@ class ArvadosFile(object):
         """Internal implementation of add_segment."""
         self.set_committed(False)
         for lr in locators_and_ranges(blocks, pos, size):
-            last = self._segments[-1] if self._segments else Range(0, 0, 0, 0)
-            r = Range(lr.locator, last.range_start+last.range_size, lr.segment_size, lr.segment_offset)
-            self._segments.append(r)
+            self._segments.append(Range(lr.locator, self._segments.size(), lr.segment_size, lr.segment_offset))
+
+    def _append_stream_range(self, stream, pos, size):
+        """Add a segment from a BlockStream to the end of the file.
+
+        Used by Collection._import_manifest(), which holds the lock.
+        """
+        self._segments.append_stream_range(stream, pos, size)
 
     @synchronized
     def size(self):
         """Get the file size."""
-        if self._segments:
-            n = self._segments[-1]
-            return n.range_start + n.range_size
-        else:
-            return 0
+        return self._segments.size()
 
     @synchronized
     def manifest_text(self, stream_name=".", portable_locators=False,
@@ -1237,9 +1765,10 @@ class ArvadosFile(object):
                 if only_committed:
                     continue
                 loc = self.parent._my_block_manager().get_bufferblock(loc).locator()
+            locator = KeepLocator(loc)
             if portable_locators:
-                loc = KeepLocator(loc).stripped()
-            filestream.append(LocatorAndRange(loc, KeepLocator(loc).size,
+                loc = locator.stripped()
+            filestream.append(LocatorAndRange(loc, locator.size,
                                  segment.segment_offset, segment.range_size))
         buf += ' '.join(normalize_stream(stream_name, {self.name: filestream}))
         buf += "\n"
@@ -1253,7 +1782,11 @@ class ArvadosFile(object):
         self.parent.remove(self.name)
         self.parent = newparent
         self.name = newname
-        self.lock = self.parent.root_collection().lock
+        root = self.parent.root_collection()
+        self.lock = root.lock
+        # The file may have come from another collection; its segments
+        # must use the block table of the collection it is now in.
+        self._segments.rebind(root._my_block_table())
 
 
 class ArvadosFileReader(ArvadosFileReaderBase):
@@ -1267,6 +1800,22 @@ class ArvadosFileReader(ArvadosFileReaderBase):
     def __init__(self, arvadosfile, mode="r", num_retries=None):
         super(ArvadosFileReader, self).__init__(arvadosfile.name, mode=mode, num_retries=num_retries)
         self.arvadosfile = arvadosfile
+        self._readahead = None
+
+    def _my_readahead(self):
+        if self._readahead is None:
+            self._readahead = self.arvadosfile.new_readahead()
+        return self._readahead
+
+    def readahead_stats(self):
+        """Return read-ahead counters for this file handle.
+
+        The result has the current read-ahead `window` in bytes, the number
+        of blocks `prefetched`, how many of those were later read (`hits`)
+        or abandoned unread (`wasted`), how many are still `outstanding`,
+        and `hit_ratio` and `waste_ratio` as fractions of `prefetched`.
+        """
+        return self._my_readahead().stats()
 
     def size(self):
         return self.arvadosfile.size()
@@ -1289,14 +1838,17 @@ class ArvadosFileReader(ArvadosFileReaderBase):
         """
         if size is None:
             data = []
-            rd = self.arvadosfile.readfrom(self._filepos, config.KEEP_BLOCK_SIZE, num_retries)
+            rd = self.arvadosfile.readfrom(self._filepos, config.KEEP_BLOCK_SIZE, num_retries,
+                                           readahead=self._my_readahead())
             while rd:
                 data.append(rd)
                 self._filepos += len(rd)
-                rd = self.arvadosfile.readfrom(self._filepos, config.KEEP_BLOCK_SIZE, num_retries)
+                rd = self.arvadosfile.readfrom(self._filepos, config.KEEP_BLOCK_SIZE, num_retries,
+                                               readahead=self._my_readahead())
             return b''.join(data)
         else:
-            data = self.arvadosfile.readfrom(self._filepos, size, num_retries, exact=True)
+            data = self.arvadosfile.readfrom(self._filepos, size, num_retries, exact=True,
+                                             readahead=self._my_readahead())
             self._filepos += len(data)
             return data
 
@@ -1307,7 +1859,8 @@ class ArvadosFileReader(ArvadosFileReaderBase):
 
         This method does not change the file position.
         """
-        return self.arvadosfile.readfrom(offset, size, num_retries)
+        return self.arvadosfile.readfrom(offset, size, num_retries,
+                                         readahead=self._my_readahead())
 
     def flush(self):
         pass
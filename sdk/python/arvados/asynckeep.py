@@ -0,0 +1,678 @@
+# Copyright (C) The Arvados Authors. All rights reserved.
+#
+# SPDX-License-Identifier: Apache-2.0
+
+"""asyncio interface to Keep.
+
+AsyncKeepClient offers coroutine versions of KeepClient's get(), head()
+and put(), so a program can have thousands of block operations in flight
+from a single thread.  It wraps a KeepClient and shares its service
+discovery, rendezvous probe order, retry and storage class rules, timeouts,
+counters and block cache, so blocks fetched by either client are available
+to both.
+
+Requests are made with pycurl, configured the same way as KeepClient's,
+through a CurlMulti driven by the event loop.  This module requires
+Python 3.5 or later.
+"""
+
+import asyncio
+import collections
+import hashlib
+import io
+import logging
+import math
+import queue
+import time
+
+import pycurl
+
+import arvados
+import arvados.errors
+import arvados.util
+from . import retry
+from .keep import (KeepClient, KeepLocator, _as_bytes, _block_data, _BlockChunks,
+                   _BlockReceiver, _BlockSender, _put_response_copies)
+
+_logger = logging.getLogger('arvados.keep')
+
+class _AsyncRetryLoop(retry.RetryLoop):
+    """A RetryLoop that backs off with asyncio.sleep() instead of time.sleep().
+
+    Callers must `await loop.backoff()` at the start of each iteration.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super(_AsyncRetryLoop, self).__init__(*args, **kwargs)
+        self._wait_until = 0
+
+    def __next__(self):
+        # Take over the wait RetryLoop would sleep for.
+        self._wait_until, self.next_start_time = self.next_start_time, 0
+        return super(_AsyncRetryLoop, self).__next__()
+
+    async def backoff(self):
+        wait_time = self._wait_until - time.time()
+        if wait_time > 0:
+            await asyncio.sleep(wait_time)
+
+
+class _CurlMulti(object):
+    """Run pycurl requests on an asyncio event loop.
+
+    Drives a pycurl.CurlMulti from the loop's reader, writer and timer
+    callbacks (libcurl's multi_socket interface).  Requests are set up
+    exactly like KeepClient's, so proxy settings, TLS options, timeouts
+    and low-speed limits are all handled by libcurl, and connections are
+    kept alive and reused across requests.
+    """
+
+    def __init__(self, loop):
+        self.loop = loop
+        self._multi = pycurl.CurlMulti()
+        self._multi.setopt(pycurl.M_SOCKETFUNCTION, self._socket_callback)
+        self._multi.setopt(pycurl.M_TIMERFUNCTION, self._timer_callback)
+        self._timer = None
+        # curl => Future for requests libcurl is running.
+        self._requests = {}
+        self._closed = False
+
+    def close(self):
+        if self._closed:
+            return
+        self._closed = True
+        for curl, future in list(self._requests.items()):
+            self._multi.remove_handle(curl)
+            future.cancel()
+        self._requests.clear()
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        self._multi.close()
+
+    async def perform(self, curl):
+        """Run curl's request.  Raises pycurl.error if it fails."""
+        future = self.loop.create_future()
+        self._requests[curl] = future
+        self._multi.add_handle(curl)
+        try:
+            await future
+        finally:
+            if self._requests.pop(curl, None) is not None:
+                # Cancelled before libcurl finished.
+                self._multi.remove_handle(curl)
+
+    def _socket_callback(self, event, fd, multi, data):
+        if self._closed or self.loop.is_closed():
+            return
+        if event & pycurl.POLL_IN:
+            self.loop.add_reader(fd, self._socket_action, fd, pycurl.CSELECT_IN)
+        else:
+            self.loop.remove_reader(fd)
+        if event & pycurl.POLL_OUT:
+            self.loop.add_writer(fd, self._socket_action, fd, pycurl.CSELECT_OUT)
+        else:
+            self.loop.remove_writer(fd)
+
+    def _timer_callback(self, timeout_ms):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        if timeout_ms >= 0 and not self._closed:
+            self._timer = self.loop.call_later(
+                timeout_ms / 1000.0, self._on_timer)
+
+    def _on_timer(self):
+        self._timer = None
+        self._socket_action(pycurl.SOCKET_TIMEOUT, 0)
+
+    def _socket_action(self, fd, event):
+        if self._closed:
+            return
+        while True:
+            ret, _ = self._multi.socket_action(fd, event)
+            if ret != pycurl.E_CALL_MULTI_PERFORM:
+                break
+        while True:
+            queued, succeeded, failed = self._multi.info_read()
+            for curl in succeeded:
+                self._finish(curl, None)
+            for curl, errno, message in failed:
+                self._finish(curl, pycurl.error(errno, message))
+            if not queued:
+                break
+
+    def _finish(self, curl, error):
+        future = self._requests.pop(curl, None)
+        self._multi.remove_handle(curl)
+        if future is None or future.done():
+            return
+        if error is None:
+            future.set_result(None)
+        else:
+            future.set_exception(error)
+
+
+class AsyncKeepService(KeepClient.KeepService):
+    """Make requests to a single Keep service, and track results.
+
+    The asyncio counterpart of KeepClient.KeepService; like that class,
+    an instance is meant to last for one GET or PUT transaction.
+    """
+
+    def __init__(self, root, multi, **kwargs):
+        super(AsyncKeepService, self).__init__(root, **kwargs)
+        self._multi = multi
+
+    def _setcurlopts(self, curl, url, headers, response_body):
+        curl.setopt(pycurl.NOSIGNAL, 1)
+        # Connections belong to the multi handle and outlive this request,
+        # so let libcurl own the socket and set keepalive itself.
+        curl.setopt(pycurl.TCP_KEEPALIVE, 1)
+        curl.setopt(pycurl.TCP_KEEPIDLE, 75)
+        curl.setopt(pycurl.TCP_KEEPINTVL, 75)
+        super(AsyncKeepService, self)._setcurlopts(curl, url, headers, response_body)
+
+    async def _perform(self, curl, method, url, response_body):
+        ok = None
+        self._start_request()
+        t0 = time.time()
+        try:
+            try:
+                await self._multi.perform(curl)
+            except pycurl.error as e:
+                raise arvados.errors.HttpError(0, str(e))
+            self._result = {
+                'status_code': curl.getinfo(pycurl.RESPONSE_CODE),
+                'body': response_body.getvalue(),
+                'headers': self._headers,
+                'error': False,
+            }
+            ok = retry.check_http_response_success(self._result['status_code'])
+            if not ok:
+                self._result['error'] = arvados.errors.HttpError(
+                    self._result['status_code'],
+                    self._headers.get('x-status-line', 'Error'))
+        except self.HTTP_ERRORS as e:
+            self._result = {
+                'error': e,
+            }
+        except asyncio.CancelledError:
+            # Another service answered first; this one isn't to blame.
+            curl.close()
+            raise
+        self._usable = ok != False
+        self._record_health(t0)
+        if self._result.get('status_code', None):
+            # Client is functional. See comment in KeepService.get().
+            self._put_user_agent(curl)
+        else:
+            curl.close()
+        if not ok:
+            _logger.debug("Request fail: %s %s => %s: %s",
+                          method, url, type(self._result['error']), str(self._result['error']))
+        return ok
+
+    async def get(self, locator, method="GET", timeout=None):
+        # locator is a KeepLocator object.
+        url = self.root + str(locator)
+        _logger.debug("Request: %s %s", method, url)
+        self._headers = {}
+        response_body = _BlockReceiver(locator.size, self._headers)
+        curl = self._get_user_agent()
+        self._setcurlopts(curl, url, self.get_headers, response_body)
+        if method == "HEAD":
+            curl.setopt(pycurl.NOBODY, True)
+        self._setcurltimeouts(curl, timeout, method=="HEAD")
+        t0 = time.time()
+        if not (await self._perform(curl, method, url, response_body)):
+            return None
+        if method == "HEAD":
+            _logger.info("HEAD %s: %s bytes",
+                         self._result['status_code'],
+                         self._result['headers'].get('content-length'))
+            if self._result['headers'].get('x-keep-locator'):
+                # This is a response to a remote block copy request, return
+                # the local copy block locator.
+                return self._result['headers'].get('x-keep-locator')
+            return True
+
+        secs = time.time() - t0
+        _logger.info("GET %s: %s bytes in %s msec (%.3f MiB/sec)",
+                     self._result['status_code'],
+                     len(self._result['body']),
+                     secs * 1000,
+                     1.0*len(self._result['body'])/2**20/secs if secs > 0 else 0)
+
+        if self.download_counter:
+            self.download_counter.add(len(self._result['body']))
+        resp_md5 = response_body.hexdigest()
+        if resp_md5 != locator.md5sum:
+            _logger.warning("Checksum fail: md5(%s) = %s",
+                            url, resp_md5)
+            self._result['error'] = arvados.errors.HttpError(
+                0, 'Checksum fail')
+            return None
+        return self._result['body']
+
+    async def put(self, hash_s, body, timeout=None, headers={}):
+        put_headers = dict(self.put_headers)
+        put_headers.update(headers)
+        url = self.root + hash_s
+        _logger.debug("Request: PUT %s", url)
+        self._headers = {}
+        response_body = io.BytesIO()
+        curl = self._get_user_agent()
+        self._setcurlopts(curl, url, put_headers, response_body)
+        # Wait for "100 Continue" before sending the body, as
+        # KeepService.put() does.
+        curl.setopt(pycurl.UPLOAD, True)
+        curl.setopt(pycurl.INFILESIZE, len(body))
+        curl.setopt(pycurl.READFUNCTION, _BlockSender(body).read)
+        self._setcurltimeouts(curl, timeout)
+        t0 = time.time()
+        ok = await self._perform(curl, "PUT", url, response_body)
+        if self._result.get('status_code', None):
+            self._result['body'] = self._result['body'].decode('utf-8')
+        if not ok:
+            return False
+        secs = time.time() - t0
+        _logger.info("PUT %s: %s bytes in %s msec (%.3f MiB/sec)",
+                     self._result['status_code'],
+                     len(body),
+                     secs * 1000,
+                     1.0*len(body)/2**20/secs if secs > 0 else 0)
+        if self.upload_counter:
+            self.upload_counter.add(len(body))
+        return True
+
+
+class _AsyncWriterState(KeepClient.KeepWriterQueue):
+    """Copy and storage class accounting for one AsyncKeepClient.put() try.
+
+    Reuses KeepWriterQueue's bookkeeping; the blocking get_next_task() is
+    replaced by the scheduling loop in AsyncKeepClient._put_copies().
+    """
+
+    def wants_more(self):
+        return self.pending_copies() > 0 or len(self.pending_classes()) > 0
+
+
+class AsyncKeepClient(object):
+    """asyncio counterpart of KeepClient.
+
+    Usage:
+
+        keep = arvados.asynckeep.AsyncKeepClient(api_client=api)
+        blobs = await asyncio.gather(*[keep.get(loc) for loc in locators])
+
+    All methods are coroutines and must be awaited from the same event
+    loop.  Synchronous work (service discovery through the API server, and
+    local_store access) is done in the loop's default executor.
+    """
+
+    # Default maximum number of HTTP requests in flight at once.
+    DEFAULT_MAX_REQUESTS = 64
+
+    def __init__(self, keep_client=None, max_requests=None, **kwargs):
+        """Initialize a new AsyncKeepClient.
+
+        Arguments:
+        :keep_client:
+          The KeepClient whose configuration, service list and block cache
+          to use.  If not given, one is created by passing any other keyword
+          arguments to KeepClient().
+
+        :max_requests:
+          The maximum number of HTTP requests this client makes at once,
+          across all concurrent calls.  Default DEFAULT_MAX_REQUESTS.
+        """
+        if keep_client is None:
+            keep_client = KeepClient(**kwargs)
+        elif kwargs:
+            raise ValueError(
+                "can't build AsyncKeepClient with both keep_client and KeepClient arguments")
+        self.keep_client = keep_client
+        self.block_cache = keep_client.block_cache
+        self.max_requests = max_requests or self.DEFAULT_MAX_REQUESTS
+        self._multi = None
+        self._user_agent_pool = queue.LifoQueue()
+        self._request_slots = None
+        # md5sum => Future for blocks this client is already fetching.
+        self._inflight = {}
+
+    def close(self):
+        """Close idle connections."""
+        if self._multi is not None:
+            self._multi.close()
+            self._multi = None
+        while not self._user_agent_pool.empty():
+            self._user_agent_pool.get().close()
+
+    def _curl_multi(self):
+        loop = asyncio.get_event_loop()
+        if self._multi is None or self._multi.loop is not loop:
+            # Connections belong to the loop that opened them.
+            self.close()
+            self._multi = _CurlMulti(loop)
+        return self._multi
+
+    def _semaphore(self):
+        if self._request_slots is None:
+            self._request_slots = asyncio.Semaphore(self.max_requests)
+        return self._request_slots
+
+    async def _run_sync(self, func, *args):
+        return await asyncio.get_event_loop().run_in_executor(None, func, *args)
+
+    async def _map_new_services(self, roots_map, locator, force_rebuild, need_writable, headers):
+        kc = self.keep_client
+        if force_rebuild or not kc._keep_services:
+            # Fetching the service list from the API server blocks.
+            await self._run_sync(kc.build_services_list, force_rebuild)
+        headers.setdefault('Authorization', "OAuth2 %s" % (kc.api_token,))
+        local_roots = kc.weighted_service_roots(locator, False, need_writable)
+        for root in local_roots:
+            if root not in roots_map:
+                roots_map[root] = AsyncKeepService(
+                    root, self._curl_multi(),
+                    user_agent_pool=self._user_agent_pool,
+                    upload_counter=kc.upload_counter,
+                    download_counter=kc.download_counter,
+                    headers=headers,
+                    insecure=kc.insecure,
+                    health=kc._service_health)
+        return local_roots
+
+    async def _get_from_service(self, keep_service, locator, method, timeout):
+        kc = self.keep_client
+        t0 = time.time()
+        async with self._semaphore():
+            blob = await keep_service.get(locator, method=method, timeout=timeout)
+        if blob is not None and method == "GET" and kc.hedge_percentile is not None:
+            with kc.lock:
+                kc._get_latencies.append(time.time() - t0)
+        return blob
+
+    async def _hedged_get(self, services, locator, timeout, delay):
+        """Fetch a block from the first of `services` to deliver it.
+
+        Same policy as KeepClient._hedged_get(), except that requests still
+        in flight when one succeeds are cancelled.
+        """
+        pending = set()
+        remaining = iter(services)
+
+        def start_next():
+            ks = next(remaining, None)
+            if ks is not None:
+                pending.add(asyncio.ensure_future(
+                    self._get_from_service(ks, locator, "GET", timeout)))
+                return True
+            return False
+
+        more = start_next()
+        try:
+            while pending:
+                done, still_pending = await asyncio.wait(
+                    pending, timeout=(delay if more else None),
+                    return_when=asyncio.FIRST_COMPLETED)
+                pending.intersection_update(still_pending)
+                if not done:
+                    _logger.debug("Hedging GET %s after %.3f s", locator, delay)
+                    more = start_next()
+                    continue
+                for task in done:
+                    if task.result() is not None:
+                        return task.result()
+                more = start_next()
+            return None
+        finally:
+            for task in pending:
+                task.cancel()
+
+    async def get(self, loc_s, num_retries=None, request_id=None, headers=None):
+        """Get data from Keep.  See KeepClient.get()."""
+        return _as_bytes(await self._get_or_head(
+            loc_s, method="GET", num_retries=num_retries,
+            request_id=request_id, headers=headers))
+
+    async def head(self, loc_s, num_retries=None, request_id=None, headers=None):
+        """Check that a block is readable.  See KeepClient.head()."""
+        return await self._get_or_head(loc_s, method="HEAD", num_retries=num_retries,
+                                       request_id=request_id, headers=headers)
+
+    async def _get_or_head(self, loc_s, method="GET", num_retries=None, request_id=None, headers=None):
+        kc = self.keep_client
+        if num_retries is None:
+            num_retries = getattr(kc, 'num_retries', 0)
+        if getattr(kc, 'local_store', None):
+            getter = kc.local_store_get if method == "GET" else kc.local_store_head
+            return await self._run_sync(getter, loc_s, num_retries)
+        if ',' in loc_s:
+            blobs = await asyncio.gather(*[
+                self._get_or_head(x, method, num_retries, request_id, headers)
+                for x in loc_s.split(',')])
+            return b''.join(blobs) if method == "GET" else True
+
+        kc.get_counter.add(1)
+
+        slot = None
+        first = False
+        blob = None
+        fetch = None
+        try:
+            locator = KeepLocator(loc_s)
+            if method == "GET":
+                fetching = self._inflight.get(locator.md5sum)
+                if fetching is not None:
+                    kc.hits_counter.add(1)
+                    blob = await asyncio.shield(fetching)
+                    if blob is None:
+                        raise arvados.errors.KeepReadError(
+                            "failed to read {}".format(loc_s))
+                    return blob
+                fetch = asyncio.get_event_loop().create_future()
+                self._inflight[locator.md5sum] = fetch
+                # The block cache may be on disk, so keep its I/O (and
+                # waits for other threads filling the slot) off the loop.
+                slot, first = await self._run_sync(
+                    self.block_cache.reserve_cache, locator.md5sum)
+                if not first:
+                    kc.hits_counter.add(1)
+                    blob = await self._run_sync(slot.get)
+                    if blob is None:
+                        raise arvados.errors.KeepReadError(
+                            "failed to read {}".format(loc_s))
+                    return blob
+
+            kc.misses_counter.add(1)
+
+            if headers is None:
+                headers = {}
+            headers['X-Request-Id'] = (request_id or
+                                        (hasattr(kc, 'api_client') and kc.api_client.request_id) or
+                                        arvados.util.new_request_id())
+
+            sorted_roots = []
+            roots_map = {}
+            loop = _AsyncRetryLoop(num_retries, kc._check_loop_result,
+                                   backoff_start=2)
+            for tries_left in loop:
+                await loop.backoff()
+                try:
+                    sorted_roots = await self._map_new_services(
+                        roots_map, locator,
+                        force_rebuild=(tries_left < num_retries),
+                        need_writable=False,
+                        headers=headers)
+                except Exception as error:
+                    loop.save_result(error)
+                    continue
+
+                services_to_try = [roots_map[root]
+                                   for root in sorted_roots
+                                   if roots_map[root].usable()]
+                timeout = kc.current_timeout(num_retries-tries_left)
+                hedge_delay = kc.current_hedge_delay() if method == "GET" else None
+                if hedge_delay is not None and len(services_to_try) > 1:
+                    blob = await self._hedged_get(services_to_try, locator, timeout, hedge_delay)
+                else:
+                    for keep_service in services_to_try:
+                        blob = await self._get_from_service(keep_service, locator, method, timeout)
+                        if blob is not None:
+                            break
+                loop.save_result((blob, len(services_to_try)))
+
+            if loop.success():
+                return blob
+        finally:
+            if fetch is not None:
+                del self._inflight[locator.md5sum]
+                fetch.set_result(blob)
+            if first:
+                await self._run_sync(self.block_cache.set, slot, blob)
+
+        raise kc._read_error(loc_s, loop, roots_map, sorted_roots)
+
+    async def put(self, data, copies=2, num_retries=None, request_id=None, classes=[], data_hash=None):
+        """Save data in Keep.  See KeepClient.put()."""
+        kc = self.keep_client
+        if num_retries is None:
+            num_retries = getattr(kc, 'num_retries', 0)
+        data = _block_data(data)
+        if getattr(kc, 'local_store', None):
+            return await self._run_sync(kc.local_store_put, data, copies, num_retries, classes, data_hash)
+
+        kc.put_counter.add(1)
+
+        if data_hash is None:
+            if isinstance(data, _BlockChunks):
+                data_hash = data.md5().hexdigest()
+            else:
+                data_hash = hashlib.md5(data).hexdigest()
+        loc_s = data_hash + '+' + str(len(data))
+        if copies < 1:
+            return loc_s
+        locator = KeepLocator(loc_s)
+
+        headers = {
+            'X-Request-Id': (request_id or
+                             (hasattr(kc, 'api_client') and kc.api_client.request_id) or
+                             arvados.util.new_request_id()),
+            'X-Keep-Desired-Replicas': str(copies),
+        }
+        roots_map = {}
+        sorted_roots = []
+        loop = _AsyncRetryLoop(num_retries, kc._check_loop_result,
+                               backoff_start=2)
+        done_copies = 0
+        done_classes = []
+        state = None
+        for tries_left in loop:
+            await loop.backoff()
+            try:
+                sorted_roots = await self._map_new_services(
+                    roots_map, locator,
+                    force_rebuild=(tries_left < num_retries),
+                    need_writable=True,
+                    headers=headers)
+            except Exception as error:
+                loop.save_result(error)
+                continue
+
+            pending_classes = []
+            if done_classes is not None:
+                pending_classes = list(set(classes) - set(done_classes))
+            state = _AsyncWriterState(copies - done_copies, pending_classes)
+            tasks_nr = await self._put_copies(
+                state, [(roots_map[root], root) for root in sorted_roots],
+                data, data_hash,
+                timeout=kc.current_timeout(num_retries - tries_left))
+            pool_classes = state.satisfied_classes()
+            done_copies += state.successful_copies
+            if (done_classes is not None) and (pool_classes is not None):
+                done_classes += pool_classes
+                loop.save_result(
+                    (done_copies >= copies and set(done_classes) == set(classes),
+                     tasks_nr))
+            else:
+                # Old keepstore contacted without storage classes support:
+                # success is determined only by successful copies.
+                if not kc._storage_classes_unsupported_warning:
+                    kc._storage_classes_unsupported_warning = True
+                    _logger.warning("X-Keep-Storage-Classes header not supported by the cluster")
+                done_classes = None
+                loop.save_result((done_copies >= copies, tasks_nr))
+
+        if loop.success():
+            return state.response
+        if not roots_map:
+            raise arvados.errors.KeepWriteError(
+                "failed to write {}: no Keep services available ({})".format(
+                    data_hash, loop.last_result()))
+        else:
+            service_errors = ((key, roots_map[key].last_result()['error'])
+                              for key in sorted_roots
+                              if roots_map[key].last_result()['error'])
+            raise arvados.errors.KeepWriteError(
+                "failed to write {} after {} (wanted {} copies but wrote {})".format(
+                    data_hash, loop.attempts_str(), (copies, classes),
+                    (state.successful_copies, state.satisfied_classes()) if state else (0, [])),
+                service_errors, label="service")
+
+    async def _put_copies(self, state, services, data, data_hash, timeout):
+        """Write to services, in order, until state is satisfied.
+
+        Runs as many writes at once as KeepWriterThreadPool would use
+        threads.  Returns the number of services that were available.
+        """
+        max_replicas = self.keep_client.max_replicas_per_service
+        if (not max_replicas) or (max_replicas >= state.wanted_copies):
+            concurrency = 1
+        else:
+            concurrency = int(math.ceil(1.0*state.wanted_copies/max_replicas))
+
+        todo = collections.deque(
+            (ks, root) for ks, root in services if not ks.finished())
+        tasks_nr = len(todo)
+        running = set()
+        try:
+            while state.wants_more():
+                while (todo and state.pending_tries > 0 and
+                       len(running) < concurrency):
+                    ks, root = todo.popleft()
+                    if ks.finished():
+                        continue
+                    state.pending_tries -= 1
+                    running.add(asyncio.ensure_future(
+                        self._write_one(state, ks, root, data, data_hash, timeout)))
+                if not running:
+                    break
+                done, running = await asyncio.wait(
+                    running, return_when=asyncio.FIRST_COMPLETED)
+        finally:
+            for task in running:
+                task.cancel()
+        return tasks_nr
+
+    async def _write_one(self, state, service, service_root, data, data_hash, timeout):
+        classes = state.pending_classes()
+        headers = {}
+        if len(classes) > 0:
+            classes.sort()
+            headers['X-Keep-Storage-Classes'] = ', '.join(classes)
+        async with self._semaphore():
+            success = await service.put(data_hash, data, timeout=timeout,
+                                        headers=headers)
+        result = service.last_result()
+        if not success:
+            if result.get('status_code', None):
+                _logger.debug("Request fail: PUT %s => %s %s",
+                              data_hash, result['status_code'], result['body'])
+            state.write_fail(service)
+            return
+        _logger.debug("AsyncKeepClient succeeded %s+%i %s",
+                      data_hash, len(data), service_root)
+        replicas_stored, classes_confirmed = _put_response_copies(result['headers'])
+        state.write_success(result['body'].strip(), replicas_stored, classes_confirmed)
@@ -27,7 +27,7 @@ from .arvfile import split, _FileLikeObjectBase, ArvadosFile, ArvadosFileWriter,
 from .keep import KeepLocator, KeepClient
 from .stream import StreamReader
 from ._normalize_stream import normalize_stream, escape
-from ._ranges import Range, LocatorAndRange
+from ._ranges import Range, LocatorAndRange, BlockStream, BlockTable
 from .safeapi import ThreadSafeApiCache
 import arvados.config as config
 import arvados.errors as errors
@@ -52,6 +52,25 @@ else:
             return super(TextIOWrapper, self).write(data)
 
 
+def _manifest_block_tokens(line):
+    """Get the positions of the block locators in a manifest line."""
+    tokens = line.split(" ")
+    end = 1
+    while end < len(tokens) and ":" not in tokens[end]:
+        end += 1
+    return tokens, range(1, end)
+
+def _resign_manifest_text(manifest_text, resign):
+    """Replace each block locator `loc` in a manifest with `resign(loc)`, unless that is None."""
+    lines = []
+    for line in manifest_text.split("\n"):
+        tokens, blocks = _manifest_block_tokens(line)
+        for i in blocks:
+            tokens[i] = resign(tokens[i]) or tokens[i]
+        lines.append(" ".join(tokens))
+    return "\n".join(lines)
+
+
 class CollectionBase(object):
     """Abstract base class for Collection classes."""
 
@@ -539,7 +558,34 @@ class RichCollectionBase(CollectionBase):
         self._committed = False
         self._has_remote_blocks = False
         self._callback = None
-        self._items = {}
+        self._unloaded_streams = None
+        self._loaded_items = {}
+        self._manifest_cache = None
+
+    @property
+    def _items(self):
+        # With Collection(lazy=True), the manifest lines of a subdirectory
+        # are only parsed when its contents are first needed.
+        if self._unloaded_streams is not None:
+            self._load_streams()
+        return self._loaded_items
+
+    def _load_streams(self):
+        with self.lock:
+            lines = self._unloaded_streams
+            if lines is None:
+                return
+            existing = set(self._loaded_items)
+            try:
+                self.root_collection()._import_stream_lines(self, lines)
+            except:
+                for name in set(self._loaded_items) - existing:
+                    del self._loaded_items[name]
+                raise
+            for name, item in listitems(self._loaded_items):
+                if name not in existing:
+                    item.set_committed(True)
+            self._unloaded_streams = None
 
     def _my_api(self):
         raise NotImplementedError()
@@ -550,6 +596,9 @@ class RichCollectionBase(CollectionBase):
     def _my_block_manager(self):
         raise NotImplementedError()
 
+    def _my_block_table(self):
+        raise NotImplementedError()
+
     def writable(self):
         raise NotImplementedError()
 
@@ -741,10 +790,14 @@ class RichCollectionBase(CollectionBase):
 
         If value is False, set committed to be False for this and all parents.
         """
+        if not value:
+            self._invalidate_manifest_cache()
         if value == self._committed:
             return
         if value:
-            for k,v in listitems(self._items):
+            # Files that haven't been loaded yet are committed when
+            # they are loaded.
+            for k,v in listitems(self._loaded_items):
                 v.set_committed(True)
             self._committed = True
         else:
@@ -833,6 +886,11 @@ class RichCollectionBase(CollectionBase):
         for k,v in listitems(source):
             self._items[k] = v.clone(self, k)
 
+    @synchronized
+    def _rebind_block_table(self, blocks):
+        for item in listvalues(self._loaded_items):
+            item._rebind_block_table(blocks)
+
     def clone(self):
         raise NotImplementedError()
 
@@ -1038,37 +1096,97 @@ class RichCollectionBase(CollectionBase):
         """
 
         if not self.committed() or self._manifest_text is None or normalize:
-            stream = {}
-            buf = []
-            sorted_keys = sorted(self.keys())
-            for filename in [s for s in sorted_keys if isinstance(self[s], ArvadosFile)]:
-                # Create a stream per file `k`
-                arvfile = self[filename]
-                filestream = []
-                for segment in arvfile.segments():
-                    loc = segment.locator
-                    if arvfile.parent._my_block_manager().is_bufferblock(loc):
-                        if only_committed:
-                            continue
-                        loc = arvfile.parent._my_block_manager().get_bufferblock(loc).locator()
-                    if strip:
-                        loc = KeepLocator(loc).stripped()
-                    filestream.append(LocatorAndRange(loc, KeepLocator(loc).size,
-                                         segment.segment_offset, segment.range_size))
-                stream[filename] = filestream
-            if stream:
-                buf.append(" ".join(normalize_stream(stream_name, stream)) + "\n")
-            for dirname in [s for s in sorted_keys if isinstance(self[s], RichCollectionBase)]:
-                buf.append(self[dirname].manifest_text(
-                    stream_name=os.path.join(stream_name, dirname),
-                    strip=strip, normalize=True, only_committed=only_committed))
-            return "".join(buf)
+            return "".join(self._stream_lines(stream_name, strip, only_committed, {})[0])
         else:
             if strip:
                 return self.stripped_manifest()
             else:
                 return self._manifest_text
 
+    def _stream_lines(self, stream_name, strip, only_committed, locators):
+        """Get the normalized manifest of this collection as a list of stream lines.
+
+        Returns a tuple of the list and whether it could be cached.  Lines
+        are cached per collection until something in it changes (see
+        `_invalidate_manifest_cache`), so after a small change only the
+        collections on the path to it are rendered again.  Lines for files
+        with uncommitted blocks are never cached, because those blocks get
+        new locators when they are committed.
+
+        :locators:
+          Dict shared by the whole call, used to parse each distinct
+          locator only once.
+
+        """
+        key = (stream_name, strip)
+        if self._manifest_cache is not None and key in self._manifest_cache:
+            return self._manifest_cache[key], True
+
+        cacheable = True
+        lines = []
+        stream = {}
+        block_manager = None
+        sorted_keys = sorted(self.keys())
+        for filename in [s for s in sorted_keys if isinstance(self[s], ArvadosFile)]:
+            # Create a stream per file `k`
+            arvfile = self[filename]
+            filestream = []
+            for segment in arvfile.segments():
+                loc = segment.locator
+                if block_manager is None:
+                    block_manager = self._my_block_manager()
+                if block_manager.is_bufferblock(loc):
+                    cacheable = False
+                    if only_committed:
+                        continue
+                    loc = block_manager.get_bufferblock(loc).locator()
+                try:
+                    loc, size = locators[loc]
+                except KeyError:
+                    locator = KeepLocator(loc)
+                    locators[loc] = (locator.stripped() if strip else loc, locator.size)
+                    loc, size = locators[loc]
+                filestream.append(LocatorAndRange(loc, size,
+                                     segment.segment_offset, segment.range_size))
+            stream[filename] = filestream
+        if stream:
+            lines.append(" ".join(normalize_stream(stream_name, stream)) + "\n")
+        for dirname in [s for s in sorted_keys if isinstance(self[s], RichCollectionBase)]:
+            sublines, subcacheable = self[dirname]._stream_lines(
+                os.path.join(stream_name, dirname), strip, only_committed, locators)
+            lines.extend(sublines)
+            cacheable = cacheable and subcacheable
+
+        if cacheable:
+            if self._manifest_cache is None:
+                self._manifest_cache = {}
+            self._manifest_cache[key] = lines
+        return lines, cacheable
+
+    def _invalidate_manifest_cache(self):
+        """Drop cached manifest lines after this collection has changed."""
+        self._manifest_cache = None
+
+    def _resign(self, resign):
+        """Update manifest text that isn't in the block table after `BlockTable.remap`.
+
+        Stream lines that have not been loaded get the new locators, and
+        cached lines that include signatures are dropped.
+        """
+        if self._unloaded_streams is not None:
+            self._unloaded_streams = [_resign_manifest_text(line, resign)
+                                      for line in self._unloaded_streams]
+        if self._manifest_cache is not None:
+            for key in list(self._manifest_cache):
+                stream_name, strip = key
+                if not strip:
+                    del self._manifest_cache[key]
+            if not self._manifest_cache:
+                self._manifest_cache = None
+        for item in listvalues(self._loaded_items):
+            if isinstance(item, RichCollectionBase):
+                item._resign(resign)
+
     @synchronized
     def _copy_remote_blocks(self, remote_blocks={}):
         """Scan through the entire collection and ask Keep to copy remote blocks.
@@ -1077,39 +1195,77 @@ class RichCollectionBase(CollectionBase):
         (+R instead of +A). Collect these signatures and request Keep to copy the
         blocks to the local cluster, returning local (+A) signatures.
 
+        The blocks are requested concurrently, and each distinct block only
+        once (see `KeepClient.refresh_signatures`).
+
         :remote_blocks:
           Shared cache of remote to local block mappings. This is used to avoid
           doing extra work when blocks are shared by more than one file in
           different subdirectories.
 
         """
-        for item in self:
-            remote_blocks = self[item]._copy_remote_blocks(remote_blocks)
+        remote_blocks = dict(remote_blocks)
+        wanted = self._remote_locators() - set(remote_blocks)
+        if wanted:
+            remote_blocks.update(self._my_keep().refresh_signatures(wanted))
+        self._replace_remote_blocks(remote_blocks)
         return remote_blocks
 
+    def _remote_locators(self):
+        """Get the set of remote block locators used in this collection."""
+        locators = set()
+        for item in listvalues(self._items):
+            locators.update(item._remote_locators())
+        return locators
+
+    def _replace_remote_blocks(self, remote_blocks):
+        for item in listvalues(self._items):
+            if isinstance(item, RichCollectionBase):
+                item._replace_remote_blocks(remote_blocks)
+            else:
+                item._copy_remote_blocks(remote_blocks)
+
     @synchronized
     def diff(self, end_collection, prefix=".", holding_collection=None):
         """Generate list of add/modify/delete actions.
 
         When given to `apply`, will change `self` to match `end_collection`
 
+        Added, deleted and modified items are copied into
+        `holding_collection`.  Items that only differ in their permission
+        signatures ("tok" changes) refer to the items in `self` and
+        `end_collection` directly, so those must not be modified before the
+        changes are applied.
+
+        Subcollections of lazily loaded collections (see the `lazy` option
+        of `Collection`) whose manifest lines are identical are compared
+        without loading them.
+
         """
         changes = []
         if holding_collection is None:
             holding_collection = Collection(api_client=self._my_api(), keep_client=self._my_keep())
-        for k in self:
-            if k not in end_collection:
-               changes.append((DEL, os.path.join(prefix, k), self[k].clone(holding_collection, "")))
-        for k in end_collection:
-            if k in self:
-                if isinstance(end_collection[k], Subcollection) and isinstance(self[k], Subcollection):
-                    changes.extend(self[k].diff(end_collection[k], os.path.join(prefix, k), holding_collection))
-                elif end_collection[k] != self[k]:
-                    changes.append((MOD, os.path.join(prefix, k), self[k].clone(holding_collection, ""), end_collection[k].clone(holding_collection, "")))
+        if (self._unloaded_streams is not None and
+            self._unloaded_streams == end_collection._unloaded_streams):
+            # Same files on both sides, only subcollections can differ.
+            items = self._loaded_items
+            end_items = end_collection._loaded_items
+        else:
+            items = self._items
+            end_items = end_collection._items
+        for k in items:
+            if k not in end_items:
+               changes.append((DEL, os.path.join(prefix, k), items[k].clone(holding_collection, "")))
+        for k in end_items:
+            if k in items:
+                if isinstance(end_items[k], Subcollection) and isinstance(items[k], Subcollection):
+                    changes.extend(items[k].diff(end_items[k], os.path.join(prefix, k), holding_collection))
+                elif end_items[k] != items[k]:
+                    changes.append((MOD, os.path.join(prefix, k), items[k].clone(holding_collection, ""), end_items[k].clone(holding_collection, "")))
                 else:
-                    changes.append((TOK, os.path.join(prefix, k), self[k].clone(holding_collection, ""), end_collection[k].clone(holding_collection, "")))
+                    changes.append((TOK, os.path.join(prefix, k), items[k], end_items[k]))
             else:
-                changes.append((ADD, os.path.join(prefix, k), end_collection[k].clone(holding_collection, "")))
+                changes.append((ADD, os.path.join(prefix, k), end_items[k].clone(holding_collection, "")))
         return changes
 
     @must_be_writable
@@ -1140,6 +1296,11 @@ class RichCollectionBase(CollectionBase):
                     self.copy(initial, conflictpath)
             elif event_type == MOD or event_type == TOK:
                 final = change[3]
+                if (event_type == TOK and
+                    isinstance(local, ArvadosFile) and isinstance(final, ArvadosFile) and
+                    local.segments() == final.segments()):
+                    # Local already has the same signatures.
+                    continue
                 if local == initial:
                     # Local matches the "initial" item so it has not
                     # changed locally and is safe to update.
@@ -1262,7 +1423,9 @@ class Collection(RichCollectionBase):
                  block_manager=None,
                  replication_desired=None,
                  storage_classes_desired=None,
-                 put_threads=None):
+                 put_threads=None,
+                 get_threads=None,
+                 lazy=False):
         """Collection constructor.
 
         :manifest_locator_or_text:
@@ -1299,6 +1462,20 @@ class Collection(RichCollectionBase):
           the keepstores are expected to store the data into their default
           storage class.
 
+        :put_threads:
+          Number of threads uploading blocks.  If not specified, use the
+          block manager's default.
+
+        :get_threads:
+          Number of threads prefetching blocks ahead of readers.  If not
+          specified, use the block manager's default.
+
+        :lazy:
+          If True, don't create the files of a subdirectory until it is
+          first accessed.  Loading is faster when only part of a large
+          collection is used, but errors in a subdirectory's part of the
+          manifest are only reported when it is loaded.
+
         """
 
         if storage_classes_desired and type(storage_classes_desired) is not list:
@@ -1308,9 +1485,13 @@ class Collection(RichCollectionBase):
         self._api_client = api_client
         self._keep_client = keep_client
         self._block_manager = block_manager
+        self._block_table = BlockTable()
+        self._block_table_rebuilt_size = None
         self.replication_desired = replication_desired
         self._storage_classes_desired = storage_classes_desired
         self.put_threads = put_threads
+        self.get_threads = get_threads
+        self._lazy = lazy
 
         if apiconfig:
             self._config = apiconfig
@@ -1396,11 +1577,71 @@ class Collection(RichCollectionBase):
                 return
             else:
                 self._past_versions.add((response.get("modified_at"), response.get("portable_data_hash")))
-            other = CollectionReader(response["manifest_text"])
-        baseline = CollectionReader(self._manifest_text)
+            if response.get("portable_data_hash") == self.portable_data_hash():
+                # Same content, so only the signatures can have changed.
+                self._refresh_signatures(response["manifest_text"])
+                self._manifest_text = response["manifest_text"]
+                return
+            other = CollectionReader(response["manifest_text"],
+                                     api_client=self._my_api(),
+                                     keep_client=self._my_keep(),
+                                     lazy=True)
+        # Loading both sides lazily lets diff() skip the subcollections
+        # that did not change without parsing them.
+        baseline = CollectionReader(self._manifest_text,
+                                    api_client=self._my_api(),
+                                    keep_client=self._my_keep(),
+                                    lazy=True)
+        if self._block_table_rebuilt_size is None:
+            self._block_table_rebuilt_size = len(self._block_table)
         self.apply(baseline.diff(other))
+        # Merging brings in newly signed locators.  Once the block table
+        # has doubled, move the files to a fresh one so the locators no
+        # longer used are dropped.
+        if len(self._block_table) > 2 * self._block_table_rebuilt_size:
+            blocks = BlockTable()
+            self._rebind_block_table(blocks)
+            self._block_table = blocks
+            self._block_table_rebuilt_size = len(blocks)
         self._manifest_text = self.manifest_text()
 
+    @synchronized
+    @retry_method
+    def refresh_signatures(self, num_retries=None):
+        """Get new permission signatures for the blocks of this collection.
+
+        Fetches the collection record from the API server and gives each
+        block that it shares with this collection the newly signed locator.
+        Files, segments and caches are kept as they are, which makes this
+        much cheaper than `update()` or loading the collection again when
+        only the signatures have expired.  Blocks that are not in the
+        fetched manifest keep their signatures.
+
+        """
+        if self._manifest_locator is None:
+            raise errors.ArgumentError("`refresh_signatures` needs a collection with a manifest_locator")
+        response = self._my_api().collections().get(uuid=self._manifest_locator).execute(num_retries=num_retries)
+        self._refresh_signatures(response["manifest_text"])
+
+    def _refresh_signatures(self, manifest_text):
+        signed = {}
+        for line in manifest_text.split("\n"):
+            tokens, blocks = _manifest_block_tokens(line)
+            for i in blocks:
+                signed[self._stripped_locator(tokens[i])] = tokens[i]
+
+        def resign(loc):
+            return signed.get(self._stripped_locator(loc))
+
+        self._block_table.remap(resign)
+        self._resign(resign)
+        if self._manifest_text is not None:
+            self._manifest_text = _resign_manifest_text(self._manifest_text, resign)
+
+    @staticmethod
+    def _stripped_locator(loc):
+        return "+".join(loc.split("+", 2)[:2])
+
     @synchronized
     def _my_api(self):
         if self._api_client is None:
@@ -1424,9 +1665,12 @@ class Collection(RichCollectionBase):
             copies = (self.replication_desired or
                       self._my_api()._rootDesc.get('defaultCollectionReplication',
                                                    2))
-            self._block_manager = _BlockManager(self._my_keep(), copies=copies, put_threads=self.put_threads, num_retries=self.num_retries, storage_classes_func=self.storage_classes_desired)
+            self._block_manager = _BlockManager(self._my_keep(), copies=copies, put_threads=self.put_threads, num_retries=self.num_retries, storage_classes_func=self.storage_classes_desired, get_threads=self.get_threads)
         return self._block_manager
 
+    def _my_block_table(self):
+        return self._block_table
+
     def _remember_api_response(self, response):
         self._api_response = response
         self._past_versions.add((response.get("modified_at"), response.get("portable_data_hash")))
@@ -1730,12 +1974,14 @@ class Collection(RichCollectionBase):
 
         return text
 
-    _token_re = re.compile(r'(\S+)(\s+|$)')
     _block_re = re.compile(r'[0-9a-f]{32}\+(\d+)(\+\S+)*')
     _segment_re = re.compile(r'(\d+):(\d+):(\S+)')
+    _escape_re = re.compile(r'\\([0-3][0-7][0-7])')
 
     def _unescape_manifest_path(self, path):
-        return re.sub('\\\\([0-3][0-7][0-7])', lambda m: chr(int(m.group(1), 8)), path)
+        if '\\' not in path:
+            return path
+        return self._escape_re.sub(lambda m: chr(int(m.group(1), 8)), path)
 
     @synchronized
     def _import_manifest(self, manifest_text):
@@ -1748,62 +1994,100 @@ class Collection(RichCollectionBase):
         if len(self) > 0:
             raise ArgumentError("Can only import manifest into an empty collection")
 
-        STREAM_NAME = 0
-        BLOCKS = 1
-        SEGMENTS = 2
-
-        stream_name = None
-        state = STREAM_NAME
-
-        for token_and_separator in self._token_re.finditer(manifest_text):
-            tok = token_and_separator.group(1)
-            sep = token_and_separator.group(2)
-
-            if state == STREAM_NAME:
-                # starting a new stream
-                stream_name = self._unescape_manifest_path(tok)
-                blocks = []
-                segments = []
-                streamoffset = 0
-                state = BLOCKS
-                self.find_or_create(stream_name, COLLECTION)
+        lines = manifest_text.split("\n")
+        if self._lazy and self._can_load_lazily(lines):
+            for line in lines:
+                tokens = line.split(None, 1)
+                if not tokens:
+                    continue
+                stream_name = self._unescape_manifest_path(tokens[0])
+                if stream_name == ".":
+                    self._import_stream(self, stream_name, line.split())
+                    continue
+                stream = self
+                for name in stream_name.split("/")[1:]:
+                    item = stream._loaded_items.get(name)
+                    if item is None:
+                        item = Subcollection(stream, name)
+                        stream._loaded_items[name] = item
+                    elif not isinstance(item, RichCollectionBase):
+                        raise IOError(errno.ENOTDIR, "Not a directory", stream_name)
+                    stream = item
+                if stream._unloaded_streams is None:
+                    stream._unloaded_streams = []
+                stream._unloaded_streams.append(line)
+        else:
+            for line in lines:
+                tokens = line.split()
+                if tokens:
+                    stream_name = self._unescape_manifest_path(tokens[0])
+                    stream = self.find_or_create(stream_name, COLLECTION)
+                    self._import_stream(stream, stream_name, tokens)
+
+        self.set_committed(True)
+
+    def _can_load_lazily(self, lines):
+        """Return True if each stream line only adds files to its own directory."""
+        for line in lines:
+            tokens = line.split(None, 1)
+            if len(tokens) < 2:
                 continue
+            stream_name, rest = tokens
+            if '/' in rest or '\\057' in rest or '\\057' in stream_name:
+                return False
+            if stream_name != '.' and not (stream_name.startswith('./') and
+                                           '' not in stream_name.split('/')):
+                return False
+        return True
 
-            if state == BLOCKS:
-                block_locator = self._block_re.match(tok)
-                if block_locator:
-                    blocksize = int(block_locator.group(1))
-                    blocks.append(Range(tok, streamoffset, blocksize, 0))
-                    streamoffset += blocksize
-                else:
-                    state = SEGMENTS
-
-            if state == SEGMENTS:
-                file_segment = self._segment_re.match(tok)
-                if file_segment:
-                    pos = int(file_segment.group(1))
-                    size = int(file_segment.group(2))
-                    name = self._unescape_manifest_path(file_segment.group(3))
-                    if name.split('/')[-1] == '.':
-                        # placeholder for persisting an empty directory, not a real file
-                        if len(name) > 2:
-                            self.find_or_create(os.path.join(stream_name, name[:-2]), COLLECTION)
-                    else:
-                        filepath = os.path.join(stream_name, name)
-                        afile = self.find_or_create(filepath, FILE)
-                        if isinstance(afile, ArvadosFile):
-                            afile.add_segment(blocks, pos, size)
-                        else:
-                            raise errors.SyntaxError("File %s conflicts with stream of the same name.", filepath)
-                else:
-                    # error!
-                    raise errors.SyntaxError("Invalid manifest format, expected file segment but did not match format: '%s'" % tok)
+    def _import_stream_lines(self, stream, lines):
+        """Import the manifest lines of a subcollection loaded lazily."""
+        for line in lines:
+            tokens = line.split()
+            self._import_stream(stream, self._unescape_manifest_path(tokens[0]), tokens)
 
-            if sep == "\n":
-                stream_name = None
-                state = STREAM_NAME
+    def _import_stream(self, stream, stream_name, tokens):
+        """Import the blocks and files of one manifest stream line.
 
-        self.set_committed(True)
+        The collection is new and nobody can be watching it yet, so files
+        are added to `stream` directly, without going through
+        find_or_create() and notify() for each one.  The caller marks them
+        committed.
+        """
+        blocks = BlockStream(self._my_block_table())
+        i = 1
+        while i < len(tokens):
+            block_locator = self._block_re.match(tokens[i])
+            if not block_locator:
+                break
+            blocks.append(tokens[i], int(block_locator.group(1)))
+            i += 1
+
+        for tok in tokens[i:]:
+            file_segment = self._segment_re.match(tok)
+            if not file_segment:
+                raise errors.SyntaxError("Invalid manifest format, expected file segment but did not match format: '%s'" % tok)
+            pos = int(file_segment.group(1))
+            size = int(file_segment.group(2))
+            name = self._unescape_manifest_path(file_segment.group(3))
+            if '/' in name or name == '.':
+                if name.split('/')[-1] == '.':
+                    # placeholder for persisting an empty directory, not a real file
+                    if len(name) > 2:
+                        self.find_or_create(os.path.join(stream_name, name[:-2]), COLLECTION)
+                    continue
+                afile = self.find_or_create(os.path.join(stream_name, name), FILE)
+            elif isinstance(stream, RichCollectionBase):
+                afile = stream._loaded_items.get(name)
+                if afile is None:
+                    afile = ArvadosFile(stream, name)
+                    stream._loaded_items[name] = afile
+            else:
+                raise IOError(errno.ENOTDIR, "Not a directory", stream_name)
+            if isinstance(afile, ArvadosFile):
+                afile._append_stream_range(blocks, pos, size)
+            else:
+                raise errors.SyntaxError("File %s conflicts with stream of the same name.", os.path.join(stream_name, name))
 
     @synchronized
     def notify(self, event, collection, name, item):
@@ -1841,6 +2125,9 @@ class Subcollection(RichCollectionBase):
     def _my_block_manager(self):
         return self.root_collection()._my_block_manager()
 
+    def _my_block_table(self):
+        return self.root_collection()._my_block_table()
+
     def stream_name(self):
         return os.path.join(self.parent.stream_name(), self.name)
 
@@ -1858,17 +2145,27 @@ class Subcollection(RichCollectionBase):
         self.parent.remove(self.name, recursive=True)
         self.parent = newparent
         self.name = newname
-        self.lock = self.parent.root_collection().lock
+        root = self.parent.root_collection()
+        self.lock = root.lock
+        self._rebind_block_table(root._my_block_table())
 
-    @synchronized
-    def _get_manifest_text(self, stream_name, strip, normalize, only_committed=False):
+    def _stream_lines(self, stream_name, strip, only_committed, locators):
         """Encode empty directories by using an \056-named (".") empty file"""
         if len(self._items) == 0:
-            return "%s %s 0:0:\\056\n" % (
-                escape(stream_name), config.EMPTY_BLOCK_LOCATOR)
-        return super(Subcollection, self)._get_manifest_text(stream_name,
-                                                             strip, normalize,
-                                                             only_committed)
+            lines = ["%s %s 0:0:\\056\n" % (
+                escape(stream_name), config.EMPTY_BLOCK_LOCATOR)]
+            self._manifest_cache = {(stream_name, strip): lines}
+            return lines, True
+        return super(Subcollection, self)._stream_lines(stream_name, strip,
+                                                        only_committed, locators)
+
+    def _invalidate_manifest_cache(self):
+        # The cached lines of every parent include ours.  A collection is
+        # only cached when all its subcollections are, so the parents are
+        # already clear if we are.
+        if self._manifest_cache is not None:
+            self._manifest_cache = None
+            self.parent._invalidate_manifest_cache()
 
 
 class CollectionReader(Collection):
@@ -25,6 +25,7 @@ standard_library.install_aliases()
 from past.builtins import basestring
 from builtins import object
 import argparse
+import collections
 import contextlib
 import getpass
 import os
@@ -543,6 +544,27 @@ def copy_collection(obj_uuid, src, dst, args):
     else:
         progress_writer = None
 
+    # Find each distinct block in the manifest, so they can be fetched
+    # from src_keep concurrently while we copy them in order.
+    src_blocks = collections.OrderedDict()
+    for line in manifest.splitlines():
+        for word in line.split()[1:]:
+            try:
+                loc = arvados.KeepLocator(word)
+            except ValueError:
+                continue
+            src_blocks.setdefault(loc.md5sum, (word, loc.size))
+
+    src_block_list = list(src_blocks.items())
+    for i, data in enumerate(src_keep.get_many(
+            word for word, size in src_block_list)):
+        blockhash, (word, size) = src_block_list[i]
+        logger.debug("Copying block %s (%s bytes)", blockhash, size)
+        if progress_writer:
+            progress_writer.report(obj_uuid, bytes_written, bytes_expected)
+        dst_locators[blockhash] = dst_keep.put(data)
+        bytes_written += size
+
     for line in manifest.splitlines():
         words = line.split()
         dst_manifest.write(words[0])
@@ -555,19 +577,8 @@ def copy_collection(obj_uuid, src, dst, args):
                 dst_manifest.write(' ')
                 dst_manifest.write(word)
                 continue
-            blockhash = loc.md5sum
-            # copy this block if we haven't seen it before
-            # (otherwise, just reuse the existing dst_locator)
-            if blockhash not in dst_locators:
-                logger.debug("Copying block %s (%s bytes)", blockhash, loc.size)
-                if progress_writer:
-                    progress_writer.report(obj_uuid, bytes_written, bytes_expected)
-                data = src_keep.get(word)
-                dst_locator = dst_keep.put(data)
-                dst_locators[blockhash] = dst_locator
-                bytes_written += loc.size
             dst_manifest.write(' ')
-            dst_manifest.write(dst_locators[blockhash])
+            dst_manifest.write(dst_locators[loc.md5sum])
         dst_manifest.write("\n")
 
     if progress_writer:
@@ -53,8 +53,11 @@ def main(args, stdout, stderr, api_client=None, logger=None):
         collection = r.group(1)
         get_prefix = r.group(2)
 
+        # When listing a subdirectory, only load that part of the
+        # collection.
         cr = arvados.CollectionReader(collection, api_client=api_client,
-                                      num_retries=args.retries)
+                                      num_retries=args.retries,
+                                      lazy=bool(get_prefix))
         if get_prefix:
             if get_prefix[-1] == '/':
                 get_prefix = get_prefix[:-1]
@@ -0,0 +1,193 @@
+# Copyright (C) The Arvados Authors. All rights reserved.
+#
+# SPDX-License-Identifier: Apache-2.0
+
+"""On-disk storage for KeepBlockCache.
+
+Cached blocks are stored as one file per block, named by the block's md5
+hash, under a directory that can be shared by every Keep client process on
+a host.  Files are written to a temporary name and then renamed into
+place, so readers never see a partially written block.  Slots hold a
+read-only mmap of the file so content is paged in on demand rather than
+copied into process memory; KeepClient.get() still returns bytes.
+
+Removing a block file while another process has it mapped is safe: the
+mapping stays valid until that process drops it.
+
+The cache_max limit applies to the whole directory: a process trims the
+directory back to its own cache_max, holding a lock file so only one
+process trims at a time.  Scanning the directory isn't cheap, so
+KeepBlockCache only trims when the blocks it has stored may have pushed
+the directory over budget, or when the last trim was a while ago (other
+processes add blocks too).
+"""
+
+from __future__ import absolute_import
+import errno
+import fcntl
+import logging
+import mmap
+import os
+import tempfile
+import threading
+import time
+
+from . import util
+
+_logger = logging.getLogger('arvados.keep')
+
+cacheblock_suffix = ".keepcacheblock"
+lock_filename = "trim.lock"
+
+# Temporary files older than this (in seconds) are left over from a
+# process that died while writing a block, and can be removed.
+STALE_TMP_AGE = 60
+
+
+def block_path(cachedir, locator):
+    return os.path.join(cachedir, locator[0:3], locator + cacheblock_suffix)
+
+
+class DiskCacheSlot(object):
+    """A KeepBlockCache slot whose content is backed by a file on disk."""
+
+    __slots__ = ("locator", "ready", "content", "cachedir")
+
+    def __init__(self, locator, cachedir):
+        self.locator = locator
+        self.ready = threading.Event()
+        self.content = None
+        self.cachedir = cachedir
+
+    def get(self):
+        self.ready.wait()
+        return self.content
+
+    def set(self, value):
+        """Fill the slot with content returned by store() or load()."""
+        self.content = value
+        self.ready.set()
+
+    def store(self, value):
+        """Write value to the block's file and return a mapping of it.
+
+        This does disk I/O, so KeepBlockCache calls it before taking its
+        lock, then fills the slot with set().  If the block can't be
+        written, value itself is returned so it can still be served from
+        memory.
+        """
+        if value is None or len(value) == 0:
+            # Nothing to store (and a zero-length file can't be mapped).
+            return value
+        try:
+            final = block_path(self.cachedir, self.locator)
+            blockdir = os.path.dirname(final)
+            util.mkdir_dash_p(blockdir)
+            fd, tmpfile = tempfile.mkstemp(dir=blockdir, prefix="tmp",
+                                           suffix=cacheblock_suffix)
+            try:
+                with os.fdopen(fd, 'w+b') as f:
+                    f.write(value)
+                    f.flush()
+                    os.rename(tmpfile, final)
+                    tmpfile = None
+                    return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            finally:
+                if tmpfile is not None:
+                    os.unlink(tmpfile)
+        except (IOError, OSError, ValueError) as e:
+            # The disk is full or unwritable.  Keep serving the block
+            # from memory rather than failing the read.
+            _logger.warning("Could not write %s to disk cache: %s",
+                            self.locator, e)
+            return value
+
+    def size(self):
+        if self.content is None:
+            return 0
+        else:
+            return len(self.content)
+
+    def evict(self):
+        """Remove the block's file from the disk cache.
+
+        Callers that already hold the content can keep using it; the
+        mapping is released once the last reference is dropped.
+        """
+        try:
+            os.unlink(block_path(self.cachedir, self.locator))
+        except OSError:
+            pass
+
+    def load(self):
+        """Return a mapping of a block another process already cached.
+
+        Returns None if the block is not on disk.
+        """
+        path = block_path(self.cachedir, self.locator)
+        try:
+            with open(path, 'rb') as f:
+                content = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            # Record the access so least recently used blocks are the
+            # first to go when the cache directory is trimmed.
+            os.utime(path, None)
+        except (IOError, OSError, ValueError) as e:
+            if getattr(e, 'errno', None) != errno.ENOENT:
+                _logger.warning("Could not read %s from disk cache: %s",
+                                self.locator, e)
+            return None
+        return content
+
+    @staticmethod
+    def init_cache(cachedir, cache_max):
+        """Trim the cache directory to cache_max bytes.
+
+        Deletes the least recently used blocks beyond cache_max, along with
+        temporary files abandoned by processes that died mid-write.  Runs
+        with an exclusive lock on the directory's lock file, so processes
+        sharing the directory don't trim it at the same time.
+
+        Returns the size of the blocks left in the directory, or None if
+        it could not be trimmed.
+        """
+        try:
+            lockfile = open(os.path.join(cachedir, lock_filename), 'a')
+        except (IOError, OSError) as e:
+            _logger.warning("Could not open disk cache lock file: %s", e)
+            return None
+        with lockfile:
+            fcntl.flock(lockfile, fcntl.LOCK_EX)
+            return DiskCacheSlot._trim(cachedir, cache_max)
+
+    @staticmethod
+    def _trim(cachedir, cache_max):
+        blocks = []
+        now = time.time()
+        for root, dirs, files in os.walk(cachedir):
+            for name in files:
+                if not name.endswith(cacheblock_suffix):
+                    continue
+                path = os.path.join(root, name)
+                try:
+                    st = os.stat(path)
+                    if name.startswith("tmp"):
+                        if now - st.st_mtime > STALE_TMP_AGE:
+                            os.unlink(path)
+                    else:
+                        blocks.append((st.st_mtime, st.st_size, path))
+                except OSError:
+                    pass
+
+        blocks.sort(reverse=True)
+        total = 0
+        kept = 0
+        for mtime, size, path in blocks:
+            total += size
+            if total > cache_max:
+                try:
+                    os.unlink(path)
+                except OSError:
+                    pass
+            else:
+                kept += size
+        return kept
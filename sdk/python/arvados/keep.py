@@ -18,6 +18,7 @@ import hashlib
 import io
 import logging
 import math
+import mmap
 import os
 import pycurl
 import queue
@@ -26,6 +27,7 @@ import socket
 import ssl
 import sys
 import threading
+import time
 from . import timer
 import urllib.parse
 
@@ -36,6 +38,7 @@ else:
 
 import arvados
 import arvados.config as config
+import arvados.diskcache
 import arvados.errors
 import arvados.retry as retry
 import arvados.util
@@ -58,8 +61,38 @@ if sys.platform == 'darwin':
 class KeepLocator(object):
     EPOCH_DATETIME = datetime.datetime.utcfromtimestamp(0)
     HINT_RE = re.compile(r'^[A-Z][A-Za-z0-9@_-]+$')
+    # Locators as they appear in manifests: a checksum, a size, an
+    # optional permission hint, then any other hints.  Anything else goes
+    # through the general parser.
+    LOCATOR_RE = re.compile(
+        r'^([0-9a-fA-F]{32})\+([0-9]+)'
+        r'(?:\+A([0-9a-fA-F]{40})@([0-9a-fA-F]{1,8}))?'
+        r'((?:\+[B-Z][A-Za-z0-9@_-]+)*)$')
+    # Fields of recently parsed locators.  A collection usually refers to
+    # each block from many segments, so most lookups hit.
+    PARSED_CACHE_SIZE = 16384
+    _parsed = {}
+
+    __slots__ = ('_md5sum', 'size', 'hints', '_perm_sig', '_perm_expiry')
 
     def __init__(self, locator_str):
+        fields = KeepLocator._parsed.get(locator_str)
+        if fields is None:
+            m = self.LOCATOR_RE.match(locator_str)
+            if m is None:
+                self._parse(locator_str)
+                return
+            md5sum, size, perm_sig, perm_expiry, hints = m.groups()
+            fields = (md5sum, int(size), perm_sig, perm_expiry,
+                      tuple(hints.split('+')[1:]))
+            if len(KeepLocator._parsed) >= self.PARSED_CACHE_SIZE:
+                KeepLocator._parsed.clear()
+            KeepLocator._parsed[locator_str] = fields
+        (self._md5sum, self.size, self._perm_sig,
+         self._perm_expiry, hints) = fields
+        self.hints = list(hints)
+
+    def _parse(self, locator_str):
         self.hints = []
         self._perm_sig = None
         self._perm_expiry = None
@@ -106,9 +139,13 @@ class KeepLocator(object):
     md5sum = _make_hex_prop('md5sum', 32)
     perm_sig = _make_hex_prop('perm_sig', 40)
 
+    # The expiry is kept as the hex timestamp from the hint, and only
+    # converted to a datetime when asked for.
     @property
     def perm_expiry(self):
-        return self._perm_expiry
+        if self._perm_expiry is None:
+            return None
+        return datetime.datetime.utcfromtimestamp(int(self._perm_expiry, 16))
 
     @perm_expiry.setter
     def perm_expiry(self, value):
@@ -116,14 +153,12 @@ class KeepLocator(object):
             raise ValueError(
                 "permission timestamp must be a hex Unix timestamp: {}".
                 format(value))
-        self._perm_expiry = datetime.datetime.utcfromtimestamp(int(value, 16))
+        self._perm_expiry = value
 
     def permission_hint(self):
-        data = [self.perm_sig, self.perm_expiry]
-        if None in data:
+        if self._perm_sig is None or self._perm_expiry is None:
             return None
-        data[1] = int((data[1] - self.EPOCH_DATETIME).total_seconds())
-        return "A{}@{:08x}".format(*data)
+        return "A{}@{:08x}".format(self._perm_sig, int(self._perm_expiry, 16))
 
     def parse_permission_hint(self, s):
         try:
@@ -132,11 +167,12 @@ class KeepLocator(object):
             raise ValueError("bad permission hint {}".format(s))
 
     def permission_expired(self, as_of_dt=None):
-        if self.perm_expiry is None:
+        if self._perm_expiry is None:
             return False
         elif as_of_dt is None:
             as_of_dt = datetime.datetime.now()
-        return self.perm_expiry <= as_of_dt
+        return (int(self._perm_expiry, 16) <=
+                (as_of_dt - self.EPOCH_DATETIME).total_seconds())
 
 
 class Keep(object):
@@ -174,12 +210,59 @@ class Keep(object):
     def put(data, **kwargs):
         return Keep.global_client_object().put(data, **kwargs)
 
+def _as_bytes(content):
+    """Return cached block content as bytes.
+
+    Content held in a disk cache is a read-only mmap; copy it out so callers
+    get the same type whichever cache the block came from.
+    """
+    if isinstance(content, (bytearray, mmap.mmap)):
+        return bytes(content)
+    return content
+
 class KeepBlockCache(object):
+    # Seconds between rescans of the disk cache directory, to account
+    # for blocks added by other processes.
+    DISK_TRIM_INTERVAL = 60
+
     # Default RAM cache is 256MiB
-    def __init__(self, cache_max=(256 * 1024 * 1024)):
+    def __init__(self, cache_max=(256 * 1024 * 1024), disk_cache=False,
+                 disk_cache_dir=None):
+        """Initialize a new KeepBlockCache.
+
+        :cache_max:
+          Maximum size of cached content, in bytes.
+
+        :disk_cache:
+          If True, store blocks as files in disk_cache_dir instead of
+          in RAM.  The directory can be shared by several processes on
+          the same host: blocks fetched by one of them are served to the
+          others without going back to Keep.  Processes that add blocks
+          trim the directory to their own cache_max, so the limit holds
+          for the directory as a whole.
+
+        :disk_cache_dir:
+          Directory for disk_cache.  Default ~/.cache/arvados/keep.
+        """
         self.cache_max = cache_max
-        self._cache = []
+        self._disk_cache = disk_cache
+        self._disk_cache_dir = None
+        if disk_cache:
+            if disk_cache_dir is None:
+                disk_cache_dir = os.path.join(os.path.expanduser('~'), '.cache', 'arvados', 'keep')
+            arvados.util.mkdir_dash_p(disk_cache_dir)
+            self._disk_cache_dir = disk_cache_dir
+        # Estimated size of the disk cache directory: its size at the
+        # last trim plus the blocks stored since then.
+        self._disk_total = 0
+        self._disk_trimmed_at = 0
+        # Slots are kept in least-recently-used order: the most recently
+        # used slot is at the end, eviction candidates are at the front.
+        self._cache = collections.OrderedDict()
+        self._cache_total = 0
         self._cache_lock = threading.Lock()
+        if disk_cache:
+            self._trim_disk_cache()
 
     class CacheSlot(object):
         __slots__ = ("locator", "ready", "content")
@@ -203,36 +286,87 @@ class KeepBlockCache(object):
             else:
                 return len(self.content)
 
+        def evict(self):
+            pass
+
+    def _new_slot(self, locator):
+        if self._disk_cache:
+            return arvados.diskcache.DiskCacheSlot(locator, self._disk_cache_dir)
+        else:
+            return KeepBlockCache.CacheSlot(locator)
+
+    def _cap_cache(self):
+        # Drop ready slots, least recently used first, until the total
+        # size of cached content fits in cache_max.  Slots that are
+        # still being filled are skipped.  Returns the dropped slots;
+        # the caller evicts them after releasing _cache_lock, since
+        # that may touch the disk.
+        excess = self._cache_total - self.cache_max
+        if excess <= 0:
+            return []
+        evict = []
+        for slot in self._cache.values():
+            if excess <= 0:
+                break
+            if slot.ready.is_set():
+                evict.append(slot)
+                excess -= slot.size()
+        for slot in evict:
+            del self._cache[slot.locator]
+            self._cache_total -= slot.size()
+            if self._disk_cache:
+                self._disk_total = max(0, self._disk_total - slot.size())
+        return evict
+
+    @staticmethod
+    def _evict(slots):
+        for slot in slots:
+            slot.evict()
+
     def cap_cache(self):
         '''Cap the cache size to self.cache_max'''
         with self._cache_lock:
-            # Select all slots except those where ready.is_set() and content is
-            # None (that means there was an error reading the block).
-            self._cache = [c for c in self._cache if not (c.ready.is_set() and c.content is None)]
-            sm = sum([slot.size() for slot in self._cache])
-            while len(self._cache) > 0 and sm > self.cache_max:
-                for i in range(len(self._cache)-1, -1, -1):
-                    if self._cache[i].ready.is_set():
-                        del self._cache[i]
-                        break
-                sm = sum([slot.size() for slot in self._cache])
+            evicted = self._cap_cache()
+        self._evict(evicted)
+
+    def _trim_disk_cache(self):
+        with self._cache_lock:
+            self._disk_trimmed_at = time.time()
+        total = arvados.diskcache.DiskCacheSlot.init_cache(
+            self._disk_cache_dir, self.cache_max)
+        if total is not None:
+            with self._cache_lock:
+                self._disk_total = total
+
+    def _disk_cache_stored(self, size):
+        # Trim the directory when the blocks stored since the last trim
+        # may have taken it over budget, or when the last trim is old
+        # enough that other processes may have done the same.
+        with self._cache_lock:
+            self._disk_total += size
+            if (self._disk_total <= self.cache_max and
+                    time.time() - self._disk_trimmed_at < self.DISK_TRIM_INTERVAL):
+                return
+        self._trim_disk_cache()
 
     def _get(self, locator):
         # Test if the locator is already in the cache
-        for i in range(0, len(self._cache)):
-            if self._cache[i].locator == locator:
-                n = self._cache[i]
-                if i != 0:
-                    # move it to the front
-                    del self._cache[i]
-                    self._cache.insert(0, n)
-                return n
-        return None
+        n = self._cache.pop(locator, None)
+        if n is not None:
+            # Re-insert to mark it as the most recently used.
+            self._cache[locator] = n
+        return n
 
     def get(self, locator):
         with self._cache_lock:
             return self._get(locator)
 
+    def peek(self, locator):
+        """Return the slot for locator, or None, without marking it as
+        recently used."""
+        with self._cache_lock:
+            return self._cache.get(locator)
+
     def reserve_cache(self, locator):
         '''Reserve a cache slot for the specified locator,
         or return the existing slot.'''
@@ -240,11 +374,460 @@ class KeepBlockCache(object):
             n = self._get(locator)
             if n:
                 return n, False
-            else:
-                # Add a new cache slot for the locator
-                n = KeepBlockCache.CacheSlot(locator)
-                self._cache.insert(0, n)
-                return n, True
+            # Add a new cache slot for the locator
+            n = self._new_slot(locator)
+            self._cache[locator] = n
+        if self._disk_cache:
+            # Another process may already have stored this block.  The
+            # slot is reserved while we look, so other threads asking
+            # for the block wait for it rather than reading it too.
+            content = n.load()
+            if content is not None:
+                self._fill(n, content)
+                return n, False
+        return n, True
+
+    def _fill(self, slot, content):
+        # Publish content that is already in its final form (in memory,
+        # or mapped from disk).
+        with self._cache_lock:
+            slot.set(content)
+            if self._cache.get(slot.locator) is slot:
+                if content is None:
+                    del self._cache[slot.locator]
+                else:
+                    self._cache_total += slot.size()
+            evicted = self._cap_cache()
+        self._evict(evicted)
+
+    def set(self, slot, blob):
+        '''Fill a reserved slot with the given content and cap the cache.
+
+        If blob is None (the block could not be read), the slot is
+        dropped from the cache so a later request will try again.  A
+        slot that is already filled is left as it is.
+        '''
+        if slot.ready.is_set():
+            return
+        if self._disk_cache:
+            # Write the block out before taking the lock, so readers of
+            # other blocks don't wait for the disk.
+            content = slot.store(blob)
+            self._fill(slot, content)
+            if blob:
+                self._disk_cache_stored(slot.size())
+        else:
+            self._fill(slot, blob)
+
+class _GetManyBatch(object):
+    """State shared by the threads fetching blocks for KeepClient.get_many.
+
+    Blocks are claimed in request order, and a block is only claimed when
+    its size fits in what's left of the memory budget, so the consumer is
+    never left waiting for a block that can't start.
+    """
+
+    def __init__(self, get, locators, max_inflight, max_bytes):
+        self._get = get
+        self._locators = locators
+        self._sizes = []
+        for loc_s in locators:
+            try:
+                size = KeepLocator(loc_s).size
+            except ValueError:
+                size = None
+            self._sizes.append(config.KEEP_BLOCK_SIZE if size is None else size)
+        self._results = [None] * len(locators)
+        self._ready = [threading.Event() for _ in locators]
+        self._max_inflight = max_inflight
+        self._max_bytes = max_bytes
+        self._next = 0
+        self._used = 0
+        self._closed = False
+        self._cond = threading.Condition()
+
+    def _claim(self):
+        with self._cond:
+            while True:
+                if self._closed or self._next >= len(self._locators):
+                    return None
+                size = self._sizes[self._next]
+                if self._used == 0 or self._used + size <= self._max_bytes:
+                    break
+                self._cond.wait()
+            i = self._next
+            self._next += 1
+            self._used += size
+            return i
+
+    def _worker(self):
+        while True:
+            i = self._claim()
+            if i is None:
+                return
+            try:
+                self._results[i] = (True, self._get(self._locators[i]))
+            except Exception as e:
+                self._results[i] = (False, e)
+            self._ready[i].set()
+
+    def __iter__(self):
+        for _ in range(min(self._max_inflight, len(self._locators))):
+            thread = threading.Thread(target=self._worker)
+            thread.daemon = True
+            thread.start()
+        try:
+            for i in range(len(self._locators)):
+                self._ready[i].wait()
+                ok, result = self._results[i]
+                self._results[i] = None
+                with self._cond:
+                    self._used -= self._sizes[i]
+                    self._cond.notify_all()
+                if not ok:
+                    raise result
+                yield result
+        finally:
+            with self._cond:
+                self._closed = True
+                self._cond.notify_all()
+
+
+class _BlockReceiver(object):
+    """Collect a Keep block from a pycurl WRITEFUNCTION callback.
+
+    The body is written into a single bytearray and hashed as it arrives.
+    This avoids accumulating it in a BytesIO, copying it out again, and
+    making a second pass over it to verify the checksum.
+
+    If `headers` (filled in by the header callback) shows a 200 status by
+    the first write, the buffer is allocated at the expected size then.
+    The size comes from the locator, so it is capped at KEEP_BLOCK_SIZE.
+    Error bodies just grow as they arrive.
+    """
+    __slots__ = ('expected_size', 'headers', 'buf', 'pos', 'md5')
+
+    def __init__(self, expected_size=None, headers=None):
+        self.expected_size = expected_size
+        self.headers = headers
+        self.buf = None
+        self.pos = 0
+        self.md5 = hashlib.md5()
+
+    def _status_ok(self):
+        status_line = (self.headers or {}).get('x-status-line', '')
+        return status_line.split(None, 2)[1:2] == ['200']
+
+    def write(self, data):
+        if self.buf is None:
+            size = 0
+            if self.expected_size and self._status_ok():
+                size = min(self.expected_size, config.KEEP_BLOCK_SIZE)
+            self.buf = bytearray(size)
+        n = len(data)
+        # Overwrites in place while within the preallocated size, and
+        # extends the buffer if the server sends more than that.
+        self.buf[self.pos:self.pos+n] = data
+        self.pos += n
+        self.md5.update(data)
+
+    def getvalue(self):
+        """Return the body as bytes.
+
+        The result is handed to callers and stored in the block cache, so
+        it is an immutable copy rather than the receive buffer.
+        """
+        if self.buf is None:
+            return b''
+        return bytes(memoryview(self.buf)[:self.pos])
+
+    def hexdigest(self):
+        return self.md5.hexdigest()
+
+
+def _byte_view(buf):
+    """Return a memoryview of buf's content as unsigned bytes.
+
+    len() of a memoryview counts items, not bytes, so a buffer whose
+    items are bigger than a byte (an array('i'), say) is cast first.
+    """
+    view = memoryview(buf)
+    if view.format != 'B' or view.ndim != 1:
+        view = view.cast('B')
+    return view
+
+
+def _block_data(data):
+    """Return data to upload in a form that can be hashed, sized and sent.
+
+    Strings are encoded, a list of buffers becomes a _BlockChunks, and
+    other buffers are viewed as bytes without being copied.
+    """
+    if isinstance(data, (bytes, _BlockChunks)):
+        return data
+    if hasattr(data, 'encode'):
+        return data.encode()
+    if isinstance(data, list):
+        return _BlockChunks(data)
+    return _byte_view(data)
+
+
+class _BlockChunks(object):
+    """A Keep block given as a list of buffers, in order.
+
+    Lets a block assembled from several buffers be hashed and uploaded
+    without first joining them into one.
+    """
+    __slots__ = ('chunks', 'size')
+
+    def __init__(self, chunks):
+        self.chunks = [_byte_view(c) for c in chunks]
+        self.size = sum(len(c) for c in self.chunks)
+
+    def __len__(self):
+        return self.size
+
+    def md5(self):
+        md5 = hashlib.md5()
+        for c in self.chunks:
+            md5.update(c)
+        return md5
+
+
+class _BlockSender(object):
+    """Feed a Keep block to a pycurl READFUNCTION callback.
+
+    Reads are served from memoryviews over the caller's buffers, so the
+    only copy made is of each chunk as pycurl asks for it.
+    """
+    __slots__ = ('views', 'index', 'pos')
+
+    def __init__(self, data):
+        if isinstance(data, _BlockChunks):
+            self.views = data.chunks
+        else:
+            self.views = [memoryview(data)]
+        self.index = 0
+        self.pos = 0
+
+    def read(self, size):
+        while self.index < len(self.views):
+            chunk = self.views[self.index][self.pos:self.pos+size]
+            if len(chunk):
+                self.pos += len(chunk)
+                return chunk.tobytes()
+            self.index += 1
+            self.pos = 0
+        return b''
+
+
+def _put_response_copies(headers):
+    """Return (replicas_stored, classes_confirmed) from PUT response headers.
+
+    classes_confirmed is None if the service did not report storage
+    classes, or reported them in a form we can't parse.
+    """
+    try:
+        replicas_stored = int(headers['x-keep-replicas-stored'])
+    except (KeyError, ValueError):
+        replicas_stored = 1
+
+    classes_confirmed = {}
+    try:
+        scch = headers['x-keep-storage-classes-confirmed']
+        for confirmation in scch.replace(' ', '').split(','):
+            if '=' in confirmation:
+                stored_class, stored_copies = confirmation.split('=')[:2]
+                classes_confirmed[stored_class] = int(stored_copies)
+    except (KeyError, ValueError):
+        # Storage classes confirmed header missing or corrupt
+        classes_confirmed = None
+    return replicas_stored, classes_confirmed
+
+
+class KeepServiceHealth(object):
+    """Track the health of Keep services across requests.
+
+    KeepService objects only last for one transaction, so a KeepClient
+    shares one of these between all of them to remember how each service
+    root has been doing.  A service whose requests fail (no HTTP response,
+    or a 5xx status) FAILURE_THRESHOLD times in a row has its circuit
+    opened: it is moved to the end of the probe order for COOLDOWN
+    seconds.  After that, the next request sent to it is a probe, and it
+    is avoided again until the probe's outcome is recorded.  If the probe
+    succeeds the circuit closes.  If it fails, the cooldown is doubled,
+    up to MAX_COOLDOWN.
+    """
+
+    FAILURE_THRESHOLD = 3
+    COOLDOWN = 5
+    MAX_COOLDOWN = 60
+    # Weight of the newest sample in the latency and error rate averages.
+    EWMA_ALPHA = 0.2
+
+    class ServiceRecord(object):
+        __slots__ = ('requests', 'failures', 'latency', 'error_rate',
+                     'consecutive_failures', 'last_failure', 'open_until',
+                     'cooldown')
+
+        def __init__(self):
+            self.requests = 0
+            self.failures = 0
+            self.latency = None
+            self.error_rate = 0.0
+            self.consecutive_failures = 0
+            self.last_failure = None
+            self.open_until = None
+            self.cooldown = 0
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._services = {}
+        self._open_count = 0
+
+    def record(self, root, status_code, elapsed):
+        """Record the outcome of one request to the service at root."""
+        failed = status_code is None or status_code >= 500
+        now = time.time()
+        with self._lock:
+            rec = self._services.get(root)
+            if rec is None:
+                rec = self._services[root] = self.ServiceRecord()
+            rec.requests += 1
+            a = self.EWMA_ALPHA
+            rec.error_rate = (1 - a) * rec.error_rate + a * (1 if failed else 0)
+            if not failed:
+                if rec.latency is None:
+                    rec.latency = elapsed
+                else:
+                    rec.latency = (1 - a) * rec.latency + a * elapsed
+                rec.consecutive_failures = 0
+                if rec.open_until is not None:
+                    _logger.info("Keep service %s is responding again", root)
+                    rec.open_until = None
+                    rec.cooldown = 0
+                    self._open_count -= 1
+                return
+            rec.failures += 1
+            rec.consecutive_failures += 1
+            rec.last_failure = now
+            if rec.open_until is not None:
+                # The probe failed.
+                rec.cooldown = min(rec.cooldown * 2, self.MAX_COOLDOWN)
+                rec.open_until = now + rec.cooldown
+            elif rec.consecutive_failures >= self.FAILURE_THRESHOLD:
+                _logger.warning("Keep service %s failed %d requests in a row, "
+                                "avoiding it for %d s", root,
+                                rec.consecutive_failures, self.COOLDOWN)
+                rec.cooldown = self.COOLDOWN
+                rec.open_until = now + rec.cooldown
+                self._open_count += 1
+
+    def reorder(self, roots):
+        """Return roots with services whose circuit is open moved to the end.
+
+        Relative order is otherwise preserved.  A service whose cooldown
+        has expired keeps its place, so it can be probed.
+        """
+        if not self._open_count:
+            return roots
+        now = time.time()
+        healthy = []
+        avoided = []
+        with self._lock:
+            for root in roots:
+                rec = self._services.get(root)
+                if rec is None or rec.open_until is None or now >= rec.open_until:
+                    healthy.append(root)
+                else:
+                    avoided.append(root)
+        return healthy + avoided
+
+    def start_request(self, root):
+        """Note that a request is being sent to the service at root.
+
+        If the service's cooldown has expired, this request is the probe:
+        other callers go back to avoiding the service until its outcome
+        is recorded.
+        """
+        if not self._open_count:
+            return
+        now = time.time()
+        with self._lock:
+            rec = self._services.get(root)
+            if rec is not None and rec.open_until is not None and now >= rec.open_until:
+                rec.open_until = now + rec.cooldown
+
+    def metrics(self):
+        """Return a dict mapping each service root to its health metrics."""
+        now = time.time()
+        with self._lock:
+            return {
+                root: {
+                    'requests': rec.requests,
+                    'failures': rec.failures,
+                    'latency': rec.latency,
+                    'error_rate': rec.error_rate,
+                    'consecutive_failures': rec.consecutive_failures,
+                    'last_failure': rec.last_failure,
+                    'circuit_open': (rec.open_until is not None and
+                                     now < rec.open_until),
+                }
+                for root, rec in self._services.items()
+            }
+
+
+class _WorkerThreads(object):
+    """Run functions on reusable daemon threads.
+
+    Threads are started when a function is submitted and no thread is
+    idle, up to max_threads (no limit if None).  A thread exits after
+    IDLE_TIMEOUT seconds without work, so a pool nobody uses any more
+    doesn't keep threads alive.
+    """
+    IDLE_TIMEOUT = 10
+
+    def __init__(self, max_threads=None):
+        self.max_threads = max_threads
+        self._tasks = queue.Queue()
+        self._lock = threading.Lock()
+        self._threads = 0
+        self._idle = 0
+        self._pending = 0
+
+    def submit(self, func, *args):
+        with self._lock:
+            self._tasks.put((func, args))
+            self._pending += 1
+            if (self._pending > self._idle and
+                (self.max_threads is None or self._threads < self.max_threads)):
+                thread = threading.Thread(target=self._run)
+                thread.daemon = True
+                thread.start()
+                self._threads += 1
+                self._idle += 1
+
+    def _run(self):
+        while True:
+            try:
+                func, args = self._tasks.get(timeout=self.IDLE_TIMEOUT)
+            except queue.Empty:
+                with self._lock:
+                    if self._pending == 0:
+                        self._threads -= 1
+                        self._idle -= 1
+                        return
+                continue
+            with self._lock:
+                self._pending -= 1
+                self._idle -= 1
+            try:
+                func(*args)
+            except Exception:
+                _logger.exception("Exception in Keep worker thread")
+            with self._lock:
+                self._idle += 1
+
 
 class Counter(object):
     def __init__(self, v=0):
@@ -271,6 +854,22 @@ class KeepClient(object):
     DEFAULT_TIMEOUT = (2, 256, 32768)
     DEFAULT_PROXY_TIMEOUT = (20, 256, 32768)
 
+    # Number of recent GET latencies used to compute hedge_percentile,
+    # and how many are needed before it is used instead of hedge_delay.
+    HEDGE_LATENCY_SAMPLES = 256
+    HEDGE_MIN_SAMPLES = 16
+
+    # Default maximum number of concurrent PUT requests across all put()
+    # calls on one client.
+    DEFAULT_WRITER_THREADS = 16
+
+    # Default number of concurrent GET requests for get_many().
+    DEFAULT_GET_MANY_INFLIGHT = 8
+
+    # Number of block hashes whose service probe order is remembered by
+    # weighted_service_roots().
+    PROBE_ORDER_CACHE_SIZE = 4096
+
 
     class KeepService(object):
         """Make requests to a single Keep service, and track results.
@@ -294,9 +893,11 @@ class KeepClient(object):
                      upload_counter=None,
                      download_counter=None,
                      headers={},
-                     insecure=False):
+                     insecure=False,
+                     health=None):
             self.root = root
             self._user_agent_pool = user_agent_pool
+            self._health = health
             self._result = {'error': None}
             self._usable = True
             self._session = None
@@ -308,6 +909,16 @@ class KeepClient(object):
             self.download_counter = download_counter
             self.insecure = insecure
 
+        def _start_request(self):
+            if self._health is not None:
+                self._health.start_request(self.root)
+
+        def _record_health(self, t0):
+            if self._health is not None:
+                self._health.record(self.root,
+                                    self._result.get('status_code', None),
+                                    time.time() - t0)
+
         def usable(self):
             """Is it worth attempting a request?"""
             return self._usable
@@ -356,30 +967,33 @@ class KeepClient(object):
             self._socket = s
             return s
 
-        def get(self, locator, method="GET", timeout=None):
-            # locator is a KeepLocator object.
+        def get(self, locator, method="GET", timeout=None, cancel=None):
+            # locator is a KeepLocator object.  If cancel (a
+            # threading.Event) is set while the request is running, the
+            # transfer is aborted and the request fails without counting
+            # against the service's health.
             url = self.root + str(locator)
             _logger.debug("Request: %s %s", method, url)
             curl = self._get_user_agent()
             ok = None
+            self._start_request()
+            t0 = time.time()
             try:
                 with timer.Timer() as t:
                     self._headers = {}
-                    response_body = BytesIO()
+                    response_body = _BlockReceiver(locator.size, self._headers)
                     curl.setopt(pycurl.NOSIGNAL, 1)
                     curl.setopt(pycurl.OPENSOCKETFUNCTION,
                                 lambda *args, **kwargs: self._socket_open(*args, **kwargs))
-                    curl.setopt(pycurl.URL, url.encode('utf-8'))
-                    curl.setopt(pycurl.HTTPHEADER, [
-                        '{}: {}'.format(k,v) for k,v in self.get_headers.items()])
-                    curl.setopt(pycurl.WRITEFUNCTION, response_body.write)
-                    curl.setopt(pycurl.HEADERFUNCTION, self._headerfunction)
-                    if self.insecure:
-                        curl.setopt(pycurl.SSL_VERIFYPEER, 0)
-                    else:
-                        curl.setopt(pycurl.CAINFO, arvados.util.ca_certs_path())
+                    self._setcurlopts(curl, url, self.get_headers, response_body)
                     if method == "HEAD":
                         curl.setopt(pycurl.NOBODY, True)
+                    if cancel is not None:
+                        # libcurl calls this at least once a second, even
+                        # while waiting for the server; non-zero aborts.
+                        curl.setopt(pycurl.NOPROGRESS, 0)
+                        curl.setopt(pycurl.XFERINFOFUNCTION,
+                                    lambda *args: int(cancel.is_set()))
                     self._setcurltimeouts(curl, timeout, method=="HEAD")
 
                     try:
@@ -407,6 +1021,8 @@ class KeepClient(object):
                     'error': e,
                 }
             self._usable = ok != False
+            if not (cancel is not None and cancel.is_set() and not ok):
+                self._record_health(t0)
             if self._result.get('status_code', None):
                 # The client worked well enough to get an HTTP status
                 # code, so presumably any problems are just on the
@@ -438,7 +1054,7 @@ class KeepClient(object):
 
             if self.download_counter:
                 self.download_counter.add(len(self._result['body']))
-            resp_md5 = hashlib.md5(self._result['body']).hexdigest()
+            resp_md5 = response_body.hexdigest()
             if resp_md5 != locator.md5sum:
                 _logger.warning("Checksum fail: md5(%s) = %s",
                                 url, resp_md5)
@@ -454,15 +1070,17 @@ class KeepClient(object):
             _logger.debug("Request: PUT %s", url)
             curl = self._get_user_agent()
             ok = None
+            self._start_request()
+            t0 = time.time()
             try:
                 with timer.Timer() as t:
                     self._headers = {}
-                    body_reader = BytesIO(body)
+                    body_reader = _BlockSender(body)
                     response_body = BytesIO()
                     curl.setopt(pycurl.NOSIGNAL, 1)
                     curl.setopt(pycurl.OPENSOCKETFUNCTION,
                                 lambda *args, **kwargs: self._socket_open(*args, **kwargs))
-                    curl.setopt(pycurl.URL, url.encode('utf-8'))
+                    self._setcurlopts(curl, url, put_headers, response_body)
                     # Using UPLOAD tells cURL to wait for a "go ahead" from the
                     # Keep server (in the form of a HTTP/1.1 "100 Continue"
                     # response) instead of sending the request body immediately.
@@ -472,14 +1090,6 @@ class KeepClient(object):
                     curl.setopt(pycurl.UPLOAD, True)
                     curl.setopt(pycurl.INFILESIZE, len(body))
                     curl.setopt(pycurl.READFUNCTION, body_reader.read)
-                    curl.setopt(pycurl.HTTPHEADER, [
-                        '{}: {}'.format(k,v) for k,v in put_headers.items()])
-                    curl.setopt(pycurl.WRITEFUNCTION, response_body.write)
-                    curl.setopt(pycurl.HEADERFUNCTION, self._headerfunction)
-                    if self.insecure:
-                        curl.setopt(pycurl.SSL_VERIFYPEER, 0)
-                    else:
-                        curl.setopt(pycurl.CAINFO, arvados.util.ca_certs_path())
                     self._setcurltimeouts(curl, timeout)
                     try:
                         curl.perform()
@@ -505,6 +1115,7 @@ class KeepClient(object):
                     'error': e,
                 }
             self._usable = ok != False # still usable if ok is True or None
+            self._record_health(t0)
             if self._result.get('status_code', None):
                 # Client is functional. See comment in get().
                 self._put_user_agent(curl)
@@ -523,6 +1134,17 @@ class KeepClient(object):
                 self.upload_counter.add(len(body))
             return True
 
+        def _setcurlopts(self, curl, url, headers, response_body):
+            curl.setopt(pycurl.URL, url.encode('utf-8'))
+            curl.setopt(pycurl.HTTPHEADER, [
+                '{}: {}'.format(k,v) for k,v in headers.items()])
+            curl.setopt(pycurl.WRITEFUNCTION, response_body.write)
+            curl.setopt(pycurl.HEADERFUNCTION, self._headerfunction)
+            if self.insecure:
+                curl.setopt(pycurl.SSL_VERIFYPEER, 0)
+            else:
+                curl.setopt(pycurl.CAINFO, arvados.util.ca_certs_path())
+
         def _setcurltimeouts(self, curl, timeouts, ignore_bandwidth=False):
             if not timeouts:
                 return
@@ -647,7 +1269,7 @@ class KeepClient(object):
 
 
     class KeepWriterThreadPool(object):
-        def __init__(self, data, data_hash, copies, max_service_replicas, timeout=None, classes=[]):
+        def __init__(self, data, data_hash, copies, max_service_replicas, timeout=None, classes=[], workers=None):
             self.total_task_nr = 0
             if (not max_service_replicas) or (max_service_replicas >= copies):
                 num_threads = 1
@@ -656,9 +1278,15 @@ class KeepClient(object):
             _logger.debug("Pool max threads is %d", num_threads)
             self.workers = []
             self.queue = KeepClient.KeepWriterQueue(copies, classes)
-            # Create workers
+            # If a shared KeepWriterWorkers pool is given, hand it the
+            # writer tasks instead of starting a thread for each one.
+            self._shared_workers = workers
+            if workers is None:
+                writer_class = KeepClient.KeepWriterThread
+            else:
+                writer_class = KeepClient.KeepWriterTask
             for _ in range(num_threads):
-                w = KeepClient.KeepWriterThread(self.queue, data, data_hash, timeout)
+                w = writer_class(self.queue, data, data_hash, timeout)
                 self.workers.append(w)
 
         def add_task(self, ks, service_root):
@@ -671,7 +1299,10 @@ class KeepClient(object):
         def join(self):
             # Start workers
             for worker in self.workers:
-                worker.start()
+                if self._shared_workers is None:
+                    worker.start()
+                else:
+                    self._shared_workers.submit(worker)
             # Wait for finished work
             self.queue.join()
 
@@ -679,16 +1310,32 @@ class KeepClient(object):
             return self.queue.response
 
 
-    class KeepWriterThread(threading.Thread):
+    class KeepWriterWorkers(_WorkerThreads):
+        """Threads that run KeepWriterTasks for a KeepClient.
+
+        All put() calls on a client share these threads, so the number of
+        threads bounds how many PUT requests are in flight at once, and
+        threads are reused from one block to the next.  Threads start as
+        tasks arrive and exit once idle, so a client that has stopped
+        writing holds no threads.
+        """
+
+        def __init__(self, num_threads):
+            super(KeepClient.KeepWriterWorkers, self).__init__(max_threads=num_threads)
+            self.num_threads = num_threads
+
+        def submit(self, task):
+            super(KeepClient.KeepWriterWorkers, self).submit(task.run)
+
+
+    class KeepWriterTask(object):
         class TaskFailed(RuntimeError): pass
 
         def __init__(self, queue, data, data_hash, timeout=None):
-            super(KeepClient.KeepWriterThread, self).__init__()
             self.timeout = timeout
             self.queue = queue
             self.data = data
             self.data_hash = data_hash
-            self.daemon = True
 
         def run(self):
             while True:
@@ -732,29 +1379,22 @@ class KeepClient(object):
                           self.data_hash,
                           len(self.data),
                           service_root)
-            try:
-                replicas_stored = int(result['headers']['x-keep-replicas-stored'])
-            except (KeyError, ValueError):
-                replicas_stored = 1
+            replicas_stored, classes_confirmed = _put_response_copies(result['headers'])
+            return result['body'].strip(), replicas_stored, classes_confirmed
 
-            classes_confirmed = {}
-            try:
-                scch = result['headers']['x-keep-storage-classes-confirmed']
-                for confirmation in scch.replace(' ', '').split(','):
-                    if '=' in confirmation:
-                        stored_class, stored_copies = confirmation.split('=')[:2]
-                        classes_confirmed[stored_class] = int(stored_copies)
-            except (KeyError, ValueError):
-                # Storage classes confirmed header missing or corrupt
-                classes_confirmed = None
 
-            return result['body'].strip(), replicas_stored, classes_confirmed
+    class KeepWriterThread(KeepWriterTask, threading.Thread):
+        def __init__(self, queue, data, data_hash, timeout=None):
+            threading.Thread.__init__(self)
+            KeepClient.KeepWriterTask.__init__(self, queue, data, data_hash, timeout)
+            self.daemon = True
 
 
     def __init__(self, api_client=None, proxy=None,
                  timeout=DEFAULT_TIMEOUT, proxy_timeout=DEFAULT_PROXY_TIMEOUT,
                  api_token=None, local_store=None, block_cache=None,
-                 num_retries=0, session=None):
+                 num_retries=0, session=None, hedge_delay=None,
+                 hedge_percentile=None, writer_threads=None):
         """Initialize a new KeepClient.
 
         Arguments:
@@ -808,6 +1448,25 @@ class KeepClient(object):
           The default number of times to retry failed requests.
           This will be used as the default num_retries value when get() and
           put() are called.  Default 0.
+
+        :hedge_delay:
+          If specified, a GET request that hasn't completed after this many
+          seconds is also sent to the next Keep service in probe order, and
+          whichever response arrives first is used.  This bounds the cost
+          of a slow or hung service to about hedge_delay instead of the
+          full read timeout.  Default None (requests are sent to one
+          service at a time).
+
+        :hedge_percentile:
+          If specified, once enough GET requests have completed, hedge
+          after this percentile (0-100) of recent GET latencies instead of
+          the fixed hedge_delay.
+
+        :writer_threads:
+          The maximum number of PUT requests to have in flight at once,
+          across all concurrent put() calls on this client.  Writes are
+          done by a pool of reusable threads, which exit after a few
+          seconds without work.  Default DEFAULT_WRITER_THREADS.
         """
         self.lock = threading.Lock()
         if proxy is None:
@@ -842,11 +1501,24 @@ class KeepClient(object):
         self.hits_counter = Counter()
         self.misses_counter = Counter()
         self._storage_classes_unsupported_warning = False
+        self.hedge_delay = hedge_delay
+        self.hedge_percentile = hedge_percentile
+        self._get_latencies = collections.deque(maxlen=self.HEDGE_LATENCY_SAMPLES)
+        self._hedge_workers = _WorkerThreads()
+        self._writer_workers = KeepClient.KeepWriterWorkers(
+            writer_threads or self.DEFAULT_WRITER_THREADS)
+        # Maps (md5sum, need_writable, services generation) to the
+        # (roots, using_proxy) computed for it, least recently used first.
+        self._probe_order_cache = collections.OrderedDict()
+        self._probe_order_lock = threading.Lock()
+        self._services_generation = 0
+        self._service_health = KeepServiceHealth()
 
         if local_store:
             self.local_store = local_store
             self.head = self.local_store_head
             self.get = self.local_store_get
+            self._get = self.local_store_get
             self.put = self.local_store_put
         else:
             self.num_retries = num_retries
@@ -947,6 +1619,13 @@ class KeepClient(object):
             else:
                 self.max_replicas_per_service = 1
 
+            # Probe orders computed from the old list are stale.
+            # Entries are keyed by generation too, so an order computed
+            # concurrently from the old list is never returned.
+            with self._probe_order_lock:
+                self._services_generation += 1
+                self._probe_order_cache.clear()
+
     def _service_weight(self, data_hash, service_uuid):
         """Compute the weight of a Keep service endpoint for a data
         block with a known hash.
@@ -980,17 +1659,40 @@ class KeepClient(object):
         # Sort the available local services by weight (heaviest first)
         # for this locator, and return their service_roots (base URIs)
         # in that order.
+        roots, self.using_proxy = self._probe_order(locator.md5sum, need_writable)
+        # Try services that have been failing last.
+        sorted_roots.extend(self._service_health.reorder(roots))
+        _logger.debug("%s: %s", locator, sorted_roots)
+        return sorted_roots
+
+    def _probe_order(self, md5sum, need_writable):
+        """Return (roots, using_proxy) for the local services and a hash.
+
+        Results are memoized, since computing them takes an md5 and a
+        sort over every service.
+        """
+        key = (md5sum, need_writable, self._services_generation)
+        with self._probe_order_lock:
+            cached = self._probe_order_cache.pop(key, None)
+            if cached is not None:
+                self._probe_order_cache[key] = cached
+                return cached
+
         use_services = self._keep_services
         if need_writable:
             use_services = self._writable_services
-        self.using_proxy = self._any_nondisk_services(use_services)
-        sorted_roots.extend([
-            svc['_service_root'] for svc in sorted(
+        cached = (
+            tuple(svc['_service_root'] for svc in sorted(
                 use_services,
                 reverse=True,
-                key=lambda svc: self._service_weight(locator.md5sum, svc['uuid']))])
-        _logger.debug("{}: {}".format(locator, sorted_roots))
-        return sorted_roots
+                key=lambda svc: self._service_weight(md5sum, svc['uuid']))),
+            self._any_nondisk_services(use_services))
+
+        with self._probe_order_lock:
+            self._probe_order_cache[key] = cached
+            while len(self._probe_order_cache) > self.PROBE_ORDER_CACHE_SIZE:
+                self._probe_order_cache.popitem(last=False)
+        return cached
 
     def map_new_services(self, roots_map, locator, force_rebuild, need_writable, headers):
         # roots_map is a dictionary, mapping Keep service root strings
@@ -1006,7 +1708,8 @@ class KeepClient(object):
                     upload_counter=self.upload_counter,
                     download_counter=self.download_counter,
                     headers=headers,
-                    insecure=self.insecure)
+                    insecure=self.insecure,
+                    health=self._service_health)
         return local_roots
 
     @staticmethod
@@ -1027,25 +1730,162 @@ class KeepClient(object):
         else:
             return None
 
+    def service_health(self):
+        """Return health metrics for the Keep services this client has used.
+
+        The result maps each service root to a dict with the number of
+        `requests` and `failures`, a moving average of response `latency`
+        (seconds) and `error_rate` (0 to 1), the number of
+        `consecutive_failures`, the time of the `last_failure`, and
+        whether its `circuit_open` (the service is being avoided).
+        """
+        return self._service_health.metrics()
+
+    def current_hedge_delay(self):
+        """Return how long a GET may run before it is hedged.
+
+        None means GET requests are not hedged.
+        """
+        if self.hedge_percentile is not None:
+            with self.lock:
+                samples = sorted(self._get_latencies)
+            if len(samples) >= self.HEDGE_MIN_SAMPLES:
+                i = int(len(samples) * self.hedge_percentile / 100.0)
+                return samples[min(i, len(samples) - 1)]
+        return self.hedge_delay
+
+    def _get_from_service(self, keep_service, locator, method, timeout, cancel=None):
+        t0 = time.time()
+        if cancel is None:
+            blob = keep_service.get(locator, method=method, timeout=timeout)
+        else:
+            blob = keep_service.get(locator, method=method, timeout=timeout,
+                                    cancel=cancel)
+        if blob is not None and method == "GET" and self.hedge_percentile is not None:
+            with self.lock:
+                self._get_latencies.append(time.time() - t0)
+        return blob
+
+    def _hedged_get(self, services, locator, timeout, delay):
+        """Fetch a block from the first of `services` to deliver it.
+
+        Requests start with the first service.  Whenever no response has
+        arrived within `delay` seconds, or a request fails, the next service
+        is tried as well, without abandoning requests already in flight.
+        Once a block arrives, the requests still in flight are cancelled.
+        Returns None if every service failed.
+        """
+        results = queue.Queue()
+        cancel = threading.Event()
+
+        def fetch(keep_service):
+            blob = None
+            try:
+                blob = self._get_from_service(keep_service, locator, "GET", timeout, cancel)
+            finally:
+                results.put(blob)
+
+        started = 0
+        pending = 0
+        try:
+            while True:
+                # Each pass follows a hedge timeout or a failed request,
+                # either of which means it's time to try another service.
+                if started < len(services):
+                    self._hedge_workers.submit(fetch, services[started])
+                    started += 1
+                    pending += 1
+                elif pending == 0:
+                    return None
+                try:
+                    blob = results.get(
+                        timeout=(delay if started < len(services) else None))
+                except queue.Empty:
+                    _logger.debug("Hedging GET %s after %.3f s", locator, delay)
+                    continue
+                pending -= 1
+                if blob is not None:
+                    return blob
+        finally:
+            cancel.set()
+
     def get_from_cache(self, loc):
         """Fetch a block only if is in the cache, otherwise return None."""
-        slot = self.block_cache.get(loc)
+        return _as_bytes(self._get_from_cache(loc))
+
+    def _get_from_cache(self, loc):
+        # The cache is keyed by md5sum, without size or hints.
+        slot = self.block_cache.get(loc[0:32])
         if slot is not None and slot.ready.is_set():
             return slot.get()
         else:
             return None
 
+    def read_block(self, loc_s, num_retries=None, cache_only=False):
+        """Return a block's content without copying it out of the block cache.
+
+        This is get() (or get_from_cache(), if `cache_only` is true) for
+        callers that only read slices of the block.  The result supports
+        slicing and the buffer protocol, but is not always bytes: with a
+        disk cache it is a read-only mmap of the cached file.
+        """
+        if cache_only:
+            return self._get_from_cache(loc_s)
+        return self._get(loc_s, num_retries=num_retries)
+
+    def get_many(self, locators, max_inflight=None, max_bytes=None, num_retries=None):
+        """Fetch several blocks concurrently.
+
+        Returns an iterator that yields the content of each block in
+        `locators`, in the same order.  Up to `max_inflight` GET requests
+        (default DEFAULT_GET_MANY_INFLIGHT) run at once, and fetched blocks
+        that haven't been consumed yet are limited to `max_bytes` (default
+        the block cache size, so blocks aren't evicted before they're
+        used).  Repeated locators, and blocks that other threads are already
+        fetching, are only downloaded once.
+
+        If a block can't be read, the iterator raises the error from get()
+        when it reaches that block.
+        """
+        if max_inflight is None:
+            max_inflight = self.DEFAULT_GET_MANY_INFLIGHT
+        if max_bytes is None:
+            max_bytes = self.block_cache.cache_max
+        return iter(_GetManyBatch(
+            lambda loc_s: self.get(loc_s, num_retries=num_retries),
+            list(locators), max_inflight, max_bytes))
+
     def refresh_signature(self, loc):
         """Ask Keep to get the remote block and return its local signature"""
         now = datetime.datetime.utcnow().isoformat("T") + 'Z'
         return self.head(loc, headers={'X-Keep-Signature': 'local, {}'.format(now)})
 
+    def refresh_signatures(self, locators, max_inflight=None):
+        """Ask Keep to get several remote blocks concurrently.
+
+        Returns a dict mapping each locator in `locators` to its local
+        signature, as returned by refresh_signature().  Each distinct
+        locator is requested once, with up to `max_inflight` (default
+        DEFAULT_GET_MANY_INFLIGHT) requests running at a time.  If a
+        request fails, its error is raised.
+        """
+        if max_inflight is None:
+            max_inflight = self.DEFAULT_GET_MANY_INFLIGHT
+        locators = sorted(set(locators))
+        # HEAD requests don't return data, so there is no memory budget.
+        return dict(zip(locators, _GetManyBatch(
+            self.refresh_signature, locators, max_inflight, float('inf'))))
+
     @retry.retry_method
     def head(self, loc_s, **kwargs):
         return self._get_or_head(loc_s, method="HEAD", **kwargs)
 
-    @retry.retry_method
     def get(self, loc_s, **kwargs):
+        """Get a block from Keep and return its content as bytes."""
+        return _as_bytes(self._get(loc_s, **kwargs))
+
+    @retry.retry_method
+    def _get(self, loc_s, **kwargs):
         return self._get_or_head(loc_s, method="GET", **kwargs)
 
     def _get_or_head(self, loc_s, method="GET", num_retries=None, request_id=None, headers=None):
@@ -1074,6 +1914,7 @@ class KeepClient(object):
         self.get_counter.add(1)
 
         slot = None
+        first = False
         blob = None
         try:
             locator = KeepLocator(loc_s)
@@ -1142,20 +1983,29 @@ class KeepClient(object):
                 services_to_try = [roots_map[root]
                                    for root in sorted_roots
                                    if roots_map[root].usable()]
-                for keep_service in services_to_try:
-                    blob = keep_service.get(locator, method=method, timeout=self.current_timeout(num_retries-tries_left))
-                    if blob is not None:
-                        break
+                timeout = self.current_timeout(num_retries-tries_left)
+                hedge_delay = self.current_hedge_delay() if method == "GET" else None
+                if hedge_delay is not None and len(services_to_try) > 1:
+                    blob = self._hedged_get(services_to_try, locator, timeout, hedge_delay)
+                else:
+                    for keep_service in services_to_try:
+                        blob = self._get_from_service(keep_service, locator, method, timeout)
+                        if blob is not None:
+                            break
                 loop.save_result((blob, len(services_to_try)))
 
             # Always cache the result, then return it if we succeeded.
             if loop.success():
                 return blob
         finally:
-            if slot is not None:
-                slot.set(blob)
-                self.block_cache.cap_cache()
+            if first:
+                self.block_cache.set(slot, blob)
+
+        raise self._read_error(loc_s, loop, roots_map, sorted_roots)
 
+    @staticmethod
+    def _read_error(loc_s, loop, roots_map, sorted_roots):
+        """Return the exception to raise after failing to read a block."""
         # Q: Including 403 is necessary for the Keep tests to continue
         # passing, but maybe they should expect KeepReadError instead?
         not_founds = sum(1 for key in sorted_roots
@@ -1163,28 +2013,32 @@ class KeepClient(object):
         service_errors = ((key, roots_map[key].last_result()['error'])
                           for key in sorted_roots)
         if not roots_map:
-            raise arvados.errors.KeepReadError(
+            return arvados.errors.KeepReadError(
                 "failed to read {}: no Keep services available ({})".format(
                     loc_s, loop.last_result()))
         elif not_founds == len(sorted_roots):
-            raise arvados.errors.NotFoundError(
+            return arvados.errors.NotFoundError(
                 "{} not found".format(loc_s), service_errors)
         else:
-            raise arvados.errors.KeepReadError(
+            return arvados.errors.KeepReadError(
                 "failed to read {} after {}".format(loc_s, loop.attempts_str()), service_errors, label="service")
 
     @retry.retry_method
-    def put(self, data, copies=2, num_retries=None, request_id=None, classes=[]):
+    def put(self, data, copies=2, num_retries=None, request_id=None, classes=[], data_hash=None):
         """Save data in Keep.
 
         This method will get a list of Keep services from the API server, and
-        send the data to each one simultaneously in a new thread.  Once the
+        send the data to each one simultaneously using the client's pool of
+        writer threads (see `writer_threads`).  Once the
         uploads are finished, if enough copies are saved, this method returns
         the most recent HTTP response body.  If requests fail to upload
         enough copies, this method raises KeepWriteError.
 
         Arguments:
-        * data: The string of data to upload.
+        * data: The data to upload: a string, or any object supporting
+          the buffer protocol (such as a bytearray or memoryview), which
+          is sent without being copied first.  A list of such buffers is
+          uploaded as one block holding their concatenation.
         * copies: The number of copies that the user requires be saved.
           Default 2.
         * num_retries: The number of times to retry PUT requests to
@@ -1193,14 +2047,19 @@ class KeepClient(object):
           KeepClient is initialized.
         * classes: An optional list of storage class names where copies should
           be written.
+        * data_hash: The MD5 hex digest of data, if the caller already
+          has it.  Saves hashing the data again here.
         """
 
-        if not isinstance(data, bytes):
-            data = data.encode()
+        data = _block_data(data)
 
         self.put_counter.add(1)
 
-        data_hash = hashlib.md5(data).hexdigest()
+        if data_hash is None:
+            if isinstance(data, _BlockChunks):
+                data_hash = data.md5().hexdigest()
+            else:
+                data_hash = hashlib.md5(data).hexdigest()
         loc_s = data_hash + '+' + str(len(data))
         if copies < 1:
             return loc_s
@@ -1236,7 +2095,8 @@ class KeepClient(object):
                                                         copies=copies - done_copies,
                                                         max_service_replicas=self.max_replicas_per_service,
                                                         timeout=self.current_timeout(num_retries - tries_left),
-                                                        classes=pending_classes)
+                                                        classes=pending_classes,
+                                                        workers=self._writer_workers)
             for service_root, ks in [(root, roots_map[root])
                                      for root in sorted_roots]:
                 if ks.finished():
@@ -1276,7 +2136,7 @@ class KeepClient(object):
                 "failed to write {} after {} (wanted {} copies but wrote {})".format(
                     data_hash, loop.attempts_str(), (copies, classes), writer_pool.done()), service_errors, label="service")
 
-    def local_store_put(self, data, copies=1, num_retries=None, classes=[]):
+    def local_store_put(self, data, copies=1, num_retries=None, classes=[], data_hash=None):
         """A stub for put().
 
         This method is used in place of the real put() method when
@@ -1288,10 +2148,17 @@ class KeepClient(object):
 
         Data stored this way can be retrieved via local_store_get().
         """
-        md5 = hashlib.md5(data).hexdigest()
+        data = _block_data(data)
+        if isinstance(data, _BlockChunks):
+            md5 = data_hash or data.md5().hexdigest()
+            chunks = data.chunks
+        else:
+            md5 = data_hash or hashlib.md5(data).hexdigest()
+            chunks = [data]
         locator = '%s+%d' % (md5, len(data))
         with open(os.path.join(self.local_store, md5 + '.tmp'), 'wb') as f:
-            f.write(data)
+            for chunk in chunks:
+                f.write(chunk)
         os.rename(os.path.join(self.local_store, md5 + '.tmp'),
                   os.path.join(self.local_store, md5))
         return locator
@@ -67,7 +67,7 @@ def mock_api_responses(api_client, body, codes, headers={}):
         (fake_httplib2_response(code, **headers), body) for code in codes)))
 
 def str_keep_locator(s):
-    return '{}+{}'.format(hashlib.md5(s if isinstance(s, bytes) else s.encode()).hexdigest(), len(s))
+    return '{}+{}'.format(hashlib.md5(s if isinstance(s, (bytes, bytearray, memoryview)) else s.encode()).hexdigest(), len(s))
 
 @contextlib.contextmanager
 def redirected_streams(stdout=None, stderr=None):
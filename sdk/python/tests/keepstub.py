@@ -22,25 +22,41 @@ _debug = os.environ.get('ARVADOS_DEBUG', None)
 
 
 class StubKeepServers(tutil.ApiClientMock):
+    # Number of stub servers to start.  self.server and self.port are
+    # the first one's.
+    STUB_SERVERS = 1
 
     def setUp(self):
         super(StubKeepServers, self).setUp()
-        sock = socket.socket()
-        sock.bind(('0.0.0.0', 0))
-        self.port = sock.getsockname()[1]
-        sock.close()
-        self.server = Server(('0.0.0.0', self.port), Handler)
-        self.thread = threading.Thread(target=self.server.serve_forever)
-        self.thread.daemon = True # Exit thread if main proc exits
-        self.thread.start()
+        self.servers = []
+        services = []
+        for i in range(self.STUB_SERVERS):
+            sock = socket.socket()
+            sock.bind(('0.0.0.0', 0))
+            port = sock.getsockname()[1]
+            sock.close()
+            server = Server(('0.0.0.0', port), Handler)
+            thread = threading.Thread(target=server.serve_forever)
+            thread.daemon = True # Exit thread if main proc exits
+            thread.start()
+            self.servers.append(server)
+            services.append({
+                'uuid': 'zzzzz-bi6l4-{:015x}'.format(i),
+                'owner_uuid': 'zzzzz-tpzed-000000000000000',
+                'service_host': 'localhost',
+                'service_port': port,
+                'service_ssl_flag': False,
+                'service_type': 'disk',
+                'read_only': False,
+            })
+        self.server = self.servers[0]
+        self.port = services[0]['service_port']
         self.api_client = self.mock_keep_services(
-            count=1,
-            service_host='localhost',
-            service_port=self.port,
-        )
+            count=0, additional_services=services)
 
     def tearDown(self):
-        self.server.shutdown()
+        for server in self.servers:
+            server.shutdown()
         super(StubKeepServers, self).tearDown()
 
 
@@ -0,0 +1,60 @@
+# Copyright (C) The Arvados Authors. All rights reserved.
+#
+# SPDX-License-Identifier: Apache-2.0
+
+from __future__ import absolute_import
+from __future__ import print_function
+from builtins import range
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+import arvados
+from .performance_profiler import profiled
+from .. import run_test_server
+
+class ApiStartupBenchmark(run_test_server.TestCaseWithServers):
+    MAIN_SERVER = {}
+    RUNS = 5
+    STARTUP = "import arvados; arvados.api('v1')"
+
+    def setUp(self):
+        super(ApiStartupBenchmark, self).setUp()
+        run_test_server.authorize_with('active')
+        self.home = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.home)
+        self.environ = os.environ.copy()
+        self.environ.update({
+            'HOME': self.home,
+            'PYTHONPATH': ':'.join(sys.path),
+            'ARVADOS_API_HOST': arvados.config.settings()['ARVADOS_API_HOST'],
+            'ARVADOS_API_TOKEN': arvados.config.settings()['ARVADOS_API_TOKEN'],
+            'ARVADOS_API_HOST_INSECURE': 'true',
+        })
+
+    def time_startup(self, code):
+        t0 = time.time()
+        subprocess.check_call([sys.executable, '-c', code], env=self.environ)
+        return time.time() - t0
+
+    @profiled
+    def test_api_startup(self):
+        import_secs = min(self.time_startup("import arvados")
+                          for _ in range(self.RUNS))
+        cold_secs = self.time_startup(self.STARTUP)
+        warm_secs = min(self.time_startup(self.STARTUP)
+                        for _ in range(self.RUNS))
+        print("import arvados %.3fs, arvados.api(): cold cache %.3fs, warm cache %.3fs" %
+              (import_secs, cold_secs - import_secs, warm_secs - import_secs))
+
+    @profiled
+    def test_api_clients_in_process(self):
+        arvados.api('v1')
+        t0 = time.time()
+        for _ in range(self.RUNS):
+            arvados.api('v1')
+        print("arvados.api() in a running process: %.1f msec" %
+              ((time.time() - t0) / self.RUNS * 1e3))
@@ -0,0 +1,62 @@
+# Copyright (C) The Arvados Authors. All rights reserved.
+#
+# SPDX-License-Identifier: Apache-2.0
+
+from __future__ import absolute_import
+from __future__ import print_function
+from builtins import range
+import random
+import time
+import unittest
+
+import mock
+
+import arvados
+from arvados._ranges import SegmentIndex, replace_range
+from .performance_profiler import profiled
+
+class DiscardingKeep(object):
+    """Accepts blocks without keeping them."""
+    def put(self, data, num_retries=None, copies=None, classes=[], data_hash=None):
+        return "%s+%d" % (data_hash, len(data))
+
+class RandomWritesBenchmark(unittest.TestCase):
+    WRITES = 100000
+    WRITE_SIZE = 4096
+    FILE_SIZE = 2**30
+
+    def setUp(self):
+        rand = random.Random(1)
+        self.offsets = [rand.randrange(0, self.FILE_SIZE // self.WRITE_SIZE) * self.WRITE_SIZE
+                        for _ in range(self.WRITES)]
+
+    def time_replace_range(self, segments):
+        replace_range(segments, 0, self.FILE_SIZE, 'base', 0)
+        t0 = time.time()
+        for i, offset in enumerate(self.offsets):
+            replace_range(segments, offset, self.WRITE_SIZE, 'new', i * self.WRITE_SIZE)
+        return time.time() - t0, len(segments)
+
+    @profiled
+    def test_replace_range_list_vs_index(self):
+        list_secs, list_segs = self.time_replace_range([])
+        index_secs, index_segs = self.time_replace_range(SegmentIndex())
+        print("%d random writes: list %.2fs, SegmentIndex %.2fs, %d segments" %
+              (self.WRITES, list_secs, index_secs, index_segs))
+        self.assertEqual(list_segs, index_segs)
+        self.assertLess(index_secs, list_secs)
+
+    @profiled
+    def test_random_4k_writes(self):
+        with arvados.collection.Collection(keep_client=DiscardingKeep(),
+                                           api_client=mock.MagicMock()) as c:
+            f = c.open("random.db", "wb")
+            f.arvadosfile.truncate(self.FILE_SIZE)
+            data = b'x' * self.WRITE_SIZE
+            t0 = time.time()
+            for offset in self.offsets:
+                f.arvadosfile.writeto(offset, data, 0)
+            secs = time.time() - t0
+            print("%d random %d byte writes: %.1f usec/write, %d segments" %
+                  (self.WRITES, self.WRITE_SIZE, secs / self.WRITES * 1e6,
+                   len(f.arvadosfile.segments())))
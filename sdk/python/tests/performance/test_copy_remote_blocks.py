@@ -0,0 +1,45 @@
+# Copyright (C) The Arvados Authors. All rights reserved.
+#
+# SPDX-License-Identifier: Apache-2.0
+
+from __future__ import absolute_import
+from __future__ import print_function
+from builtins import range
+import hashlib
+import time
+import unittest
+
+import mock
+
+import arvados
+from .performance_profiler import profiled
+
+class CopyRemoteBlocksBenchmark(unittest.TestCase):
+    BLOCKS = 1000
+    FILES_PER_BLOCK = 4
+    # Round trip time of one HEAD request to the local Keep service.
+    LATENCY = 0.005
+
+    def slow_refresh_signature(self, loc):
+        time.sleep(self.LATENCY)
+        return loc.replace('+Rzzzzz-', '+A')
+
+    @profiled
+    def test_copy_remote_blocks(self):
+        sig = '+Rzzzzz-' + 'a' * 40 + '@abcdef01'
+        blocks = ["%s+1024%s" % (hashlib.md5(b"%d" % b).hexdigest(), sig)
+                  for b in range(self.BLOCKS)]
+        files = ["%d:256:file%d" % (f * 256, f)
+                 for f in range(self.BLOCKS * self.FILES_PER_BLOCK)]
+        coll = arvados.collection.Collection(
+            ". %s %s\n" % (" ".join(blocks), " ".join(files)),
+            api_client=mock.MagicMock(),
+            keep_client=arvados.KeepClient(api_client=mock.MagicMock()))
+        with mock.patch('arvados.keep.KeepClient.refresh_signature',
+                        side_effect=self.slow_refresh_signature) as rs_mock:
+            t0 = time.time()
+            coll._copy_remote_blocks(remote_blocks={})
+            secs = time.time() - t0
+        print("%d remote blocks in %d files: copied in %.2fs" %
+              (self.BLOCKS, len(files), secs))
+        self.assertEqual(self.BLOCKS, rs_mock.call_count)
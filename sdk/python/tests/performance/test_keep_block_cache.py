@@ -0,0 +1,44 @@
+# Copyright (C) The Arvados Authors. All rights reserved.
+#
+# SPDX-License-Identifier: Apache-2.0
+
+from __future__ import absolute_import
+from __future__ import division
+from builtins import range
+import hashlib
+import timeit
+import unittest
+
+import arvados.keep
+from .performance_profiler import profiled
+
+class KeepBlockCacheBenchmark(unittest.TestCase):
+    HITS = 20000
+
+    def make_cache(self, nslots):
+        cache = arvados.keep.KeepBlockCache(cache_max=nslots)
+        locators = [hashlib.md5(str(i).encode()).hexdigest()
+                    for i in range(nslots)]
+        for loc in locators:
+            slot, _ = cache.reserve_cache(loc)
+            cache.set(slot, b'x')
+        return cache, locators
+
+    def time_hits(self, nslots):
+        cache, locators = self.make_cache(nslots)
+        # Look up the least recently used slot each time, which was
+        # the worst case for the old list-based cache.
+        def hit():
+            for i in range(self.HITS):
+                cache.get(locators[i % nslots])
+        return min(timeit.repeat(hit, number=1, repeat=3)) / self.HITS
+
+    @profiled
+    def test_hit_latency_flat_as_slot_count_grows(self):
+        small = self.time_hits(16)
+        large = self.time_hits(16384)
+        print("KeepBlockCache hit: %.2f usec (16 slots), %.2f usec (16384 slots)" %
+              (small * 1e6, large * 1e6))
+        # A linear scan would be ~1000x slower here; allow generous
+        # headroom for noisy test hosts.
+        self.assertLess(large, small * 5)
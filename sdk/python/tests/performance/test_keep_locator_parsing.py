@@ -0,0 +1,68 @@
+# Copyright (C) The Arvados Authors. All rights reserved.
+#
+# SPDX-License-Identifier: Apache-2.0
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from builtins import range
+import hashlib
+import time
+import unittest
+
+import mock
+
+import arvados
+from arvados.keep import KeepLocator
+from .performance_profiler import profiled
+
+class KeepLocatorBenchmark(unittest.TestCase):
+    SEGMENTS = 1000000
+    STREAMS = 1000
+    BLOCKS_PER_STREAM = 4
+    BLOCK_SIZE = 2**19
+    FILES_PER_STREAM = 10
+
+    def setUp(self):
+        signature = "+A" + "f" * 40 + "@5f612ee4"
+        segments_per_file = self.SEGMENTS // self.STREAMS // self.FILES_PER_STREAM
+        self.locators = []
+        streams = []
+        for s in range(self.STREAMS):
+            blocks = ["%s+%d%s" % (hashlib.md5(b"%d/%d" % (s, b)).hexdigest(),
+                                   self.BLOCK_SIZE, signature)
+                      for b in range(self.BLOCKS_PER_STREAM)]
+            # Every other KiB of the stream, so no segments are merged.
+            files = ["%d:1024:file%d" % ((seg * self.FILES_PER_STREAM + f) * 2048, f)
+                     for f in range(self.FILES_PER_STREAM)
+                     for seg in range(segments_per_file)]
+            streams.append("./dir%d %s %s\n" % (s, " ".join(blocks), " ".join(files)))
+            self.locators.extend(blocks[(i * 2048) // self.BLOCK_SIZE]
+                                 for i in range(self.SEGMENTS // self.STREAMS))
+        self.manifest = "".join(streams)
+
+    @profiled
+    def test_parse_locators(self):
+        t0 = time.time()
+        sizes = sum(KeepLocator(loc).size for loc in self.locators)
+        stripped = set(KeepLocator(loc).stripped() for loc in self.locators)
+        secs = time.time() - t0
+        print("%d locators: parsed twice in %.2fs, %.2f usec/parse" %
+              (len(self.locators), secs, secs / len(self.locators) / 2 * 1e6))
+        self.assertEqual(self.STREAMS * self.BLOCKS_PER_STREAM, len(stripped))
+
+    @profiled
+    def test_render_and_check_manifest(self):
+        coll = arvados.collection.Collection(self.manifest,
+                                             api_client=mock.MagicMock(),
+                                             keep_client=mock.MagicMock())
+        t0 = time.time()
+        manifest = coll.portable_manifest_text()
+        rendered = time.time()
+        expired = [f for s in coll.values() for f in s.values()
+                   if f.permission_expired()]
+        checked = time.time()
+        print("%d segment manifest: rendered in %.2fs, permissions checked in %.2fs" %
+              (self.SEGMENTS, rendered - t0, checked - rendered))
+        self.assertEqual(self.STREAMS * self.FILES_PER_STREAM, len(expired))
+        self.assertNotIn("+A", manifest)
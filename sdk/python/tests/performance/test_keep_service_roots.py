@@ -0,0 +1,58 @@
+# Copyright (C) The Arvados Authors. All rights reserved.
+#
+# SPDX-License-Identifier: Apache-2.0
+
+from __future__ import absolute_import
+from __future__ import division
+from builtins import range
+import hashlib
+import timeit
+import unittest
+
+import arvados
+from .performance_profiler import profiled
+from .. import arvados_testutil as tutil
+
+class KeepServiceRootsBenchmark(unittest.TestCase, tutil.ApiClientMock):
+    BLOCKS = 100
+    REQUESTS = 500
+
+    def time_requests(self, nservices, repeat_blocks, map_services=False):
+        keep_client = arvados.KeepClient(
+            api_client=self.mock_keep_services(count=nservices))
+        locators = [
+            arvados.KeepLocator(hashlib.md5(str(i).encode()).hexdigest())
+            for i in range(self.REQUESTS)]
+        if repeat_blocks:
+            # Warm the probe order cache with a working set of blocks
+            # and read them over and over.
+            locators = [locators[i % self.BLOCKS] for i in range(self.REQUESTS)]
+            for loc in locators[:self.BLOCKS]:
+                keep_client.weighted_service_roots(loc)
+        if map_services:
+            def requests():
+                for loc in locators:
+                    keep_client.map_new_services({}, loc, False, False, {})
+        else:
+            def requests():
+                for loc in locators:
+                    keep_client.weighted_service_roots(loc)
+        if repeat_blocks:
+            setup = 'pass'
+        else:
+            setup = keep_client._probe_order_cache.clear
+        return min(timeit.repeat(requests, setup=setup, number=1, repeat=3)) / self.REQUESTS
+
+    @profiled
+    def test_per_request_overhead_by_service_count(self):
+        for nservices in (8, 64, 512):
+            cold = self.time_requests(nservices, repeat_blocks=False)
+            warm = self.time_requests(nservices, repeat_blocks=True)
+            mapped = self.time_requests(nservices, repeat_blocks=True,
+                                        map_services=True)
+            print("%d services: probe order %.1f usec uncached, %.1f usec cached; "
+                  "%.1f usec including map_new_services" %
+                  (nservices, cold * 1e6, warm * 1e6, mapped * 1e6))
+        # Skipping the per-service md5 and sort must pay off when there
+        # are many services.
+        self.assertLess(warm * 2, cold)
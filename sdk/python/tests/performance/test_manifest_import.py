@@ -0,0 +1,126 @@
+# Copyright (C) The Arvados Authors. All rights reserved.
+#
+# SPDX-License-Identifier: Apache-2.0
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from builtins import range
+import hashlib
+import os
+import time
+import unittest
+
+import mock
+
+import arvados
+from .performance_profiler import profiled
+
+class ManifestImportBenchmark(unittest.TestCase):
+    FILES_PER_STREAM = 1000
+    BLOCKS_PER_STREAM = 4
+    FILE_COUNTS = [10000]
+    # The larger manifests need several GiB of memory to load.
+    if os.environ.get('ARVADOS_LARGE_BENCHMARKS'):
+        FILE_COUNTS += [1000000, 10000000]
+
+    def make_manifest(self, nfiles):
+        signature = "+A" + "f" * 40 + "@5f612ee4"
+        filesize = 64 * 2**20 * self.BLOCKS_PER_STREAM // self.FILES_PER_STREAM
+        streams = []
+        for s in range(nfiles // self.FILES_PER_STREAM):
+            blocks = ["%s+%d%s" % (hashlib.md5(b"%d/%d" % (s, b)).hexdigest(),
+                                   64 * 2**20, signature)
+                      for b in range(self.BLOCKS_PER_STREAM)]
+            files = ["%d:%d:file\\040%d.dat" % (f * filesize, filesize, f)
+                     for f in range(self.FILES_PER_STREAM)]
+            streams.append("./dir%d %s %s\n" % (s, " ".join(blocks), " ".join(files)))
+        return "".join(streams)
+
+    @profiled
+    def test_import_manifest(self):
+        for nfiles in self.FILE_COUNTS:
+            manifest = self.make_manifest(nfiles)
+            t0 = time.time()
+            coll = arvados.collection.Collection(manifest,
+                                                 api_client=mock.MagicMock(),
+                                                 keep_client=mock.MagicMock())
+            secs = time.time() - t0
+            print("%d files, %.1f MiB manifest: loaded in %.2fs, %.1f usec/file" %
+                  (nfiles, len(manifest) / 2**20, secs, secs / nfiles * 1e6))
+            self.assertEqual(self.FILES_PER_STREAM, len(coll.find("dir0")))
+            del coll
+
+    @profiled
+    def test_lazy_import_manifest(self):
+        for nfiles in self.FILE_COUNTS:
+            manifest = self.make_manifest(nfiles)
+            t0 = time.time()
+            coll = arvados.collection.CollectionReader(manifest,
+                                                       api_client=mock.MagicMock(),
+                                                       keep_client=mock.MagicMock(),
+                                                       lazy=True)
+            loaded = time.time()
+            self.assertIsNotNone(coll.find("dir0/file 0.dat"))
+            found = time.time()
+            print("%d files, %.1f MiB manifest: lazy load %.2fs, first lookup %.3fs" %
+                  (nfiles, len(manifest) / 2**20, loaded - t0, found - loaded))
+            del coll
+
+    @profiled
+    def test_manifest_text_after_small_change(self):
+        for nfiles in self.FILE_COUNTS:
+            coll = arvados.collection.Collection(self.make_manifest(nfiles),
+                                                 api_client=mock.MagicMock(),
+                                                 keep_client=mock.MagicMock())
+            t0 = time.time()
+            manifest = coll.portable_manifest_text()
+            first = time.time()
+            coll.copy("dir0/file 0.dat", "dir1/copy.dat")
+            changed = time.time()
+            self.assertNotEqual(manifest, coll.portable_manifest_text())
+            again = time.time()
+            print("%d files: manifest_text %.2fs, after one change %.3fs" %
+                  (nfiles, first - t0, again - changed))
+            del coll
+
+    @profiled
+    def test_update_after_small_change(self):
+        for nfiles in self.FILE_COUNTS:
+            manifest = self.make_manifest(nfiles)
+            coll = arvados.collection.Collection(manifest,
+                                                 api_client=mock.MagicMock(),
+                                                 keep_client=mock.MagicMock())
+            changed = manifest.replace("file\\040%d.dat" % (self.FILES_PER_STREAM - 1),
+                                       "renamed.dat", 1)
+            other = arvados.collection.CollectionReader(changed,
+                                                        api_client=mock.MagicMock(),
+                                                        keep_client=mock.MagicMock(),
+                                                        lazy=True)
+            # Render once, as the first save or update does.
+            coll.manifest_text(normalize=True)
+            t0 = time.time()
+            coll.update(other)
+            secs = time.time() - t0
+            print("%d files: update after one rename %.3fs" % (nfiles, secs))
+            self.assertIsNotNone(coll.find("dir0/renamed.dat"))
+            del coll
+
+    @profiled
+    def test_refresh_signatures(self):
+        for nfiles in self.FILE_COUNTS:
+            manifest = self.make_manifest(nfiles)
+            api = mock.MagicMock()
+            api.collections().get().execute.return_value = {
+                "manifest_text": manifest.replace("@5f612ee4", "@5f700000")}
+            coll = arvados.collection.Collection(manifest,
+                                                 api_client=api,
+                                                 keep_client=mock.MagicMock())
+            coll._manifest_locator = "zzzzz-4zz18-zzzzzzzzzzzzzzz"
+            coll.manifest_text()
+            t0 = time.time()
+            coll.refresh_signatures()
+            secs = time.time() - t0
+            print("%d files: refresh_signatures %.3fs" % (nfiles, secs))
+            self.assertIn("@5f700000", coll.find("dir0/file 0.dat").segments()[0].locator)
+            del coll
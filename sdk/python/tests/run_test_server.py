@@ -282,8 +282,9 @@ def run(leave_running_atexit=False):
     # be able to tolerate that.
     for fn in glob.glob(os.path.join(
             str(arvados.http_cache('discovery')),
-            '*,arvados,v1,rest,*')):
+            '*.tmp')):
         os.unlink(fn)
+    sys.modules['arvados.api']._discovery_docs.clear()
 
     pid_file = _pidfile('api')
     pid_file_ok = find_server_pid(pid_file, 0)
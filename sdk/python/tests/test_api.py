@@ -12,8 +12,12 @@ import itertools
 import json
 import mimetypes
 import os
+import shutil
 import socket
 import string
+import tempfile
+import threading
+import time
 import unittest
 
 import mock
@@ -21,7 +25,7 @@ from . import run_test_server
 
 from apiclient import errors as apiclient_errors
 from apiclient import http as apiclient_http
-from arvados.api import OrderedJsonModel, RETRY_DELAY_INITIAL, RETRY_DELAY_BACKOFF, RETRY_COUNT
+from arvados.api import OrderedJsonModel, RETRY_DELAY_INITIAL, RETRY_DELAY_BACKOFF, RETRY_COUNT, DISCOVERY_REFRESH_AGE, _discovery_docs, _discovery_refreshing, _discovery_cache_key, http_cache
 from .arvados_testutil import fake_httplib2_response, queue_with
 
 if not mimetypes.inited:
@@ -224,5 +228,92 @@ class RetryREST(unittest.TestCase):
         self.assertEqual(sleep.call_args_list, [])
 
 
+class DiscoveryCacheTest(unittest.TestCase):
+    DISCOVERY_URL = 'https://zzzzz.example/discovery/v1/apis/arvados/v1/rest'
+
+    def discovery_document(self, revision):
+        return json.dumps({
+            'rootUrl': 'https://zzzzz.example/',
+            'servicePath': 'arvados/v1/',
+            'revision': revision,
+            'resources': {'collections': {'methods': {'get': {
+                'id': 'arvados.collections.get',
+                'path': 'collections/{uuid}',
+                'httpMethod': 'GET',
+                'parameters': {'uuid': {'type': 'string',
+                                        'required': True,
+                                        'location': 'path'}},
+            }}}},
+            'schemas': {},
+        }).encode()
+
+    def setUp(self):
+        self.home = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.home)
+        for patcher in [mock.patch.dict(os.environ, {'HOME': self.home}),
+                        mock.patch.dict(_discovery_docs, clear=True)]:
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def api(self, *revisions, **kwargs):
+        with mock.patch('httplib2.Http.request', side_effect=[
+                (fake_httplib2_response(200), self.discovery_document(rev))
+                for rev in revisions]) as req:
+            svc = arvados.api('v1', host='zzzzz.example', token='xyzzy', **kwargs)
+        self.assertEqual(len(revisions), req.call_count)
+        return svc
+
+    def test_discovery_document_shared_by_clients(self):
+        clients = [self.api('1'), self.api()]
+        self.assertIsNot(*clients)
+        for svc in clients:
+            self.assertEqual('1', svc._rootDesc['revision'])
+            self.assertTrue(hasattr(svc.collections(), 'get'))
+
+    def test_discovery_document_cached_on_disk(self):
+        self.api('1')
+        _discovery_docs.clear()
+        self.assertEqual('1', self.api()._rootDesc['revision'])
+
+    def test_no_discovery_cache(self):
+        self.api('1', cache=False)
+        self.assertEqual('2', self.api('2', cache=False)._rootDesc['revision'])
+
+    def test_discovery_document_cached_as_json(self):
+        self.api('1')
+        cached = json.loads(http_cache('discovery').get(
+            _discovery_cache_key(self.DISCOVERY_URL)).decode())
+        self.assertEqual('1', json.loads(cached['document'])['revision'])
+
+    def test_unreadable_disk_cache_ignored(self):
+        http_cache('discovery').set(
+            _discovery_cache_key(self.DISCOVERY_URL), b'\x80\x02}q\x00.')
+        self.assertEqual('1', self.api('1')._rootDesc['revision'])
+
+    def test_stale_discovery_document_refreshed_in_background(self):
+        self.api('1')
+        fetched_at, doc = _discovery_docs[self.DISCOVERY_URL]
+        _discovery_docs[self.DISCOVERY_URL] = (
+            fetched_at - DISCOVERY_REFRESH_AGE - 1, doc)
+        refreshed = threading.Event()
+        with mock.patch('httplib2.Http.request', side_effect=lambda *args, **kwargs: (
+                refreshed.wait(10) and
+                (fake_httplib2_response(200), self.discovery_document('2')))) as req:
+            svc = arvados.api('v1', host='zzzzz.example', token='xyzzy')
+            self.assertEqual('1', svc._rootDesc['revision'])
+            # A second client doesn't start another refresh.
+            arvados.api('v1', host='zzzzz.example', token='xyzzy')
+            self.assertEqual(1, req.call_count)
+            self.assertEqual([self.DISCOVERY_URL], list(_discovery_refreshing))
+            # Exiting doesn't wait for the refresh.
+            self.assertTrue(_discovery_refreshing[self.DISCOVERY_URL].daemon)
+            refreshed.set()
+            for _ in range(100):
+                if self.DISCOVERY_URL not in _discovery_refreshing:
+                    break
+                time.sleep(0.05)
+        self.assertEqual('2', self.api()._rootDesc['revision'])
+
+
 if __name__ == '__main__':
     unittest.main()
@@ -10,11 +10,13 @@ from builtins import object
 import datetime
 import mock
 import os
+import random
+import threading
 import unittest
 import time
 
 import arvados
-from arvados._ranges import Range
+from arvados._ranges import Range, BlockTable, SegmentIndex, locators_and_ranges, replace_range
 from arvados.keep import KeepLocator
 from arvados.collection import Collection
 from arvados.arvfile import ArvadosFile, ArvadosFileReader
@@ -33,7 +35,13 @@ class ArvadosFileWriterTestCase(unittest.TestCase):
         def get_from_cache(self, locator):
             self.requests.append(locator)
             return self.blocks.get(locator)
-        def put(self, data, num_retries=None, copies=None, classes=[]):
+        def read_block(self, locator, num_retries=0, cache_only=False):
+            if cache_only:
+                return self.get_from_cache(locator)
+            return self.get(locator, num_retries=num_retries)
+        def put(self, data, num_retries=None, copies=None, classes=[], data_hash=None):
+            if isinstance(data, list):
+                data = b''.join(bytes(d) for d in data)
             pdh = tutil.str_keep_locator(data)
             self.blocks[pdh] = bytes(data)
             return pdh
@@ -621,6 +629,99 @@ class ArvadosFileWriterTestCase(unittest.TestCase):
             self.assertEqual(b"01234567", keep.get("2e9ec317e197819358fbc43afca7d837+8"))
 
 
+class ReadAheadTestCase(unittest.TestCase):
+    def setUp(self):
+        self.ra = arvados.arvfile._ReadAhead(max_window=8 * arvados.config.KEEP_BLOCK_SIZE)
+
+    def test_window_grows_on_sequential_reads(self):
+        windows = []
+        offset = 0
+        for _ in range(12):
+            windows.append(self.ra.access(offset, 1000, []))
+            offset += 1000
+        min_window = self.ra.MIN_WINDOW
+        self.assertEqual(min_window, windows[0])
+        self.assertEqual(2 * min_window, windows[1])
+        self.assertEqual([8 * arvados.config.KEEP_BLOCK_SIZE] * 2, windows[-2:])
+
+    def test_forward_skip_within_window_is_sequential(self):
+        self.ra.access(0, 1000, [])
+        self.assertEqual(2 * self.ra.MIN_WINDOW, self.ra.access(5000, 1000, []))
+
+    def test_out_of_order_reads_keep_window(self):
+        self.ra.access(0, 1000, [])
+        self.ra.access(2000, 1000, [])
+        # The read of 1000-2000 arrives late.
+        self.assertEqual(2 * self.ra.MIN_WINDOW, self.ra.access(1000, 1000, []))
+        self.assertEqual(4 * self.ra.MIN_WINDOW, self.ra.access(3000, 1000, []))
+
+    def test_random_read_turns_readahead_off(self):
+        self.ra.access(0, 1000, [])
+        self.ra.access(1000, 1000, [])
+        self.assertEqual(0, self.ra.access(10 * arvados.config.KEEP_BLOCK_SIZE, 1000, []))
+        self.assertEqual(0, self.ra.access(0, 1000, []))
+
+    def test_hits_and_waste(self):
+        self.ra.access(0, 1000, [])
+        for loc in 'abc':
+            self.assertTrue(self.ra.should_prefetch(loc))
+            self.ra.add_prefetch(loc)
+        self.assertFalse(self.ra.should_prefetch('a'))
+        self.ra.add_prefetch('a')
+        self.ra.access(1000, 1000, ['a'])
+        # A random read abandons the rest.
+        self.ra.access(10 * arvados.config.KEEP_BLOCK_SIZE, 1000, [])
+        stats = self.ra.stats()
+        self.assertEqual(3, stats['prefetched'])
+        self.assertEqual(1, stats['hits'])
+        self.assertEqual(2, stats['wasted'])
+        self.assertEqual(0, stats['outstanding'])
+        self.assertAlmostEqual(1.0 / 3, stats['hit_ratio'])
+        self.assertAlmostEqual(2.0 / 3, stats['waste_ratio'])
+
+
+class PrefetchQueueTestCase(unittest.TestCase):
+    def setUp(self):
+        self.q = arvados.arvfile._PrefetchQueue(maxsize=4)
+
+    def test_nearest_first(self):
+        self.q.put('c', 20)
+        self.q.put('a', 0)
+        self.q.put('b', 10)
+        self.assertEqual(['a', 'b', 'c'], [self.q.get() for _ in range(3)])
+
+    def test_duplicates_queued_once(self):
+        self.q.put('a', 10, owner='r1')
+        self.q.put('b', 5, owner='r1')
+        self.q.put('a', 0, owner='r2')
+        self.assertEqual(2, len(self.q))
+        self.assertEqual('a', self.q.get())
+        self.assertEqual('b', self.q.get())
+        self.assertEqual(0, len(self.q))
+
+    def test_bounded(self):
+        for loc in 'abcd':
+            self.assertTrue(self.q.put(loc))
+        self.assertFalse(self.q.put('e'))
+        self.assertTrue(self.q.put('a', -1))
+
+    def test_cancel(self):
+        self.q.put('a', 0, owner='r1')
+        self.q.put('b', 1, owner='r1')
+        self.q.put('b', 1, owner='r2')
+        self.q.put('c', 2, owner='r2')
+        self.q.cancel('r1')
+        self.assertEqual(2, len(self.q))
+        self.assertEqual('b', self.q.get())
+        self.q.cancel('r2')
+        self.assertEqual(0, len(self.q))
+
+    def test_get_after_close(self):
+        self.q.put('a')
+        self.q.close()
+        self.assertIsNone(self.q.get())
+
+
 class ArvadosFileReaderTestCase(StreamFileReaderTestCase):
     class MockParent(object):
         class MockBlockMgr(object):
@@ -628,9 +729,15 @@ class ArvadosFileReaderTestCase(StreamFileReaderTestCase):
                 self.blocks = blocks
                 self.nocache = nocache
 
-            def block_prefetch(self, loc):
+            def block_prefetch(self, loc, priority=0, owner=None):
+                pass
+
+            def cancel_prefetch(self, owner):
                 pass
 
+            def max_readahead(self):
+                return None
+
             def get_block_contents(self, loc, num_retries=0, cache_only=False):
                 if self.nocache and cache_only:
                     return None
@@ -647,6 +754,12 @@ class ArvadosFileReaderTestCase(StreamFileReaderTestCase):
         def _my_block_manager(self):
             return ArvadosFileReaderTestCase.MockParent.MockBlockMgr(self.blocks, self.nocache)
 
+        def _my_block_table(self):
+            return BlockTable()
+
+        def _invalidate_manifest_cache(self):
+            pass
+
 
     def make_count_reader(self, nocache=False):
         stream = []
@@ -691,6 +804,62 @@ class ArvadosFileReaderTestCase(StreamFileReaderTestCase):
         self.assertIn("2e9ec317e197819358fbc43afca7d837+8", keep.requests)
         self.assertIn("e8dc4081b13434b45189a720b77b6818+8", keep.requests)
 
+    def make_blocks_collection(self, keep, nblocks):
+        blocks = [(str(i) * 8).encode() for i in range(nblocks)]
+        locs = [tutil.str_keep_locator(b) for b in blocks]
+        keep.blocks.update(zip(locs, blocks))
+        return Collection(". {} 0:{}:count.txt\n".format(" ".join(locs), 8 * nblocks),
+                          api_client=ArvadosFileWriterTestCase.MockApi(None, None),
+                          keep_client=keep), locs
+
+    class CachingKeep(ArvadosFileWriterTestCase.MockKeep):
+        """MockKeep whose cache only has blocks that were fetched."""
+        def __init__(self, blocks):
+            super(ArvadosFileReaderTestCase.CachingKeep, self).__init__(blocks)
+            self.cached = set()
+        def get(self, locator, num_retries=0):
+            self.cached.add(locator)
+            return super(ArvadosFileReaderTestCase.CachingKeep, self).get(locator, num_retries)
+        def get_from_cache(self, locator):
+            if locator in self.cached:
+                return self.blocks.get(locator)
+            return None
+
+    def test_readahead_sequential_reads(self):
+        keep = self.CachingKeep({})
+        c, locs = self.make_blocks_collection(keep, 6)
+        with c:
+            r = c.open("count.txt", "rb")
+            for i in range(6):
+                self.assertEqual((str(i) * 8).encode(), r.read(8))
+            stats = r.readahead_stats()
+        self.assertEqual(5, stats['prefetched'])
+        self.assertEqual(5, stats['hits'])
+        self.assertEqual(0, stats['wasted'])
+        self.assertEqual(1.0, stats['hit_ratio'])
+
+    def test_readahead_does_not_count_cached_blocks(self):
+        keep = ArvadosFileWriterTestCase.MockKeep({})
+        c, locs = self.make_blocks_collection(keep, 6)
+        with c:
+            r = c.open("count.txt", "rb")
+            for i in range(6):
+                self.assertEqual((str(i) * 8).encode(), r.read(8))
+            stats = r.readahead_stats()
+        self.assertEqual(0, stats['prefetched'])
+        self.assertEqual(0.0, stats['waste_ratio'])
+
+    def test_readahead_off_for_random_reads(self):
+        keep = ArvadosFileWriterTestCase.MockKeep({})
+        c, locs = self.make_blocks_collection(keep, 6)
+        with mock.patch('arvados.arvfile._BlockManager.block_prefetch') as prefetch, c:
+            r = c.open("count.txt", "rb")
+            for offset in (40, 8, 24):
+                r.seek(offset)
+                self.assertEqual((str(offset // 8) * 4).encode(), r.read(4))
+            self.assertEqual(0, prefetch.call_count)
+            self.assertEqual(0, r.readahead_stats()['window'])
+
     def test__eq__from_manifest(self):
         with Collection('. 781e5e245d69b566979b86e28d23f2c7+10 0:10:count1.txt') as c1:
             with Collection('. 781e5e245d69b566979b86e28d23f2c7+10 0:10:count1.txt') as c2:
@@ -782,7 +951,227 @@ class ArvadosFileTestCase(unittest.TestCase):
             self.assertFalse(f.permission_expired(a_month_ago))
 
 
+class SegmentIndexTestCase(unittest.TestCase):
+    def setUp(self):
+        # Use tiny chunks so a few hundred segments exercise chunk
+        # splits and merges.
+        self.orig_load = SegmentIndex.LOAD
+        SegmentIndex.LOAD = 4
+
+    def tearDown(self):
+        SegmentIndex.LOAD = self.orig_load
+
+    def check_chunks(self, index):
+        self.assertEqual(list(index), [index[i] for i in range(len(index))])
+        rows = 0
+        for k, chunk in enumerate(index._chunks):
+            self.assertEqual(chunk[0::4], index._starts[k])
+            self.assertEqual(chunk[0], index._firsts[k])
+            self.assertEqual(rows, index._rows[k])
+            self.assertLessEqual(len(index._starts[k]), 2 * SegmentIndex.LOAD)
+            rows += len(index._starts[k])
+        self.assertEqual(len(index), rows)
+
+    def test_random_writes(self):
+        # Check against a model recording which block byte backs each
+        # file byte.
+        rand = random.Random(1)
+        index = SegmentIndex()
+        model = []
+        for i in range(300):
+            start = rand.randint(0, len(model))
+            size = rand.randint(1, 40)
+            offset = rand.randint(0, 100)
+            replace_range(index, start, size, "b%d" % i, offset)
+            model[start:start+size] = [("b%d" % i, offset + n) for n in range(size)]
+            self.check_chunks(index)
+        expanded = []
+        for r in index:
+            self.assertEqual(len(expanded), r.range_start)
+            self.assertGreater(r.range_size, 0)
+            expanded.extend((r.locator, r.segment_offset + n) for n in range(r.range_size))
+        self.assertEqual(model, expanded)
+        for _ in range(100):
+            start = rand.randint(0, len(model))
+            size = rand.randint(0, 100)
+            expanded = []
+            for lr in locators_and_ranges(index, start, size):
+                expanded.extend((lr.locator, lr.segment_offset + n) for n in range(lr.segment_size))
+            self.assertEqual(model[start:start+size], expanded)
+
+    def test_small_chunks_merged(self):
+        index = SegmentIndex([Range("b%d" % i, i * 10, 10) for i in range(100)])
+        self.assertEqual(25, len(index._chunks))
+        # Overwrite all but the first and last segments' ends.
+        replace_range(index, 5, 990, "c", 0)
+        self.assertEqual(3, len(index))
+        self.assertEqual(1, len(index._chunks))
+        self.check_chunks(index)
+        self.assertEqual(Range("c", 5, 990), index[1])
+
+    def test_truncate(self):
+        index = SegmentIndex([Range("b%d" % i, i * 10, 10) for i in range(20)])
+        index.truncate(55)
+        self.assertEqual(6, len(index))
+        self.assertEqual(Range("b5", 50, 5), index[-1])
+        index.truncate(50)
+        self.assertEqual(5, len(index))
+        self.assertEqual(Range("b4", 40, 10), index[-1])
+        index.truncate(0)
+        self.assertEqual([], list(index))
+
+    def test_block_table_shared(self):
+        blocks = BlockTable()
+        index1 = SegmentIndex([Range("a", 0, 10), Range("b", 10, 10)], blocks=blocks)
+        index2 = SegmentIndex([Range("b", 0, 5, 5), Range("a", 5, 5)], blocks=blocks)
+        self.assertEqual(2, len(blocks))
+        self.assertEqual(["a", "b"], index1.locators())
+        self.assertEqual(["b", "a"], index2.locators())
+        self.assertEqual(Range("b", 0, 5, 5), index2[0])
+
+    def test_remap_locators(self):
+        index = SegmentIndex([Range("a", 0, 10), Range("b", 10, 10), Range("a", 20, 10, 10)])
+        calls = []
+        def remap(loc):
+            calls.append(loc)
+            return "c" if loc == "a" else None
+        self.assertTrue(index.remap_locators(remap))
+        self.assertEqual(["a", "b"], calls)
+        self.assertEqual([Range("c", 0, 10), Range("b", 10, 10), Range("c", 20, 10, 10)],
+                         list(index))
+        self.assertFalse(index.remap_locators(lambda loc: None))
+
+    def test_pack_block(self):
+        index = SegmentIndex([Range("a", 0, 10, 30), Range("b", 10, 10), Range("a", 20, 5, 0)])
+        self.assertEqual([(30, 10), (0, 5)], index.pack_block("a"))
+        self.assertEqual([Range("a", 0, 10, 0), Range("b", 10, 10), Range("a", 20, 5, 10)],
+                         list(index))
+        self.assertEqual([], index.pack_block("z"))
+
+    def test_rebind(self):
+        old = BlockTable()
+        index = SegmentIndex([Range("b%d" % i, i, 1) for i in range(5)], blocks=old)
+        index.remap_locators(lambda loc: "new" + loc)
+        self.assertEqual(10, len(old))
+        new = BlockTable()
+        segs = list(index)
+        index.rebind(new)
+        self.assertEqual(5, len(new))
+        self.assertEqual(segs, list(index))
+
+
+class BufferPoolTestCase(unittest.TestCase):
+    def setUp(self):
+        self.pool = arvados.arvfile._BufferPool(budget=2**20, retain=2**20)
+
+    def test_buffers_reused(self):
+        buf = self.pool.acquire(1000)
+        self.assertEqual(2**14, len(buf))
+        self.pool.release(buf)
+        self.assertIs(buf, self.pool.acquire(2**14))
+        self.assertEqual(1, self.pool.stats()['reused'])
+
+    def test_not_reused_if_still_read(self):
+        buf = self.pool.acquire(1000)
+        self.pool.release(buf, reuse=False)
+        self.assertIsNot(buf, self.pool.acquire(1000))
+        self.assertEqual(2**14, self.pool.stats()['in_use'])
+
+    def test_waits_for_upload(self):
+        bufs = [self.pool.acquire(2**19) for _ in range(2)]
+        self.pool.upload_started()
+        t = threading.Thread(target=self.pool.wait_for_room, args=(2**19,))
+        t.start()
+        t.join(0.1)
+        self.assertTrue(t.is_alive())
+        self.pool.release(bufs[0])
+        self.pool.upload_finished()
+        t.join(5)
+        self.assertFalse(t.is_alive())
+        self.assertIs(bufs[0], self.pool.acquire(2**19))
+        self.assertEqual(1, self.pool.stats()['waits'])
+
+    def test_acquire_does_not_wait(self):
+        for _ in range(2):
+            self.pool.acquire(2**19)
+        self.pool.upload_started()
+        self.pool.acquire(2**19)
+        self.assertEqual(3 * 2**19, self.pool.stats()['in_use'])
+        self.assertEqual(0, self.pool.stats()['waits'])
+
+    def test_over_budget_when_nothing_uploading(self):
+        for _ in range(3):
+            self.pool.acquire(2**19)
+        self.assertEqual(3 * 2**19, self.pool.stats()['in_use'])
+
+    def test_idle_buffers_dropped_to_make_room(self):
+        self.pool.release(self.pool.acquire(2**19))
+        self.pool.acquire(2**20)
+        stats = self.pool.stats()
+        self.assertEqual(0, stats['free'])
+        self.assertEqual(2**20, stats['in_use'])
+
+
 class BlockManagerTest(unittest.TestCase):
+    def test_write_waits_for_buffers_without_collection_lock(self):
+        keep = ArvadosFileWriterTestCase.MockKeep({})
+        api = ArvadosFileWriterTestCase.MockApi({}, {})
+        with Collection(api_client=api, keep_client=keep) as c:
+            writer = c.open("count.txt", "wb")
+            pool = c._my_block_manager().buffer_pool
+            held = pool.acquire(pool.budget)
+            pool.upload_started()
+            t = threading.Thread(target=writer.write, args=(b"0123456789",))
+            t.daemon = True
+            t.start()
+            try:
+                t.join(0.1)
+                self.assertTrue(t.is_alive())
+                # Other operations on the collection aren't held up.
+                self.assertTrue(c.lock.acquire(False))
+                c.lock.release()
+                self.assertIsNotNone(c.find("count.txt"))
+            finally:
+                pool.release(held)
+                pool.upload_finished()
+                t.join(5)
+            self.assertFalse(t.is_alive())
+            self.assertEqual(10, writer.size())
+
+    def test_buffers_returned_after_commit(self):
+        keep = ArvadosFileWriterTestCase.MockKeep({})
+        with arvados.arvfile._BlockManager(keep) as blockmanager:
+            for data in (b"foo", b"bar"):
+                bufferblock = blockmanager.alloc_bufferblock()
+                bufferblock.append(data)
+                blockmanager.commit_bufferblock(bufferblock, True)
+                self.assertEqual(bufferblock.state(), arvados.arvfile._BufferBlock.COMMITTED)
+            stats = blockmanager.buffer_pool.stats()
+        self.assertEqual(0, stats['in_use'])
+        self.assertEqual(0, stats['uploading'])
+        self.assertEqual(1, stats['allocated'])
+        self.assertEqual(1, stats['reused'])
+        self.assertEqual(b"bar", keep.get("37b51d194a7513e45b56f6524f2d51f2+3"))
+
+    def test_prefetch_threads(self):
+        keep = ArvadosFileWriterTestCase.MockKeep({})
+        with arvados.arvfile._BlockManager(keep, get_threads=5) as blockmanager:
+            blockmanager.block_prefetch("781e5e245d69b566979b86e28d23f2c7+10")
+            self.assertEqual(5, len(blockmanager._prefetch_threads))
+
+    def test_prefetch_skips_cached_blocks(self):
+        fetched = threading.Event()
+        keep = mock.MagicMock()
+        keep.get.side_effect = lambda loc: fetched.set()
+        keep.block_cache = arvados.keep.KeepBlockCache()
+        slot, first = keep.block_cache.reserve_cache("781e5e245d69b566979b86e28d23f2c7")
+        with arvados.arvfile._BlockManager(keep) as blockmanager:
+            blockmanager.block_prefetch("781e5e245d69b566979b86e28d23f2c7+10")
+            self.assertIsNone(blockmanager._prefetch_queue)
+            blockmanager.block_prefetch("acbd18db4cc2f85cedef654fccc4a4d8+3")
+            self.assertTrue(fetched.wait(5))
+        keep.get.assert_called_once_with("acbd18db4cc2f85cedef654fccc4a4d8+3")
+
     def test_bufferblock_append(self):
         keep = ArvadosFileWriterTestCase.MockKeep({})
         with arvados.arvfile._BlockManager(keep) as blockmanager:
@@ -803,6 +1192,57 @@ class BlockManagerTest(unittest.TestCase):
             with self.assertRaises(arvados.errors.AssertionError):
                 bufferblock.append("bar")
 
+    def test_bufferblock_locator_hashes_appended_data(self):
+        keep = mock.MagicMock()
+        with arvados.arvfile._BlockManager(keep) as blockmanager:
+            bufferblock = blockmanager.alloc_bufferblock()
+            bufferblock.append("foo")
+            self.assertEqual(bufferblock.locator(), "acbd18db4cc2f85cedef654fccc4a4d8+3")
+            bufferblock.append("bar")
+            with mock.patch.object(bufferblock, '_views', wraps=bufferblock._views) as views:
+                self.assertEqual(bufferblock.locator(), "3858f62230ac3c915f300c664312c63f+6")
+            views.assert_called_once_with(3, 3)
+            blockmanager.commit_bufferblock(bufferblock, True)
+        _, kwargs = keep.put.call_args
+        self.assertEqual("3858f62230ac3c915f300c664312c63f", kwargs['data_hash'])
+
+    def test_bufferblock_append_block(self):
+        keep = ArvadosFileWriterTestCase.MockKeep({})
+        with arvados.arvfile._BlockManager(keep) as blockmanager:
+            small = []
+            for data in ("foo", "bar"):
+                bb = blockmanager.alloc_bufferblock()
+                bb.append(data)
+                small.append(bb)
+            packed = blockmanager.alloc_bufferblock()
+            for bb in small:
+                packed.append_block(bb)
+            self.assertEqual(packed.size(), 6)
+            self.assertIsNone(packed.buffer_view)
+            self.assertEqual(packed.locator(), "3858f62230ac3c915f300c664312c63f+6")
+            self.assertEqual(blockmanager.get_block_contents(packed.blockid, 1), b"foobar")
+            # The small blocks are still readable until deleted.
+            self.assertEqual(blockmanager.get_block_contents(small[0].blockid, 1), b"foo")
+            for bb in small:
+                blockmanager.delete_bufferblock(bb.blockid)
+            blockmanager.commit_bufferblock(packed, True)
+            self.assertEqual(0, blockmanager.buffer_pool.stats()['in_use'])
+        self.assertEqual(b"foobar", keep.get("3858f62230ac3c915f300c664312c63f+6"))
+
+    def test_bufferblock_append_after_append_block(self):
+        keep = ArvadosFileWriterTestCase.MockKeep({})
+        with arvados.arvfile._BlockManager(keep) as blockmanager:
+            bb1 = blockmanager.alloc_bufferblock()
+            bb1.append("foo")
+            bb2 = blockmanager.alloc_bufferblock()
+            bb2.append("bar")
+            bb2.append_block(bb1)
+            bb2.append("baz")
+            self.assertEqual(bb2.buffer_view[0:9], b"barfoobaz")
+            blockmanager.delete_bufferblock(bb1.blockid)
+            blockmanager.delete_bufferblock(bb2.blockid)
+            self.assertEqual(0, blockmanager.buffer_pool.stats()['in_use'])
+
     def test_bufferblock_dup(self):
         keep = ArvadosFileWriterTestCase.MockKeep({})
         with arvados.arvfile._BlockManager(keep) as blockmanager:
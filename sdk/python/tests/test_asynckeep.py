@@ -0,0 +1,119 @@
+# Copyright (C) The Arvados Authors. All rights reserved.
+#
+# SPDX-License-Identifier: Apache-2.0
+
+from __future__ import absolute_import
+import array
+import hashlib
+import os
+import sys
+import threading
+import time
+import unittest
+
+import arvados
+from . import arvados_testutil as tutil
+from . import keepstub
+
+if sys.version_info >= (3, 5):
+    import asyncio
+    import arvados.asynckeep
+
+
+@unittest.skipIf(sys.version_info < (3, 5), "asyncio Keep client needs Python 3.5")
+class AsyncKeepClientTestCase(keepstub.StubKeepServers, unittest.TestCase):
+    DATA = b'abcdefghij' * 100000
+
+    def setUp(self):
+        super(AsyncKeepClientTestCase, self).setUp()
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        self.keep_client = arvados.KeepClient(api_client=self.api_client)
+        self.async_client = arvados.asynckeep.AsyncKeepClient(self.keep_client)
+
+    def tearDown(self):
+        self.async_client.close()
+        asyncio.set_event_loop(None)
+        self.loop.close()
+        super(AsyncKeepClientTestCase, self).tearDown()
+
+    def run_until_complete(self, aw):
+        return self.loop.run_until_complete(aw)
+
+    def test_put_get_head(self):
+        loc = self.run_until_complete(self.async_client.put(self.DATA, copies=1))
+        self.assertEqual(tutil.str_keep_locator(self.DATA), loc.split('+A')[0])
+        self.assertEqual(self.DATA, self.run_until_complete(self.async_client.get(loc)))
+        self.assertTrue(self.run_until_complete(self.async_client.head(loc)))
+        self.assertEqual(len(self.DATA), self.keep_client.upload_counter.get())
+        self.assertEqual(len(self.DATA), self.keep_client.download_counter.get())
+
+    def test_put_non_byte_memoryview(self):
+        data = array.array('i', range(1000))
+        loc = self.run_until_complete(self.async_client.put(memoryview(data), copies=1))
+        self.assertEqual(tutil.str_keep_locator(data.tobytes()), loc.split('+A')[0])
+        self.assertEqual(data.tobytes(), self.run_until_complete(self.async_client.get(loc)))
+
+    def test_concurrent_gets_of_one_block_share_a_request(self):
+        loc = self.keep_client.put(self.DATA, copies=1)
+        blobs = self.run_until_complete(asyncio.gather(
+            *[self.async_client.get(loc) for _ in range(20)]))
+        self.assertEqual([self.DATA] * 20, blobs)
+        self.assertEqual(1, self.keep_client.misses_counter.get())
+        self.assertEqual(len(self.DATA), self.keep_client.download_counter.get())
+
+    def test_many_concurrent_gets(self):
+        blocks = [str(i).encode() * 1000 for i in range(100)]
+        locs = [self.keep_client.put(b, copies=1) for b in blocks]
+        self.async_client.max_requests = 8
+        self.assertEqual(blocks, self.run_until_complete(asyncio.gather(
+            *[self.async_client.get(loc) for loc in locs])))
+
+    def test_block_cache_shared_with_keep_client(self):
+        loc = self.keep_client.put(self.DATA, copies=1)
+        self.assertEqual(self.DATA, self.keep_client.get(loc))
+        self.server.store.clear()
+        self.assertEqual(self.DATA, self.run_until_complete(self.async_client.get(loc)))
+
+    def test_get_unreachable_service(self):
+        self.server.shutdown()
+        self.server.server_close()
+        loc = tutil.str_keep_locator(self.DATA)
+        with self.assertRaises(arvados.errors.KeepReadError):
+            self.run_until_complete(self.async_client.get(loc, num_retries=0))
+
+    def test_get_checksum_fail(self):
+        loc = self.keep_client.put(self.DATA, copies=1)
+        self.server.store[hashlib.md5(self.DATA).hexdigest()] = b'corrupt'
+        with self.assertRaises(arvados.errors.KeepReadError):
+            self.run_until_complete(self.async_client.get(loc, num_retries=0))
+
+    def test_put_fails_without_enough_services(self):
+        with self.assertRaises(arvados.errors.KeepWriteError):
+            self.run_until_complete(self.async_client.put(self.DATA, copies=2, num_retries=0))
+
+    def test_get_uses_proxy_settings(self):
+        loc = self.keep_client.put(self.DATA, copies=1)
+        proxy = keepstub.Server(('localhost', 0), keepstub.Handler)
+        threading.Thread(target=proxy.serve_forever, daemon=True).start()
+        self.addCleanup(proxy.server_close)
+        self.addCleanup(proxy.shutdown)
+        proxy.store.update(self.server.store)
+        self.server.store.clear()
+        proxy_env = {
+            'http_proxy': 'http://localhost:{}'.format(proxy.server_address[1]),
+            'no_proxy': '',
+            'NO_PROXY': '',
+        }
+        with tutil.mock.patch.dict(os.environ, proxy_env):
+            self.assertEqual(self.DATA, self.run_until_complete(
+                self.async_client.get(loc, num_retries=0)))
+
+    def test_get_low_speed_timeout(self):
+        loc = self.keep_client.put(self.DATA, copies=1)
+        self.keep_client.timeout = (1, 1, 1 << 20)
+        self.server.setdelays(response=4)
+        t0 = time.time()
+        with self.assertRaises(arvados.errors.KeepReadError):
+            self.run_until_complete(self.async_client.get(loc, num_retries=0))
+        self.assertLess(time.time() - t0, 3)
@@ -1020,6 +1020,193 @@ class NewCollectionTestCase(unittest.TestCase, CollectionTestMixin):
         self.assertEqual(c.portable_manifest_text(),
                          './foo\\040bar/baz\\040waz d41d8cd98f00b204e9800998ecf8427e+0 0:0:\\056\n')
 
+    def test_lazy_load(self):
+        m = ('. 781e5e245d69b566979b86e28d23f2c7+10 0:10:count1.txt\n'
+             './foo 781e5e245d69b566979b86e28d23f2c7+10 0:4:a 4:6:b\n'
+             './foo/bar acbd18db4cc2f85cedef654fccc4a4d8+3 0:3:c\n'
+             './foo 781e5e245d69b566979b86e28d23f2c7+10 0:2:a\n'
+             './baz acbd18db4cc2f85cedef654fccc4a4d8+3 0:3:d\n')
+        eager = CollectionReader(m)
+        c = CollectionReader(m, lazy=True)
+        self.assertEqual(m, c.manifest_text(only_committed=True))
+        self.assertIsNotNone(c._loaded_items['foo']._unloaded_streams)
+        self.assertEqual(6, c.find('foo/a').size())
+        self.assertIsNone(c._loaded_items['foo']._unloaded_streams)
+        self.assertIsNotNone(c._loaded_items['baz']._unloaded_streams)
+        self.assertIsNotNone(c._loaded_items['foo']._loaded_items['bar']._unloaded_streams)
+        self.assertTrue(c.committed())
+        self.assertTrue(c.find('foo/a').committed())
+        self.assertEqual(eager.portable_manifest_text(), c.portable_manifest_text())
+        self.assertEqual(eager.portable_data_hash(), c.portable_data_hash())
+        self.assertEqual(eager, c)
+
+    def test_lazy_load_needs_plain_stream_lines(self):
+        c = CollectionReader('. 781e5e245d69b566979b86e28d23f2c7+10 0:10:foo/count1.txt\n'
+                             './foo 781e5e245d69b566979b86e28d23f2c7+10 0:10:count2.txt\n',
+                             lazy=True)
+        self.assertIsNone(c._loaded_items['foo']._unloaded_streams)
+        self.assertEqual(['count1.txt', 'count2.txt'], sorted(c.find('foo').keys()))
+
+    def test_import_manifest_with_empty_blocks(self):
+        c = Collection('. d41d8cd98f00b204e9800998ecf8427e+0 781e5e245d69b566979b86e28d23f2c7+10 d41d8cd98f00b204e9800998ecf8427e+0 acbd18db4cc2f85cedef654fccc4a4d8+3 0:13:all 10:3:tail\n')
+        self.assertEqual(13, c.find('all').size())
+        self.assertEqual([Range('acbd18db4cc2f85cedef654fccc4a4d8+3', 0, 3, 0)],
+                         c.find('tail').segments())
+
+    def test_files_share_block_table(self):
+        c = Collection('. 781e5e245d69b566979b86e28d23f2c7+10 0:5:count1.txt 5:5:count2.txt\n./foo 781e5e245d69b566979b86e28d23f2c7+10 0:10:count3.txt\n')
+        self.assertEqual(1, len(c._my_block_table()))
+        self.assertEqual([Range('781e5e245d69b566979b86e28d23f2c7+10', 0, 5, 5)],
+                         c.find('count2.txt').segments())
+
+    def test_manifest_text_cache(self):
+        c = Collection('./foo 781e5e245d69b566979b86e28d23f2c7+10 0:10:count1.txt\n'
+                       './foo/bar acbd18db4cc2f85cedef654fccc4a4d8+3 0:3:a\n'
+                       './baz acbd18db4cc2f85cedef654fccc4a4d8+3 0:3:b\n',
+                       api_client=mock.MagicMock(), keep_client=mock.MagicMock())
+        c.portable_manifest_text()
+        foo, baz = c.find('foo'), c.find('baz')
+        self.assertIsNotNone(foo._manifest_cache)
+        c.copy('foo/count1.txt', 'baz/count1.txt')
+        self.assertIsNone(c._manifest_cache)
+        self.assertIsNone(baz._manifest_cache)
+        self.assertIsNotNone(foo._manifest_cache)
+        c.remove('foo/bar/a')
+        self.assertIsNone(foo._manifest_cache)
+        expect = ('./baz acbd18db4cc2f85cedef654fccc4a4d8+3 781e5e245d69b566979b86e28d23f2c7+10 0:3:b 3:10:count1.txt\n'
+                  './foo 781e5e245d69b566979b86e28d23f2c7+10 0:10:count1.txt\n'
+                  './foo/bar d41d8cd98f00b204e9800998ecf8427e+0 0:0:\\056\n')
+        self.assertEqual(expect, c.portable_manifest_text())
+        self.assertEqual(expect, c.portable_manifest_text())
+        c.open('baz/b', 'ab').write(b'c')
+        self.assertIn('./baz acbd18db4cc2f85cedef654fccc4a4d8+3 4a8a08f09d37b73795649038408b5f33+1 781e5e245d69b566979b86e28d23f2c7+10 0:4:b 4:10:count1.txt\n',
+                      c.portable_manifest_text())
+        self.assertIsNone(baz._manifest_cache)
+        self.assertIsNotNone(foo._manifest_cache)
+
+    @mock.patch('arvados.keep.KeepClient.refresh_signature')
+    def test_copy_remote_blocks_once_each(self, rs_mock):
+        rs_mock.side_effect = lambda loc: loc.replace('+Rzzzzz-', '+A')
+        sig = '+Rzzzzz-' + 'a' * 40 + '@abcdef01'
+        c = Collection('. 781e5e245d69b566979b86e28d23f2c7+10%s acbd18db4cc2f85cedef654fccc4a4d8+3%s 0:10:a 10:3:b\n'
+                       './foo 781e5e245d69b566979b86e28d23f2c7+10%s 0:10:c\n' % (sig, sig, sig),
+                       api_client=mock.MagicMock(),
+                       keep_client=arvados.KeepClient(api_client=mock.MagicMock()))
+        c._copy_remote_blocks(remote_blocks={})
+        self.assertEqual(2, rs_mock.call_count)
+        self.assertFalse(c.find('a').has_remote_blocks())
+        self.assertFalse(c.find('foo/c').has_remote_blocks())
+        self.assertEqual([Range('781e5e245d69b566979b86e28d23f2c7+10+A' + 'a' * 40 + '@abcdef01', 0, 10, 0)],
+                         c.find('foo/c').segments())
+
+    def test_refresh_signatures(self):
+        old_sig = '+A' + 'a' * 40 + '@abcdef01'
+        new_sig = '+A' + 'b' * 40 + '@abcdef02'
+        manifest = ('. 781e5e245d69b566979b86e28d23f2c7+10%s 0:10:count1.txt\n'
+                    './foo 781e5e245d69b566979b86e28d23f2c7+10%s 0:10:count2.txt\n'
+                    './lazy acbd18db4cc2f85cedef654fccc4a4d8+3%s 0:3:bar.txt\n')
+        api = mock.MagicMock()
+        api.collections().get().execute.return_value = {
+            "manifest_text": manifest % (new_sig, new_sig, new_sig)}
+        c = Collection(manifest % (old_sig, old_sig, old_sig), api_client=api, lazy=True)
+        c._manifest_locator = 'zzzzz-4zz18-mockcollection0'
+        count1 = c.find('count1.txt')
+        count2 = c.find('foo/count2.txt')
+        c.manifest_text()
+        c.refresh_signatures()
+        self.assertIs(count1, c.find('count1.txt'))
+        self.assertIs(count2, c.find('foo/count2.txt'))
+        self.assertEqual([Range('781e5e245d69b566979b86e28d23f2c7+10' + new_sig, 0, 10, 0)],
+                         count2.segments())
+        self.assertEqual(manifest % (new_sig, new_sig, new_sig), c.manifest_text())
+        self.assertEqual(manifest % (new_sig, new_sig, new_sig), c._manifest_text)
+        self.assertTrue(c.committed())
+
+    def test_update_same_pdh_resigns_in_place(self):
+        old_sig = '+A' + 'a' * 40 + '@abcdef01'
+        new_sig = '+A' + 'b' * 40 + '@abcdef02'
+        manifest = ('. 781e5e245d69b566979b86e28d23f2c7+10%s 0:10:count1.txt\n'
+                    './foo 781e5e245d69b566979b86e28d23f2c7+10%s 0:10:count2.txt\n')
+        api = mock.MagicMock()
+        c = Collection(manifest % (old_sig, old_sig), api_client=api)
+        c._manifest_locator = 'zzzzz-4zz18-mockcollection0'
+        api.collections().get().execute.return_value = {
+            "manifest_text": manifest % (new_sig, new_sig),
+            "portable_data_hash": c.portable_data_hash(),
+            "modified_at": "2020-01-01T00:00:00.000000000Z",
+        }
+        count1 = c.find('count1.txt')
+        count2 = c.find('foo/count2.txt')
+        with mock.patch.object(c, 'apply') as apply:
+            c.update()
+        self.assertFalse(apply.called)
+        self.assertIs(count1, c.find('count1.txt'))
+        self.assertIs(count2, c.find('foo/count2.txt'))
+        self.assertEqual([Range('781e5e245d69b566979b86e28d23f2c7+10' + new_sig, 0, 10, 0)],
+                         count2.segments())
+        self.assertEqual(manifest % (new_sig, new_sig), c.manifest_text())
+
+    def test_update_same_pdh_keeps_local_edits(self):
+        old_sig = '+A' + 'a' * 40 + '@abcdef01'
+        new_sig = '+A' + 'b' * 40 + '@abcdef02'
+        api = mock.MagicMock()
+        keep = mock.MagicMock()
+        keep.put.return_value = 'acbd18db4cc2f85cedef654fccc4a4d8+3' + new_sig
+        c = Collection('. 781e5e245d69b566979b86e28d23f2c7+10%s 0:10:count1.txt\n' % old_sig,
+                       api_client=api, keep_client=keep)
+        c._manifest_locator = 'zzzzz-4zz18-mockcollection0'
+        c.rename('count1.txt', 'count3.txt')
+        with c.open('new.txt', 'wb') as f:
+            f.write(b'foo')
+        # Someone else saved the same changes, so the server has the
+        # same content with new signatures.
+        server_manifest = ('. 781e5e245d69b566979b86e28d23f2c7+10%s acbd18db4cc2f85cedef654fccc4a4d8+3%s '
+                           '0:10:count3.txt 10:3:new.txt\n' % (new_sig, new_sig))
+        api.collections().get().execute.return_value = {
+            "manifest_text": server_manifest,
+            "portable_data_hash": c.portable_data_hash(),
+            "modified_at": "2020-01-01T00:00:00.000000000Z",
+        }
+        with mock.patch.object(c, 'apply') as apply:
+            c.update()
+        self.assertFalse(apply.called)
+        self.assertEqual(server_manifest, c.manifest_text())
+        self.assertFalse(c.committed())
+
+    def test_refresh_signatures_of_moved_file(self):
+        old_sig = '+A' + 'a' * 40 + '@abcdef01'
+        new_sig = '+A' + 'b' * 40 + '@abcdef02'
+        api, keep = mock.MagicMock(), mock.MagicMock()
+        src = Collection('. 781e5e245d69b566979b86e28d23f2c7+10%s 0:10:foo\n' % old_sig,
+                         api_client=api, keep_client=keep)
+        dst = Collection(api_client=api, keep_client=keep)
+        dst.rename('foo', 'foo', source_collection=src)
+        dst._refresh_signatures('. 781e5e245d69b566979b86e28d23f2c7+10%s 0:10:foo\n' % new_sig)
+        self.assertEqual('. 781e5e245d69b566979b86e28d23f2c7+10%s 0:10:foo\n' % new_sig,
+                         dst.manifest_text())
+
+    def test_update_different_pdh_merges(self):
+        sig = '+A' + 'a' * 40 + '@abcdef01'
+        manifest = '. 781e5e245d69b566979b86e28d23f2c7+10%s 0:10:count1.txt\n' % sig
+        new_manifest = ('. 781e5e245d69b566979b86e28d23f2c7+10%s 0:10:count1.txt 0:10:count3.txt\n' % sig)
+        api = mock.MagicMock()
+        c = Collection(manifest, api_client=api, keep_client=mock.MagicMock())
+        c._manifest_locator = 'zzzzz-4zz18-mockcollection0'
+        api.collections().get().execute.return_value = {
+            "manifest_text": new_manifest,
+            "portable_data_hash": Collection(new_manifest, api_client=api).portable_data_hash(),
+            "modified_at": "2020-01-01T00:00:00.000000000Z",
+        }
+        count1 = c.find('count1.txt')
+        with mock.patch.object(c, 'apply', wraps=c.apply) as apply, \
+             mock.patch.object(c, '_refresh_signatures') as refresh:
+            c.update()
+        self.assertEqual(1, apply.call_count)
+        self.assertFalse(refresh.called)
+        self.assertIs(count1, c.find('count1.txt'))
+        self.assertIsNotNone(c.find('count3.txt'))
+        self.assertEqual(new_manifest, c.manifest_text())
+
     def test_remove_in_subdir(self):
         c = Collection('. 781e5e245d69b566979b86e28d23f2c7+10 0:10:count1.txt\n./foo 781e5e245d69b566979b86e28d23f2c7+10 0:10:count2.txt\n')
         c.remove("foo/count2.txt")
@@ -1076,6 +1263,22 @@ class NewCollectionTestCase(unittest.TestCase, CollectionTestMixin):
         self.assertEqual("", c1.manifest_text())
         self.assertEqual(". 781e5e245d69b566979b86e28d23f2c7+10 0:10:count2.txt\n", c2.manifest_text())
 
+    def test_move_to_other_uses_its_block_table(self):
+        api, keep = mock.MagicMock(), mock.MagicMock()
+        c1 = Collection('. 781e5e245d69b566979b86e28d23f2c7+10 0:10:count1.txt\n'
+                        './foo acbd18db4cc2f85cedef654fccc4a4d8+3 0:3:count2.txt\n',
+                        api_client=api, keep_client=keep)
+        c2 = Collection('. acbd18db4cc2f85cedef654fccc4a4d8+3 0:3:bar.txt\n',
+                        api_client=api, keep_client=keep)
+        c2.rename("count1.txt", "count1.txt", source_collection=c1)
+        c2.rename("foo", "foo", source_collection=c1)
+        for path in ("count1.txt", "foo/count2.txt"):
+            self.assertIs(c2._my_block_table(), c2.find(path)._segments._blocks)
+        self.assertEqual(2, len(c2._my_block_table()))
+        self.assertEqual(". acbd18db4cc2f85cedef654fccc4a4d8+3 781e5e245d69b566979b86e28d23f2c7+10 0:3:bar.txt 3:10:count1.txt\n"
+                         "./foo acbd18db4cc2f85cedef654fccc4a4d8+3 0:3:count2.txt\n",
+                         c2.manifest_text())
+
     def test_clone(self):
         c = Collection('. 781e5e245d69b566979b86e28d23f2c7+10 0:10:count1.txt\n./foo 781e5e245d69b566979b86e28d23f2c7+10 0:10:count2.txt\n')
         cl = c.clone()
@@ -1195,6 +1398,25 @@ class NewCollectionTestCase(unittest.TestCase, CollectionTestMixin):
         c1.apply(d)
         self.assertEqual(c1.portable_manifest_text(), c2.portable_manifest_text())
 
+    def test_diff_lazy_skips_unchanged_subcollections(self):
+        m = ('. 781e5e245d69b566979b86e28d23f2c7+10 0:10:count1.txt\n'
+             './foo 781e5e245d69b566979b86e28d23f2c7+10 0:10:count2.txt\n'
+             './foo/bar acbd18db4cc2f85cedef654fccc4a4d8+3 0:3:a\n')
+        c1 = CollectionReader(m, lazy=True)
+        c2 = CollectionReader(m.replace('0:3:a', '0:3:b'), lazy=True)
+        d = c1.diff(c2)
+        self.assertIsNotNone(c1._loaded_items['foo']._unloaded_streams)
+        self.assertIsNotNone(c2._loaded_items['foo']._unloaded_streams)
+        self.assertEqual(sorted(d), [
+            ('add', './foo/bar/b', c2.find("foo/bar/b")),
+            ('del', './foo/bar/a', c1.find("foo/bar/a")),
+            ('tok', './count1.txt', c1["count1.txt"], c2["count1.txt"]),
+        ])
+        self.assertIs(c1["count1.txt"], sorted(d)[2][2])
+        c3 = Collection(m)
+        c3.apply(d)
+        self.assertEqual(c2.portable_manifest_text(), c3.portable_manifest_text())
+
     def test_conflict_keep_local_change(self):
         c1 = Collection('. 781e5e245d69b566979b86e28d23f2c7+10 0:10:count1.txt\n')
         c2 = Collection('. 5348b82a029fd9e971a811ce1f71360b+43 0:10:count2.txt\n')
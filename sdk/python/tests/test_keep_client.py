@@ -9,14 +9,18 @@ standard_library.install_aliases()
 from builtins import str
 from builtins import range
 from builtins import object
+import array
 import hashlib
 import mock
 import os
 import pycurl
 import random
 import re
+import shutil
 import socket
 import sys
+import tempfile
+import threading
 import time
 import unittest
 import urllib.parse
@@ -532,6 +536,308 @@ class KeepClientCacheTestCase(unittest.TestCase, tutil.ApiClientMock):
         # First reponse was not cached because it was from a HEAD request.
         self.assertNotEqual(head_resp, get_resp)
 
+@tutil.skip_sleep
+class KeepClientResponseBodyTestCase(unittest.TestCase, tutil.ApiClientMock):
+    def setUp(self):
+        self.api_client = self.mock_keep_services(count=1)
+        self.keep_client = arvados.KeepClient(api_client=self.api_client)
+        self.data = b'xyzzy' * 1000
+        self.md5 = hashlib.md5(self.data).hexdigest()
+
+    def test_get_with_size_hint(self):
+        with tutil.mock_keep_responses(self.data, 200):
+            self.assertEqual(self.data, self.keep_client.get(
+                '{}+{}'.format(self.md5, len(self.data))))
+
+    def test_get_without_size_hint(self):
+        with tutil.mock_keep_responses(self.data, 200):
+            self.assertEqual(self.data, self.keep_client.get(self.md5))
+
+    def test_get_with_wrong_size_hint(self):
+        with tutil.mock_keep_responses(self.data, 200):
+            self.assertEqual(self.data, self.keep_client.get(
+                '{}+{}'.format(self.md5, 10)))
+
+    def test_block_receiver_in_chunks(self):
+        receiver = arvados.keep._BlockReceiver(
+            len(self.data) + 100, {'x-status-line': 'HTTP/1.1 200 OK'})
+        for i in range(0, len(self.data), 7):
+            receiver.write(self.data[i:i+7])
+        self.assertEqual(self.data, receiver.getvalue())
+        self.assertIs(bytes, type(receiver.getvalue()))
+        self.assertEqual(self.md5, receiver.hexdigest())
+
+    def test_block_receiver_preallocates_only_for_success(self):
+        headers = {'x-status-line': 'HTTP/1.1 404 Not Found'}
+        receiver = arvados.keep._BlockReceiver(2**40, headers)
+        receiver.write(b'not found')
+        self.assertEqual(len(b'not found'), len(receiver.buf))
+        headers['x-status-line'] = 'HTTP/1.1 200 OK'
+        receiver = arvados.keep._BlockReceiver(2**40, headers)
+        receiver.write(b'x')
+        self.assertEqual(arvados.config.KEEP_BLOCK_SIZE, len(receiver.buf))
+
+    def test_get_returns_bytes(self):
+        with tutil.mock_keep_responses(self.data, 200):
+            self.assertIs(bytes, type(self.keep_client.get(self.md5)))
+
+
+class KeepBlockCacheTestCase(unittest.TestCase):
+    def fill(self, cache, locator, content):
+        slot, first = cache.reserve_cache(locator)
+        self.assertTrue(first)
+        cache.set(slot, content)
+        return slot
+
+    def test_hit_returns_same_slot(self):
+        cache = arvados.keep.KeepBlockCache(cache_max=100)
+        slot = self.fill(cache, 'a', b'x'*10)
+        self.assertIs(slot, cache.get('a'))
+        self.assertEqual((slot, False), cache.reserve_cache('a'))
+        self.assertIsNone(cache.get('b'))
+
+    def test_evict_least_recently_used(self):
+        cache = arvados.keep.KeepBlockCache(cache_max=30)
+        for loc in 'abc':
+            self.fill(cache, loc, b'x'*10)
+        # Touch 'a' so 'b' becomes the least recently used slot.
+        cache.get('a')
+        self.fill(cache, 'd', b'x'*10)
+        self.assertIsNone(cache.get('b'))
+        for loc in 'acd':
+            self.assertIsNotNone(cache.get(loc))
+        self.assertEqual(30, cache._cache_total)
+
+    def test_peek_does_not_touch(self):
+        cache = arvados.keep.KeepBlockCache(cache_max=30)
+        slots = [self.fill(cache, loc, b'x'*10) for loc in 'abc']
+        self.assertIs(slots[0], cache.peek('a'))
+        self.assertIsNone(cache.peek('z'))
+        self.fill(cache, 'd', b'x'*10)
+        # 'a' was still the least recently used slot.
+        self.assertIsNone(cache.peek('a'))
+        self.assertIs(slots[1], cache.peek('b'))
+
+    def test_pending_slots_not_evicted(self):
+        cache = arvados.keep.KeepBlockCache(cache_max=10)
+        pending, _ = cache.reserve_cache('a')
+        self.fill(cache, 'b', b'x'*10)
+        self.fill(cache, 'c', b'x'*10)
+        self.assertIs(pending, cache.get('a'))
+        self.assertIsNone(cache.get('b'))
+        self.assertIsNotNone(cache.get('c'))
+
+    def test_failed_read_not_cached(self):
+        cache = arvados.keep.KeepBlockCache(cache_max=10)
+        self.fill(cache, 'a', None)
+        self.assertIsNone(cache.get('a'))
+        self.assertEqual(0, cache._cache_total)
+
+    def test_set_ignores_filled_slot(self):
+        cache = arvados.keep.KeepBlockCache(cache_max=30)
+        slot = self.fill(cache, 'a', b'x'*10)
+        cache.set(slot, b'y'*10)
+        self.assertEqual(b'x'*10, slot.get())
+        self.assertEqual(10, cache._cache_total)
+
+    def test_hits_do_not_grow_cache_total(self):
+        data = b'x' * 1000
+        loc = tutil.str_keep_locator(data)
+        keep_client = arvados.KeepClient(
+            api_client=tutil.ApiClientMock().mock_keep_services(count=1),
+            block_cache=arvados.keep.KeepBlockCache(cache_max=3000))
+        with tutil.mock_keep_responses(data, 200) as mock:
+            for _ in range(5):
+                self.assertEqual(data, keep_client.get(loc))
+                self.assertEqual(1000, keep_client.block_cache._cache_total)
+        self.assertEqual(1, mock.call_count)
+
+
+@tutil.skip_sleep
+class KeepDiskCacheTestCase(unittest.TestCase, tutil.ApiClientMock):
+    def setUp(self):
+        self.api_client = self.mock_keep_services(count=2)
+        self.data = b'xyzzy'
+        self.locator = '1271ed5ef305aadabc605b1609e24c52'
+        self.disk_cache_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.disk_cache_dir)
+
+    def new_client(self, cache_max=1024):
+        block_cache = arvados.keep.KeepBlockCache(
+            cache_max, disk_cache=True, disk_cache_dir=self.disk_cache_dir)
+        return arvados.KeepClient(api_client=self.api_client,
+                                  block_cache=block_cache)
+
+    def get_blocks(self, keep_client, blocks):
+        for data in blocks:
+            with tutil.mock_keep_responses(data, 200):
+                keep_client.get(tutil.str_keep_locator(data))
+
+    def test_block_shared_between_clients(self):
+        with tutil.mock_keep_responses(self.data, 200):
+            self.assertEqual(self.data, self.new_client().get(self.locator))
+        self.assertTrue(os.path.exists(arvados.diskcache.block_path(
+            self.disk_cache_dir, self.locator)))
+        # A second client with its own cache reads the block from disk
+        # without making any requests.
+        with tutil.mock_keep_responses(self.data) as mock:
+            keep_client = self.new_client()
+            self.assertEqual(self.data, keep_client.get(self.locator))
+            self.assertEqual(1, keep_client.hits_counter.get())
+        self.assertEqual(0, mock.call_count)
+
+    def test_evicted_block_removed_from_disk(self):
+        keep_client = self.new_client(cache_max=len(self.data))
+        other = b'plugh'
+        with tutil.mock_keep_responses(self.data, 200):
+            keep_client.get(self.locator)
+        with tutil.mock_keep_responses(other, 200):
+            keep_client.get(tutil.str_keep_locator(other))
+        self.assertFalse(os.path.exists(arvados.diskcache.block_path(
+            self.disk_cache_dir, self.locator)))
+
+    def test_get_returns_bytes(self):
+        keep_client = self.new_client()
+        with tutil.mock_keep_responses(self.data, 200):
+            self.assertIs(bytes, type(keep_client.get(self.locator)))
+        self.assertIs(bytes, type(keep_client.get(self.locator)))
+        self.assertIs(bytes, type(keep_client.get_from_cache(self.locator)))
+        self.assertEqual(self.data, keep_client.read_block(self.locator)[:])
+
+    @mock.patch('arvados.keep.KeepBlockCache.DISK_TRIM_INTERVAL', 0)
+    def test_cache_max_shared_between_clients(self):
+        other = b'plugh'
+        clients = [self.new_client(cache_max=len(self.data)) for _ in range(2)]
+        with tutil.mock_keep_responses(self.data, 200):
+            clients[0].get(self.locator)
+        # The directory holds one block's worth, so the second client's
+        # block replaces the first client's once it rescans the directory.
+        with tutil.mock_keep_responses(other, 200):
+            clients[1].get(tutil.str_keep_locator(other))
+        self.assertFalse(os.path.exists(arvados.diskcache.block_path(
+            self.disk_cache_dir, self.locator)))
+        self.assertTrue(os.path.exists(arvados.diskcache.block_path(
+            self.disk_cache_dir, tutil.str_keep_locator(other)[:32])))
+
+    def test_cache_dir_rescanned_only_when_over_budget(self):
+        blocks = [b'block%d' % i for i in range(4)]
+        self.get_blocks(self.new_client(), blocks[:2])
+        # This client finds two blocks on disk and has room for one more.
+        keep_client = self.new_client(cache_max=3*len(blocks[0]))
+        with mock.patch('arvados.diskcache.DiskCacheSlot._trim',
+                        wraps=arvados.diskcache.DiskCacheSlot._trim) as trim:
+            self.get_blocks(keep_client, blocks[2:3])
+            self.assertEqual(0, trim.call_count)
+            self.get_blocks(keep_client, blocks[3:])
+            self.assertEqual(1, trim.call_count)
+            # Cache hits don't touch the directory at all.
+            self.get_blocks(keep_client, blocks[2:])
+            self.assertEqual(1, trim.call_count)
+        self.assertFalse(os.path.exists(arvados.diskcache.block_path(
+            self.disk_cache_dir, tutil.str_keep_locator(blocks[0])[:32])))
+
+    def test_cache_hit_does_not_rewrite_block(self):
+        keep_client = self.new_client()
+        self.get_blocks(keep_client, [self.data])
+        with mock.patch('arvados.diskcache.DiskCacheSlot.store') as store:
+            self.assertEqual(self.data, keep_client.get(self.locator))
+        self.assertEqual(0, store.call_count)
+
+    def test_disk_io_outside_cache_lock(self):
+        keep_client = self.new_client()
+        cache = keep_client.block_cache
+        locked = []
+        orig_store = arvados.diskcache.DiskCacheSlot.store
+        orig_load = arvados.diskcache.DiskCacheSlot.load
+        def store(slot, value):
+            locked.append(cache._cache_lock.locked())
+            return orig_store(slot, value)
+        def load(slot):
+            locked.append(cache._cache_lock.locked())
+            return orig_load(slot)
+        with mock.patch('arvados.diskcache.DiskCacheSlot.store', store), \
+             mock.patch('arvados.diskcache.DiskCacheSlot.load', load):
+            self.get_blocks(keep_client, [self.data])
+            self.get_blocks(self.new_client(), [self.data])
+        self.assertEqual([False, False, False], locked)
+
+    def test_init_trims_cache_dir(self):
+        with tutil.mock_keep_responses(self.data, 200):
+            self.new_client().get(self.locator)
+        self.new_client(cache_max=1)
+        self.assertFalse(os.path.exists(arvados.diskcache.block_path(
+            self.disk_cache_dir, self.locator)))
+
+
+class KeepClientGetManyTestCase(unittest.TestCase, tutil.ApiClientMock):
+    def setUp(self):
+        self.api_client = self.mock_keep_services(count=2)
+        self.keep_client = arvados.KeepClient(api_client=self.api_client)
+        self.blocks = [b'block%d' % i for i in range(10)]
+        self.by_hash = {hashlib.md5(b).hexdigest(): b for b in self.blocks}
+        self.locators = [tutil.str_keep_locator(b) for b in self.blocks]
+        self.lock = threading.Lock()
+        self.inflight = 0
+        self.max_inflight = 0
+
+    def fake_get(self, locator, method="GET", timeout=None):
+        with self.lock:
+            self.inflight += 1
+            self.max_inflight = max(self.max_inflight, self.inflight)
+        time.sleep(0.01)
+        with self.lock:
+            self.inflight -= 1
+        return self.by_hash.get(locator.md5sum)
+
+    def test_results_in_request_order(self):
+        with mock.patch('arvados.KeepClient.KeepService.get', side_effect=self.fake_get):
+            got = list(self.keep_client.get_many(reversed(self.locators), max_inflight=4))
+        self.assertEqual(list(reversed(self.blocks)), got)
+        self.assertEqual(4, self.max_inflight)
+
+    def test_duplicates_fetched_once(self):
+        with mock.patch('arvados.KeepClient.KeepService.get', side_effect=self.fake_get) as get_mock:
+            got = list(self.keep_client.get_many(self.locators[:2] * 5))
+        self.assertEqual(self.blocks[:2] * 5, got)
+        self.assertEqual(2, get_mock.call_count)
+
+    def test_memory_budget_limits_inflight(self):
+        with mock.patch('arvados.KeepClient.KeepService.get', side_effect=self.fake_get):
+            got = list(self.keep_client.get_many(
+                self.locators, max_inflight=8, max_bytes=2*len(self.blocks[0])))
+        self.assertEqual(self.blocks, got)
+        self.assertLessEqual(self.max_inflight, 2)
+
+    def fake_refresh_signature(self, locator):
+        with self.lock:
+            self.inflight += 1
+            self.max_inflight = max(self.max_inflight, self.inflight)
+        time.sleep(0.01)
+        with self.lock:
+            self.inflight -= 1
+        return locator.replace('+R', '+A')
+
+    def test_refresh_signatures(self):
+        remote = [loc + '+Rzzzzz-' + 'a' * 40 + '@abcdef01' for loc in self.locators]
+        with mock.patch('arvados.KeepClient.refresh_signature',
+                        side_effect=self.fake_refresh_signature) as rs_mock:
+            got = self.keep_client.refresh_signatures(remote * 3, max_inflight=4)
+        self.assertEqual({loc: loc.replace('+R', '+A') for loc in remote}, got)
+        self.assertEqual(len(remote), rs_mock.call_count)
+        self.assertEqual(4, self.max_inflight)
+
+    def test_error_raised_at_failed_block(self):
+        missing = tutil.str_keep_locator(b'missing')
+        with mock.patch('arvados.KeepClient.KeepService.get', side_effect=self.fake_get):
+            got = self.keep_client.get_many([self.locators[0], missing, self.locators[1]],
+                                            num_retries=0)
+            self.assertEqual(self.blocks[0], next(got))
+            with self.assertRaises(arvados.errors.KeepReadError):
+                next(got)
+
+
 @tutil.skip_sleep
 class KeepStorageClassesTestCase(unittest.TestCase, tutil.ApiClientMock):
     def setUp(self):
@@ -726,6 +1032,30 @@ class KeepClientRendezvousTestCase(unittest.TestCase, tutil.ApiClientMock):
                 for root in roots]
             self.assertEqual(self.expected_order[i], got_order)
 
+    def test_weighted_service_roots_cached(self):
+        loc = arvados.KeepLocator(self.hashes[0])
+        first = self.keep_client.weighted_service_roots(loc)
+        with mock.patch.object(self.keep_client, '_service_weight',
+                               wraps=self.keep_client._service_weight) as weight:
+            self.assertEqual(first, self.keep_client.weighted_service_roots(loc))
+            self.assertEqual(0, weight.call_count)
+            # Writable services are ordered separately.
+            self.keep_client.weighted_service_roots(loc, need_writable=True)
+            self.assertEqual(self.services, weight.call_count)
+
+    def test_weighted_service_roots_cache_invalidated_on_rebuild(self):
+        loc = arvados.KeepLocator(self.hashes[0])
+        self.keep_client.weighted_service_roots(loc)
+        self.mock_keep_services(self.api_client, count=self.services+1)
+        roots = self.keep_client.weighted_service_roots(loc, force_rebuild=True)
+        self.assertEqual(self.services+1, len(roots))
+
+    def test_weighted_service_roots_cache_bounded(self):
+        self.keep_client.PROBE_ORDER_CACHE_SIZE = 2
+        for hash in self.hashes:
+            self.keep_client.weighted_service_roots(arvados.KeepLocator(hash))
+        self.assertEqual(2, len(self.keep_client._probe_order_cache))
+
     def test_get_probe_order_against_reference_set(self):
         self._test_probe_order_against_reference_set(
             lambda i: self.keep_client.get(self.hashes[i], num_retries=1))
@@ -988,6 +1318,117 @@ class KeepClientTimeout(keepstub.StubKeepServers, unittest.TestCase):
                 kc.put(self.DATA, copies=1, num_retries=0)
 
 
+class KeepClientPutBufferTestCase(keepstub.StubKeepServers, unittest.TestCase):
+    DATA = b'abcdefghij' * 100000
+
+    def test_put_memoryview(self):
+        buf = bytearray(self.DATA + b'unwritten tail')
+        view = memoryview(buf)[0:len(self.DATA)]
+        kc = arvados.KeepClient(api_client=self.api_client)
+        loc = kc.put(view, copies=1, num_retries=0)
+        self.assertEqual(tutil.str_keep_locator(self.DATA),
+                         loc.split('+A')[0])
+        self.assertEqual(self.DATA,
+                         self.server.store[hashlib.md5(self.DATA).hexdigest()])
+
+    def test_put_bytearray(self):
+        kc = arvados.KeepClient(api_client=self.api_client)
+        loc = kc.put(bytearray(self.DATA), copies=1, num_retries=0)
+        self.assertEqual(self.DATA, kc.get(loc, num_retries=0))
+
+    def test_put_non_byte_memoryview(self):
+        data = array.array('i', range(1000))
+        expect = data.tobytes()
+        kc = arvados.KeepClient(api_client=self.api_client)
+        for buf in (data, memoryview(data), [memoryview(data)[:500], data[500:]]):
+            loc = kc.put(buf, copies=1, num_retries=0)
+            self.assertEqual(tutil.str_keep_locator(expect),
+                             loc.split('+A')[0])
+        self.assertEqual(expect,
+                         self.server.store[hashlib.md5(expect).hexdigest()])
+
+    def test_put_buffer_list(self):
+        view = memoryview(self.DATA)
+        chunks = [view[0:1000], bytearray(self.DATA[1000:500000]), view[500000:]]
+        kc = arvados.KeepClient(api_client=self.api_client)
+        loc = kc.put(chunks, copies=1, num_retries=0)
+        self.assertEqual(tutil.str_keep_locator(self.DATA),
+                         loc.split('+A')[0])
+        self.assertEqual(self.DATA,
+                         self.server.store[hashlib.md5(self.DATA).hexdigest()])
+
+
+class KeepClientHedgedGetTestCase(keepstub.StubKeepServers, unittest.TestCase):
+    STUB_SERVERS = 2
+    SLOW_DELAY = 2
+    HEDGE_DELAY = 0.1
+
+    def setUp(self):
+        super(KeepClientHedgedGetTestCase, self).setUp()
+        # The first server hangs on every request.
+        self.servers[0].setdelays(response=self.SLOW_DELAY)
+        self.slow_root = 'http://localhost:{}/'.format(self.port)
+
+    def store_blocks(self, count):
+        locators = []
+        for i in range(count):
+            data = 'block {}'.format(i).encode()
+            for server in self.servers:
+                server.store[hashlib.md5(data).hexdigest()] = data
+            locators.append(tutil.str_keep_locator(data))
+        return locators
+
+    def test_hedged_get_latency_bounded_by_hedge_delay(self):
+        kc = arvados.KeepClient(api_client=self.api_client,
+                                hedge_delay=self.HEDGE_DELAY)
+        locators = self.store_blocks(20)
+        slow_first = [loc for loc in locators
+                      if kc.weighted_service_roots(arvados.KeepLocator(loc))[0] == self.slow_root]
+        self.assertTrue(slow_first)
+        latencies = []
+        for loc in locators:
+            t0 = time.time()
+            self.assertEqual(kc.get(loc, num_retries=0),
+                             self.servers[1].store[loc.split('+')[0]])
+            latencies.append(time.time() - t0)
+        self.assertLess(max(latencies), self.HEDGE_DELAY + 0.5)
+
+    def wait_for_idle_workers(self, workers, timeout):
+        deadline = time.time() + timeout
+        while workers._idle < workers._threads and time.time() < deadline:
+            time.sleep(0.05)
+        return workers._idle == workers._threads
+
+    def test_losing_request_cancelled(self):
+        kc = arvados.KeepClient(api_client=self.api_client,
+                                hedge_delay=self.HEDGE_DELAY)
+        slow_first = [loc for loc in self.store_blocks(20)
+                      if kc.weighted_service_roots(arvados.KeepLocator(loc))[0] == self.slow_root]
+        kc.get(slow_first[0], num_retries=0)
+        # The request to the slow server is aborted well before the
+        # server would have answered it.
+        self.assertTrue(self.wait_for_idle_workers(kc._hedge_workers, self.SLOW_DELAY / 2 + 0.5))
+        # Later hedged requests reuse the idle threads.
+        kc.get(slow_first[1], num_retries=0)
+        self.assertEqual(2, kc._hedge_workers._threads)
+
+    def test_no_hedging_by_default(self):
+        kc = arvados.KeepClient(api_client=self.api_client)
+        loc = [loc for loc in self.store_blocks(20)
+               if kc.weighted_service_roots(arvados.KeepLocator(loc))[0] == self.slow_root][0]
+        t0 = time.time()
+        kc.get(loc, num_retries=0)
+        self.assertGreaterEqual(time.time() - t0, self.SLOW_DELAY)
+
+    def test_hedge_percentile(self):
+        kc = arvados.KeepClient(api_client=self.api_client,
+                                hedge_delay=5, hedge_percentile=90)
+        self.assertEqual(5, kc.current_hedge_delay())
+        for i in range(kc.HEDGE_MIN_SAMPLES):
+            kc._get_latencies.append(0.01 * (i + 1))
+        self.assertAlmostEqual(0.15, kc.current_hedge_delay())
+
+
 class KeepClientGatewayTestCase(unittest.TestCase, tutil.ApiClientMock):
     def mock_disks_and_gateways(self, disks=3, gateways=1):
         self.gateways = [{
@@ -1326,6 +1767,157 @@ class AvoidOverreplication(unittest.TestCase, tutil.ApiClientMock):
         self.assertEqual(self.pool.done(), (self.copies-1, []))
 
 
+class KeepServiceHealthTestCase(unittest.TestCase):
+    ROOTS = ['http://a/', 'http://b/', 'http://c/']
+
+    def setUp(self):
+        self.now = 1000.0
+        patcher = mock.patch('time.time', lambda: self.now)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.health = arvados.keep.KeepServiceHealth()
+
+    def fail(self, root, times=arvados.keep.KeepServiceHealth.FAILURE_THRESHOLD):
+        for _ in range(times):
+            self.health.record(root, None, 1.0)
+
+    def test_circuit_opens_after_consecutive_failures(self):
+        self.fail('http://a/', times=self.health.FAILURE_THRESHOLD - 1)
+        self.assertEqual(self.ROOTS, self.health.reorder(self.ROOTS))
+        self.fail('http://a/', times=1)
+        self.assertEqual(['http://b/', 'http://c/', 'http://a/'],
+                         self.health.reorder(self.ROOTS))
+        metrics = self.health.metrics()['http://a/']
+        self.assertTrue(metrics['circuit_open'])
+        self.assertEqual(self.health.FAILURE_THRESHOLD, metrics['failures'])
+        self.assertEqual(self.now, metrics['last_failure'])
+
+    def test_success_resets_failure_count(self):
+        self.fail('http://a/', times=self.health.FAILURE_THRESHOLD - 1)
+        self.health.record('http://a/', 200, 0.1)
+        self.fail('http://a/', times=1)
+        self.assertEqual(self.ROOTS, self.health.reorder(self.ROOTS))
+
+    def test_client_errors_are_not_failures(self):
+        for _ in range(10):
+            self.health.record('http://a/', 404, 0.1)
+            self.health.record('http://a/', 500, 0.1)
+        self.health.record('http://b/', 503, 0.1)
+        metrics = self.health.metrics()
+        self.assertEqual(10, metrics['http://a/']['failures'])
+        self.assertFalse(metrics['http://a/']['circuit_open'])
+        self.assertAlmostEqual(0.1, metrics['http://a/']['latency'])
+        self.assertEqual(1, metrics['http://b/']['failures'])
+
+    def test_probe_after_cooldown(self):
+        self.fail('http://a/')
+        self.now += self.health.COOLDOWN
+        # The service can be probed...
+        self.assertEqual(self.ROOTS, self.health.reorder(self.ROOTS))
+        self.health.start_request('http://a/')
+        # ...and the rest keep avoiding it until the probe finishes.
+        self.assertEqual('http://a/', self.health.reorder(self.ROOTS)[-1])
+        self.health.record('http://a/', 200, 0.1)
+        self.assertEqual(self.ROOTS, self.health.reorder(self.ROOTS))
+        self.assertFalse(self.health.metrics()['http://a/']['circuit_open'])
+
+    def test_reorder_does_not_take_probe(self):
+        self.fail('http://a/')
+        self.now += self.health.COOLDOWN
+        # Callers that sort the services but send their request
+        # elsewhere don't use up the probe.
+        for _ in range(3):
+            self.assertEqual(self.ROOTS, self.health.reorder(self.ROOTS))
+            self.health.start_request('http://b/')
+            self.health.record('http://b/', 200, 0.1)
+
+    def test_failed_probe_doubles_cooldown(self):
+        self.fail('http://a/')
+        self.now += self.health.COOLDOWN
+        self.health.start_request('http://a/')
+        self.fail('http://a/', times=1)
+        self.now += self.health.COOLDOWN
+        self.assertEqual('http://a/', self.health.reorder(self.ROOTS)[-1])
+        self.now += self.health.COOLDOWN
+        self.assertEqual(self.ROOTS, self.health.reorder(self.ROOTS))
+
+
+@tutil.skip_sleep
+class KeepClientServiceHealthTestCase(unittest.TestCase, tutil.ApiClientMock):
+    def setUp(self):
+        self.api_client = self.mock_keep_services(count=2)
+        self.keep_client = arvados.KeepClient(api_client=self.api_client)
+        self.locator = arvados.KeepLocator(hashlib.md5(b'foo').hexdigest())
+
+    def test_failing_service_tried_last(self):
+        roots = self.keep_client.weighted_service_roots(self.locator)
+        for _ in range(arvados.keep.KeepServiceHealth.FAILURE_THRESHOLD):
+            with tutil.mock_keep_responses(True, 500, 200) as mock:
+                self.keep_client.head(str(self.locator), num_retries=0)
+            self.assertEqual(2, len(mock.responses))
+        self.assertEqual(roots[::-1],
+                         self.keep_client.weighted_service_roots(self.locator))
+        with tutil.mock_keep_responses(True, 200) as mock:
+            self.assertTrue(self.keep_client.head(str(self.locator), num_retries=0))
+        self.assertEqual(roots[1].encode(),
+                         mock.responses[0].getopt(pycurl.URL)[:len(roots[1])])
+        health = self.keep_client.service_health()
+        self.assertTrue(health[roots[0]]['circuit_open'])
+        self.assertEqual(arvados.keep.KeepServiceHealth.FAILURE_THRESHOLD,
+                         health[roots[0]]['failures'])
+        self.assertGreater(health[roots[0]]['error_rate'], 0)
+        self.assertFalse(health[roots[1]]['circuit_open'])
+
+
+class KeepWriterWorkersTestCase(unittest.TestCase, tutil.ApiClientMock):
+    def test_threads_shared_across_puts(self):
+        api_client = self.mock_keep_services(count=4)
+        keep_client = arvados.KeepClient(api_client=api_client, writer_threads=3)
+        for i in range(5):
+            data = 'foo{}'.format(i)
+            with tutil.mock_keep_responses(tutil.str_keep_locator(data), 200, 200):
+                keep_client.put(data, copies=2)
+        self.assertLessEqual(keep_client._writer_workers._threads, 3)
+
+    @mock.patch('arvados.keep._WorkerThreads.IDLE_TIMEOUT', 0.1)
+    def test_idle_threads_exit(self):
+        api_client = self.mock_keep_services(count=4)
+        before = threading.active_count()
+        for i in range(20):
+            keep_client = arvados.KeepClient(api_client=api_client)
+            data = 'foo{}'.format(i)
+            with tutil.mock_keep_responses(tutil.str_keep_locator(data), 200, 200):
+                keep_client.put(data, copies=2)
+        del keep_client
+        deadline = time.time() + 5
+        while threading.active_count() > before and time.time() < deadline:
+            time.sleep(0.05)
+        self.assertLessEqual(threading.active_count(), before)
+
+    def test_concurrency_bounded(self):
+        workers = arvados.KeepClient.KeepWriterWorkers(2)
+        lock = threading.Lock()
+        running = [0]
+        high_water = [0]
+        done = threading.Semaphore(0)
+
+        class Task(object):
+            def run(self):
+                with lock:
+                    running[0] += 1
+                    high_water[0] = max(high_water[0], running[0])
+                time.sleep(0.05)
+                with lock:
+                    running[0] -= 1
+                done.release()
+
+        for i in range(6):
+            workers.submit(Task())
+        for i in range(6):
+            done.acquire()
+        self.assertEqual(2, high_water[0])
+
+
 @tutil.skip_sleep
 class RetryNeedsMultipleServices(unittest.TestCase, tutil.ApiClientMock):
     # Test put()s that need two distinct servers to succeed, possibly
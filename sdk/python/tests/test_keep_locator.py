@@ -88,6 +88,38 @@ class ArvadosKeepLocatorTest(unittest.TestCase):
         self.assertTrue(locator.permission_expired(dt2000))
         self.assertFalse(locator.permission_expired(dt1980))
 
+    def test_permission_hint_after_other_hints(self):
+        base = next(self.base_locators(1))
+        signature = next(self.signatures(1))
+        locator = KeepLocator('{}+Kab1cd+A{}@20000000'.format(base, signature))
+        self.assertEqual(['Kab1cd'], locator.hints)
+        self.assertEqual(signature, locator.perm_sig)
+        self.assertEqual(datetime.datetime(1987, 1, 5, 18, 48, 32), locator.perm_expiry)
+
+    def test_fast_parse_matches_general_parse(self):
+        for hint_gens in [(self.sizes(),),
+                          (self.sizes(), self.perm_hints()),
+                          (self.sizes(), self.perm_hints(), ['Kab1cd'] * 10)]:
+            for loc_data in zip(self.checksums(), *hint_gens):
+                locator = '+'.join(loc_data)
+                fast = KeepLocator(locator)
+                general = KeepLocator.__new__(KeepLocator)
+                general._parse(locator)
+                for attr in ['md5sum', 'size', 'hints', 'perm_sig', 'perm_expiry']:
+                    self.assertEqual(getattr(general, attr), getattr(fast, attr))
+
+    def test_cached_parse_returns_new_object(self):
+        locator = next(self.base_locators(1)) + '+Kab1cd'
+        first = KeepLocator(locator)
+        first.hints.append('Zfoo')
+        second = KeepLocator(locator)
+        self.assertIsNot(first, second)
+        self.assertEqual(['Kab1cd'], second.hints)
+
+    def test_no_instance_dict(self):
+        locator = KeepLocator(next(self.base_locators(1)))
+        self.assertFalse(hasattr(locator, '__dict__'))
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -121,6 +121,17 @@ class FileHandle(Handle):
     """Connects a numeric file handle to a File  object that has
     been opened by the client."""
 
+    def __init__(self, fh, obj):
+        super(FileHandle, self).__init__(fh, obj)
+        self._readahead = None
+
+    def readahead(self):
+        """Return this handle's read-ahead state, so each reader of a file
+        gets prefetching sized for its own access pattern."""
+        if self._readahead is None:
+            self._readahead = self.obj.new_readahead()
+        return self._readahead
+
     def flush(self):
         if self.obj.writable():
             return self.obj.flush()
@@ -249,11 +260,12 @@ class Inodes(object):
     """Manage the set of inodes.  This is the mapping from a numeric id
     to a concrete File or Directory object"""
 
-    def __init__(self, inode_cache, encoding="utf-8"):
+    def __init__(self, inode_cache, encoding="utf-8", prefetch_threads=None):
         self._entries = {}
         self._counter = itertools.count(llfuse.ROOT_INODE)
         self.inode_cache = inode_cache
         self.encoding = encoding
+        self.prefetch_threads = prefetch_threads
         self.deferred_invalidations = []
 
     def __getitem__(self, item):
@@ -375,14 +387,15 @@ class Operations(llfuse.Operations):
     rename_time = fuse_time.labels(op='rename')
     flush_time = fuse_time.labels(op='flush')
 
-    def __init__(self, uid, gid, api_client, encoding="utf-8", inode_cache=None, num_retries=4, enable_write=False):
+    def __init__(self, uid, gid, api_client, encoding="utf-8", inode_cache=None, num_retries=4, enable_write=False,
+                 prefetch_threads=None):
         super(Operations, self).__init__()
 
         self._api_client = api_client
 
         if not inode_cache:
             inode_cache = InodeCache(cap=256*1024*1024)
-        self.inodes = Inodes(inode_cache, encoding=encoding)
+        self.inodes = Inodes(inode_cache, encoding=encoding, prefetch_threads=prefetch_threads)
         self.uid = uid
         self.gid = gid
         self.enable_write = enable_write
@@ -652,7 +665,8 @@ class Operations(llfuse.Operations):
 
         self.inodes.touch(handle.obj)
 
-        r = handle.obj.readfrom(off, size, self.num_retries)
+        r = handle.obj.readfrom(off, size, self.num_retries,
+                                readahead=handle.readahead())
         if r:
             self.read_counter.add(len(r))
         return r
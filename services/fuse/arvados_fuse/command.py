@@ -89,7 +89,12 @@ class ArgumentParser(argparse.ArgumentParser):
         self.add_argument('--encoding', type=str, help="Character encoding to use for filesystem, default is utf-8 (see Python codec registry for list of available encodings)", default="utf-8")
 
         self.add_argument('--file-cache', type=int, help="File data cache size, in bytes (default 256MiB)", default=256*1024*1024)
+        self.add_argument('--disk-cache', action='store_true', help="Store the file data cache on disk, shared with other Keep clients on this host, instead of in RAM", default=False)
+        self.add_argument('--disk-cache-dir', type=str, help="Directory for --disk-cache (default ~/.cache/arvados/keep)", default=None)
         self.add_argument('--directory-cache', type=int, help="Directory data cache size, in bytes (default 128MiB)", default=128*1024*1024)
+        self.add_argument('--prefetch-threads', type=int, help="Number of threads per collection downloading file data ahead of reads (default 2)", default=None)
+        self.add_argument('--keep-hedge-delay', type=float, metavar='SECONDS', help="If a Keep block read has not finished after this many seconds, also request the block from the next Keep service, and use whichever answers first (default: read from one service at a time)", default=None)
+        self.add_argument('--keep-hedge-percentile', type=float, metavar='PERCENT', help="Once enough block reads have completed, use this percentile of recent read times instead of --keep-hedge-delay", default=None)
 
         self.add_argument('--disable-event-listening', action='store_true', help="Don't subscribe to events on the API server", dest="disable_event_listening", default=False)
 
@@ -214,8 +219,13 @@ class Mount(object):
             self.api = arvados.safeapi.ThreadSafeApiCache(
                 apiconfig=arvados.config.settings(),
                 keep_params={
-                    'block_cache': arvados.keep.KeepBlockCache(self.args.file_cache),
+                    'block_cache': arvados.keep.KeepBlockCache(
+                        self.args.file_cache,
+                        disk_cache=self.args.disk_cache,
+                        disk_cache_dir=self.args.disk_cache_dir),
                     'num_retries': self.args.retries,
+                    'hedge_delay': self.args.keep_hedge_delay,
+                    'hedge_percentile': self.args.keep_hedge_percentile,
                 })
         except KeyError as e:
             self.logger.error("Missing environment: %s", e)
@@ -230,7 +240,8 @@ class Mount(object):
             api_client=self.api,
             encoding=self.args.encoding,
             inode_cache=InodeCache(cap=self.args.directory_cache),
-            enable_write=self.args.enable_write)
+            enable_write=self.args.enable_write,
+            prefetch_threads=self.args.prefetch_threads)
 
         if self.args.crunchstat_interval:
             statsthread = threading.Thread(
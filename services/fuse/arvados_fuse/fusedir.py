@@ -473,11 +473,13 @@ class CollectionDirectory(CollectionDirectoryBase):
                         if uuid_pattern.match(self.collection_locator):
                             coll_reader = arvados.collection.Collection(
                                 self.collection_locator, self.api, self.api.keep,
-                                num_retries=self.num_retries)
+                                num_retries=self.num_retries,
+                                get_threads=self.inodes.prefetch_threads)
                         else:
                             coll_reader = arvados.collection.CollectionReader(
                                 self.collection_locator, self.api, self.api.keep,
-                                num_retries=self.num_retries)
+                                num_retries=self.num_retries,
+                                get_threads=self.inodes.prefetch_threads)
                         new_collection_record = coll_reader.api_response() or {}
                         # If the Collection only exists in Keep, there will be no API
                         # response.  Fill in the fields we need.
@@ -578,7 +580,8 @@ class TmpCollectionDirectory(CollectionDirectoryBase):
             api_client=api_client,
             keep_client=api_client.keep,
             num_retries=num_retries,
-            storage_classes_desired=storage_classes)
+            storage_classes_desired=storage_classes,
+            get_threads=inodes.prefetch_threads)
         super(TmpCollectionDirectory, self).__init__(
             parent_inode, inodes, api_client.config, collection)
         self.collection_record_file = None
@@ -28,9 +28,13 @@ class File(FreshBase):
     def size(self):
         return 0
 
-    def readfrom(self, off, size, num_retries=0):
+    def readfrom(self, off, size, num_retries=0, readahead=None):
         return ''
 
+    def new_readahead(self):
+        """Return read-ahead state for one file handle, or None."""
+        return None
+
     def writeto(self, off, size, num_retries=0):
         raise Exception("Not writable")
 
@@ -60,9 +64,14 @@ class FuseArvadosFile(File):
         with llfuse.lock_released:
             return self.arvfile.size()
 
-    def readfrom(self, off, size, num_retries=0):
+    def readfrom(self, off, size, num_retries=0, readahead=None):
+        with llfuse.lock_released:
+            return self.arvfile.readfrom(off, size, num_retries, exact=True,
+                                         readahead=readahead)
+
+    def new_readahead(self):
         with llfuse.lock_released:
-            return self.arvfile.readfrom(off, size, num_retries, exact=True)
+            return self.arvfile.new_readahead()
 
     def writeto(self, off, buf, num_retries=0):
         with llfuse.lock_released:
@@ -89,7 +98,7 @@ class StringFile(File):
     def size(self):
         return len(self.contents)
 
-    def readfrom(self, off, size, num_retries=0):
+    def readfrom(self, off, size, num_retries=0, readahead=None):
         return bytes(self.contents[off:(off+size)], encoding='utf-8')
 
 
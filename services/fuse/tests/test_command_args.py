@@ -91,6 +91,16 @@ class MountArgsTest(unittest.TestCase):
         assertRegex(self, txt, r'portable data hash')
         assertRegex(self, txt, r'\n$')
 
+    @noexit
+    def test_keep_hedge_args(self):
+        args = arvados_fuse.command.ArgumentParser().parse_args([
+            '--keep-hedge-delay', '0.5',
+            '--keep-hedge-percentile', '95',
+            '--foreground', self.mntdir])
+        self.mnt = arvados_fuse.command.Mount(args)
+        self.assertEqual(0.5, self.mnt.api.keep.hedge_delay)
+        self.assertEqual(95, self.mnt.api.keep.hedge_percentile)
+
     @noexit
     def test_by_id(self):
         args = arvados_fuse.command.ArgumentParser().parse_args([
@@ -486,6 +486,33 @@ class FuseWriteFileTest(MountTestBase):
             r'\. 86fb269d190d2c85f6e0468ceca42a20\+12\+A\S+ 0:12:file1\.txt$')
 
 
+class FuseReadAheadPerHandleTest(MountTestBase):
+    def runTest(self):
+        collection = arvados.collection.Collection(api_client=self.api)
+        with collection.open("file1.txt", "wb") as f:
+            f.write(b"0123456789" * 100)
+        collection.save_new()
+
+        m = self.make_mount(fuse.CollectionDirectory)
+        with llfuse.lock:
+            m.new_collection(collection.api_response(), collection)
+            inode = self.operations.lookup(m.inode, b"file1.txt").st_ino
+            fh1 = self.operations.open(inode, os.O_RDONLY)
+            fh2 = self.operations.open(inode, os.O_RDONLY)
+            try:
+                self.assertEqual(b"0123456789", self.operations.read(fh1, 0, 10))
+                self.assertEqual(b"0123456789", self.operations.read(fh2, 500, 10))
+                self.assertEqual(b"0123456789", self.operations.read(fh1, 10, 10))
+                readahead1 = self.operations._filehandles[fh1].readahead()
+                readahead2 = self.operations._filehandles[fh2].readahead()
+            finally:
+                self.operations.release(fh1)
+                self.operations.release(fh2)
+        self.assertIsNot(readahead1, readahead2)
+        # The read through fh2 didn't make fh1 look like a random reader.
+        self.assertEqual(2 * readahead1.MIN_WINDOW, readahead1.stats()['window'])
+
+
 def fuseUpdateFileTestHelper(mounttmp):
     class Test(unittest.TestCase):
         def runTest(self):
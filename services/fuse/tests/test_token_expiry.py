@@ -37,7 +37,7 @@ class TokenExpiryTest(IntegrationTest):
 
     @mock.patch.object(arvados_fuse.Operations, 'open', autospec=True)
     @mock.patch.object(time, 'time', return_value=0)
-    @mock.patch('arvados.keep.KeepClient.get')
+    @mock.patch('arvados.keep.KeepClient._get')
     @IntegrationTest.mount(argv=['--mount-by-id', 'zzz'])
     def test_refresh_old_manifest(self, mocked_get, mocked_time, mocked_open):
         # This test (and associated behavior) is still not strong